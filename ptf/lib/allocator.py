@@ -0,0 +1,144 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import heapq
+import threading
+
+# Largest id allowed by P4Runtime for action profile members and groups.
+MAX_ID = 0xffffffff
+
+
+class IdAllocator(object):
+    """
+    Thread-safe allocator of P4Runtime ids, e.g. action profile member or
+    group ids. Each thread leases blocks of ids, so the lock is taken once
+    per block and allocation is otherwise lock-free. Released ids are
+    allocated again first by the releasing thread, which gives what it can't
+    use soon to a shared free-list. Ids already in use on the switch can be
+    reserved so that they are never allocated.
+    """
+
+    def __init__(self, first=1, last=MAX_ID, block_size=64):
+        self.block_size = block_size
+        self._first = first
+        self._last = last
+        self._lock = threading.Lock()
+        # Ids from this one were never leased.
+        self._next = first
+        # Released ids, as a heap and as a set.
+        self._free = []
+        self._free_set = set()
+        # Ids in use on the switch, never allocated.
+        self._reserved = set()
+        # Blocks of all threads, to purge reserved ids from them.
+        self._blocks = []
+        self._local = threading.local()
+
+    def allocate(self):
+        try:
+            id_ = self._local.ids.pop()
+        except (AttributeError, IndexError):
+            # No block yet, or block used up.
+            id_ = self._lease()
+        if id_ in self._reserved:
+            # Reserved while allocate() was running, see reserve().
+            return self.allocate()
+        return id_
+
+    def _block(self):
+        # Block of the calling thread.
+        ids = getattr(self._local, "ids", None)
+        if ids is None:
+            ids = self._local.ids = []
+            with self._lock:
+                self._blocks.append(ids)
+        return ids
+
+    def _lease(self):
+        # Refills the block of the calling thread, returns an id of it.
+        ids = self._block()
+        block = []
+        with self._lock:
+            while self._free and len(block) < self.block_size:
+                id_ = heapq.heappop(self._free)
+                self._free_set.discard(id_)
+                block.append(id_)
+            while len(block) < self.block_size and self._next <= self._last:
+                start = self._next
+                self._next = min(start + self.block_size - len(block),
+                                 self._last + 1)
+                block.extend(i for i in xrange(start, self._next)
+                             if i not in self._reserved)
+            if not block:
+                raise Exception("No more ids available up to %d"
+                                % self._last)
+            # Allocated in increasing order, popping from the end.
+            block.reverse()
+            ids.extend(block)
+        return ids.pop()
+
+    def release(self, id_):
+        """
+        Returns an id to the allocator. It must not be in use on the switch
+        anymore, i.e. the entity using it must have been deleted. Raises an
+        exception if the id was never allocated or reserved, or was already
+        released.
+        """
+        ids = self._block()
+        with self._lock:
+            if id_ in self._reserved:
+                # Reserved ids released by their user are free again.
+                self._reserved.discard(id_)
+            elif not self._first <= id_ < self._next \
+                    or id_ in self._free_set \
+                    or any(id_ in block for block in self._blocks):
+                raise Exception("Id %d is not allocated" % id_)
+            ids.append(id_)
+            if len(ids) > 2 * self.block_size:
+                # Give to the other threads what this thread can't use soon.
+                for _ in xrange(self.block_size):
+                    id_ = ids.pop(0)
+                    heapq.heappush(self._free, id_)
+                    self._free_set.add(id_)
+
+    def discard(self, ids):
+        """
+        Releases the given ids that are allocated, ignoring the others (e.g.
+        ids chosen by the caller, or already released).
+        """
+        for id_ in ids:
+            try:
+                self.release(id_)
+            except Exception:
+                pass
+
+    def reserve(self, ids):
+        """
+        Marks the given ids (e.g. read from the switch) as in use, so that
+        they are not allocated anymore, even if they were released or leased
+        by a thread before.
+        """
+        with self._lock:
+            self._reserved.update(ids)
+            if self._free_set & self._reserved:
+                self._free_set -= self._reserved
+                self._free = list(self._free_set)
+                heapq.heapify(self._free)
+            for block in self._blocks:
+                for id_ in self._reserved.intersection(block):
+                    try:
+                        block.remove(id_)
+                    except ValueError:
+                        # Allocated by its thread meanwhile.
+                        pass
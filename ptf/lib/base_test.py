@@ -24,15 +24,13 @@ import logging
 logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
 
 import itertools
-import Queue
 import sys
-import threading
 import time
 from StringIO import StringIO
+from contextlib import contextmanager
 from functools import wraps, partial
 from unittest import SkipTest
 
-import google.protobuf.text_format
 import grpc
 import ptf
 import scapy.packet
@@ -40,8 +38,7 @@ import scapy.utils
 from google.protobuf import text_format
 from google.rpc import status_pb2, code_pb2
 from ipaddress import ip_address
-from p4.config.v1 import p4info_pb2
-from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
+from p4.v1 import p4runtime_pb2
 from ptf import config
 from ptf import testutils as testutils
 from ptf.base_tests import BaseTest
@@ -52,7 +49,13 @@ from scapy.layers.l2 import Ether
 from scapy.pton_ntop import inet_pton, inet_ntop
 from scapy.utils6 import in6_getnsma, in6_getnsmac
 
+from capture import DEFAULT_CAPTURE_CAPACITY, PacketInCapture, PayloadMatcher
+from cleanup import Cleanup
 from helper import P4InfoHelper
+from perf import RECORDER
+from pipeline import DEFAULT_WINDOW, WritePipeline, pack_updates, stages
+from reader import P4RuntimeReader
+from session import close_session, get_session, record_timing
 
 DEFAULT_PRIORITY = 10
 
@@ -87,6 +90,20 @@ NA_ICMPV6_TYPE = 136
 # FIXME: this should be removed, use generic packet in test
 PACKET_IN_INGRESS_PORT_META_ID = 1
 
+# Limits of the WriteRequests sent by P4RuntimeTest.insert_many, the byte
+# budget is well below the 4 MB default max message size of gRPC.
+DEFAULT_WRITE_BATCH_SIZE = 1000
+DEFAULT_WRITE_BATCH_BYTES = 1024 * 1024
+
+# Entity message type -> name of the field in p4runtime_pb2.Entity
+ENTITY_FIELDS = {
+    p4runtime_pb2.TableEntry: "table_entry",
+    p4runtime_pb2.ActionProfileMember: "action_profile_member",
+    p4runtime_pb2.ActionProfileGroup: "action_profile_group",
+    p4runtime_pb2.PacketReplicationEngineEntry:
+        "packet_replication_engine_entry",
+}
+
 
 def print_inline(text):
     sys.stdout.write(text)
@@ -240,6 +257,10 @@ class P4RuntimeErrorIterator:
         self.errors = error.details
         self.idx = 0
 
+    def __len__(self):
+        # Number of per-update statuses, including OK ones.
+        return len(self.errors)
+
     def __iter__(self):
         return self
 
@@ -251,6 +272,7 @@ class P4RuntimeErrorIterator:
                 raise P4RuntimeErrorFormatException(
                     "Cannot convert Any message to p4.Error")
             if p4_error.canonical_code == code_pb2.OK:
+                self.idx += 1
                 continue
             v = self.idx, p4_error
             self.idx += 1
@@ -270,8 +292,13 @@ class P4RuntimeWriteException(Exception):
         assert (grpc_error.code() == grpc.StatusCode.UNKNOWN)
         super(P4RuntimeWriteException, self).__init__()
         self.errors = []
+        # Number of updates the server reported a status for.
+        self.num_statuses = 0
+        # Entities of the failed updates, set by P4RuntimeTest.insert_many.
+        self.entities = None
         try:
             error_iterator = P4RuntimeErrorIterator(grpc_error)
+            self.num_statuses = len(error_iterator)
             for error_tuple in error_iterator:
                 self.errors.append(error_tuple)
         except P4RuntimeErrorFormatException:
@@ -292,7 +319,16 @@ class P4RuntimeWriteException(Exception):
 # failed / errored.
 # noinspection PyUnresolvedReferences
 class P4RuntimeTest(BaseTest):
+    # Set to True to clean up with undo_write_requests(reqs, wipe=True).
+    wipe_on_cleanup = False
+
+    # Set to False to close the session to the P4Runtime server at the end of
+    # each test, instead of reusing it in the next one.
+    reuse_session = True
+
     def setUp(self):
+        start = self._start_time = time.time()
+        RECORDER.current_test = self.id()
         BaseTest.setUp(self)
 
         # Setting up PTF dataplane
@@ -324,66 +360,86 @@ class P4RuntimeTest(BaseTest):
                                                            False):
             raise SkipTest("Skipping test in HW")
 
-        self.channel = grpc.insecure_channel(grpc_addr)
-        self.stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+        # The channel and stream are kept open across tests, see session.py
+        self.grpc_addr = grpc_addr
+        self.session = get_session(grpc_addr, self.device_id)
+        self.channel = self.session.channel
+        self.stub = self.session.stub
 
         proto_txt_path = testutils.test_param_get("p4info")
-        # print "Importing p4info proto from", proto_txt_path
-        self.p4info = p4info_pb2.P4Info()
-        with open(proto_txt_path, "rb") as fin:
-            google.protobuf.text_format.Merge(fin.read(), self.p4info)
-
+        # The P4Info is parsed once per process and shared by all tests.
         self.helper = P4InfoHelper(proto_txt_path)
+        self.p4info = self.helper.p4info
+        if not RECORDER.table_names:
+            RECORDER.table_names = {t.preamble.id: t.preamble.name
+                                    for t in self.p4info.tables}
+        # Latency report of the run, see perf.py
+        perf_report = testutils.test_param_get("perf_report")
+        if perf_report:
+            RECORDER.report_at_exit(perf_report)
+        # Use e.g. self.reader.table_entries(table_name) to read switch state
+        self.reader = P4RuntimeReader(self.stub, self.device_id, self.helper)
 
         # used to store write requests sent to the P4Runtime server, useful for
         # autocleanup of tests (see definition of autocleanup decorator below)
         self.reqs = []
+        # Entities queued by insert() inside a batch_writes() block.
+        self._batch = None
+        # PacketIn captures started by the test, stopped in tearDown.
+        self._captures = []
 
         self.election_id = 1
         self.set_up_stream()
+        record_timing("setUp", time.time() - start)
 
     def set_up_stream(self):
-        self.stream_out_q = Queue.Queue()
-        self.stream_in_q = Queue.Queue()
-
-        def stream_req_iterator():
-            while True:
-                p = self.stream_out_q.get()
-                if p is None:
-                    break
-                yield p
-
-        def stream_recv(stream):
-            for p in stream:
-                self.stream_in_q.put(p)
-
-        self.stream = self.stub.StreamChannel(stream_req_iterator())
-        self.stream_recv_thread = threading.Thread(
-            target=stream_recv, args=(self.stream,))
-        self.stream_recv_thread.start()
-
+        # Drop messages left on the stream by the previous test.
+        self.session.flush()
         self.handshake()
 
     def handshake(self):
-        req = p4runtime_pb2.StreamMessageRequest()
-        arbitration = req.arbitration
-        arbitration.device_id = self.device_id
-        election_id = arbitration.election_id
-        election_id.high = 0
-        election_id.low = self.election_id
-        self.stream_out_q.put(req)
-
-        rep = self.get_stream_packet("arbitration", timeout=2)
-        if rep is None:
+        # Arbitration is done again only if the stream went down or the
+        # election id changed.
+        with RECORDER.timed("handshake"):
+            success = self.session.arbitrate(self.election_id, timeout=2)
+        if not success:
             self.fail("Failed to establish handshake")
+        self.stream = self.session.stream
+        self.stream_out_q = self.session.stream_out_q
+        self.stream_in = self.session.dispatcher
+        self.stream_recv_thread = self.session.stream_recv_thread
 
     def tearDown(self):
+        start = time.time()
+        for capture in self._captures:
+            capture.stop()
         self.tear_down_stream()
         BaseTest.tearDown(self)
+        end = time.time()
+        record_timing("tearDown", end - start)
+        RECORDER.record_test(self.id(), end - self._start_time)
+        RECORDER.current_test = None
+
+    def run(self, result=None):
+        if result is None:
+            return BaseTest.run(self, result)
+        # Record the outcome in the perf report, see testcache.py
+        before = (len(result.failures), len(result.errors),
+                  len(result.skipped))
+        BaseTest.run(self, result)
+        if len(result.errors) > before[1]:
+            outcome = "error"
+        elif len(result.failures) > before[0]:
+            outcome = "fail"
+        elif len(result.skipped) > before[2]:
+            outcome = "skip"
+        else:
+            outcome = "ok"
+        RECORDER.record_outcome(self.id(), outcome)
 
     def tear_down_stream(self):
-        self.stream_out_q.put(None)
-        self.stream_recv_thread.join()
+        if not self.reuse_session:
+            close_session(self.grpc_addr, self.device_id)
 
     def get_packet_in(self, timeout=2):
         msg = self.get_stream_packet("packet", timeout)
@@ -395,46 +451,77 @@ class P4RuntimeTest(BaseTest):
     def verify_packet_in(self, exp_packet_in_msg, timeout=2):
         rx_packet_in_msg = self.get_packet_in(timeout=timeout)
 
-        # Check payload first, then metadata
-        rx_pkt = Ether(rx_packet_in_msg.payload)
+        # Check payload first, then metadata. Identical bytes need no
+        # dissection.
         exp_pkt = exp_packet_in_msg.payload
-        if not match_exp_pkt(exp_pkt, rx_pkt):
-            self.fail("Received PacketIn.payload is not the expected one\n"
-                      + format_pkt_match(rx_pkt, exp_pkt))
-
-        rx_meta_dict = {m.metadata_id: m.value
-                        for m in rx_packet_in_msg.metadata}
-        exp_meta_dict = {m.metadata_id: m.value
-                         for m in exp_packet_in_msg.metadata}
-        shared_meta = {mid: rx_meta_dict[mid] for mid in rx_meta_dict
-                       if mid in exp_meta_dict
-                       and rx_meta_dict[mid] == exp_meta_dict[mid]}
-
-        if len(rx_meta_dict) is not len(exp_meta_dict) \
-                or len(shared_meta) is not len(exp_meta_dict):
+        if rx_packet_in_msg.payload != str(exp_pkt):
+            rx_pkt = Ether(rx_packet_in_msg.payload)
+            if not match_exp_pkt(exp_pkt, rx_pkt):
+                self.fail("Received PacketIn.payload is not the expected one\n"
+                          + format_pkt_match(rx_pkt, exp_pkt))
+
+        rx_meta = sorted((m.metadata_id, m.value)
+                         for m in rx_packet_in_msg.metadata)
+        exp_meta = sorted((m.metadata_id, m.value)
+                          for m in exp_packet_in_msg.metadata)
+        if rx_meta != exp_meta:
             self.fail("Received PacketIn.metadata is not the expected one\n"
                       + format_pb_msg_match(rx_packet_in_msg,
                                             exp_packet_in_msg))
 
+    def start_packet_in_capture(self, capacity=DEFAULT_CAPTURE_CAPACITY):
+        """
+        Starts capturing PacketIns, instead of queueing them for
+        get_packet_in, until the end of the test. Use with verify_packet_ins.
+        """
+        capture = PacketInCapture(self.stream_in, self.helper, capacity)
+        self._captures.append(capture.start())
+        return capture
+
+    def verify_packet_ins(self, capture, exp_pkt, count, ingress_port=None,
+                          mask=None, timeout=2, sent_times=None):
+        """
+        Checks that the next count PacketIns of the capture match exp_pkt (on
+        the bytes selected by mask, if any) and ingress_port. Payloads are
+        compared as raw bytes, and dissected only to report a mismatch.
+        Returns the capture.CaptureStats, with rate and latency.
+        """
+        matcher = PayloadMatcher(exp_pkt, mask)
+        stats = capture.verify(matcher, count, ingress_port=ingress_port,
+                               timeout=timeout, sent_times=sent_times)
+        if stats.first_mismatch is not None:
+            payload, port = stats.first_mismatch
+            self.fail("%s\nFirst mismatched PacketIn has ingress_port %s, "
+                      "expected %s\n" % (stats, port, ingress_port)
+                      + format_pkt_match(Ether(payload), matcher.expected))
+        if stats.lost:
+            self.fail(str(stats))
+        return stats
+
+    # Returns the next StreamMessageResponse with the given field set (one of
+    # session.STREAM_KINDS), or None on timeout. Messages of other kinds are
+    # kept for later calls.
     def get_stream_packet(self, type_, timeout=1):
-        start = time.time()
-        try:
-            while True:
-                remaining = timeout - (time.time() - start)
-                if remaining < 0:
-                    break
-                msg = self.stream_in_q.get(timeout=remaining)
-                if not msg.HasField(type_):
-                    continue
-                return msg
-        except:  # timeout expired
-            pass
-        return None
+        with RECORDER.timed("StreamWait[%s]" % type_):
+            return self.stream_in.get(type_, timeout)
 
     def send_packet_out(self, packet):
         packet_out_req = p4runtime_pb2.StreamMessageRequest()
         packet_out_req.packet.CopyFrom(packet)
-        self.stream_out_q.put(packet_out_req)
+        with RECORDER.timed("StreamSend[packet]", 1, len(packet.payload)):
+            self.stream_out_q.put(packet_out_req)
+
+    def send_packet_out_burst(self, burst, timeout=None):
+        """
+        Sends a burst.PacketOutBurst and waits for it to be sent. Fails if
+        it is not sent within timeout seconds.
+        """
+        self.session.send_burst(burst)
+        if not burst.wait(timeout):
+            self.fail("PacketOut burst not sent in %s seconds: %s"
+                      % (timeout, burst))
+        RECORDER.record("StreamSend[burst]", burst.seconds, burst.sent)
+        return burst
 
     def swports(self, idx):
         if idx >= len(self._swports):
@@ -442,12 +529,15 @@ class P4RuntimeTest(BaseTest):
         return self._swports[idx]
 
     def _write(self, req):
+        start = time.time()
         try:
             return self.stub.Write(req)
         except grpc.RpcError as e:
             if e.code() != grpc.StatusCode.UNKNOWN:
                 raise e
             raise P4RuntimeWriteException(e)
+        finally:
+            RECORDER.record_write("Write", req, time.time() - start)
 
     def write_request(self, req, store=True):
         rep = self._write(req)
@@ -455,25 +545,145 @@ class P4RuntimeTest(BaseTest):
             self.reqs.append(req)
         return rep
 
+    def add_update(self, req, update_type, entity):
+        update = req.updates.add()
+        update.type = update_type
+        field = ENTITY_FIELDS.get(type(entity))
+        if field is None:
+            self.fail("Entity %s not supported" % type(entity).__name__)
+        getattr(update.entity, field).CopyFrom(entity)
+        return update
+
     def insert(self, entity):
         if isinstance(entity, list) or isinstance(entity, tuple):
+            if self._batch is not None:
+                self._batch.extend(entity)
+                return
             for e in entity:
                 self.insert(e)
             return
+        if self._batch is not None:
+            self._batch.append(entity)
+            return
         req = self.get_new_write_request()
-        update = req.updates.add()
-        update.type = p4runtime_pb2.Update.INSERT
-        if isinstance(entity, p4runtime_pb2.TableEntry):
-            msg_entity = update.entity.table_entry
-        elif isinstance(entity, p4runtime_pb2.ActionProfileGroup):
-            msg_entity = update.entity.action_profile_group
-        elif isinstance(entity, p4runtime_pb2.ActionProfileMember):
-            msg_entity = update.entity.action_profile_member
-        else:
-            self.fail("Entity %s not supported" % entity.__name__)
-        msg_entity.CopyFrom(entity)
+        self.add_update(req, p4runtime_pb2.Update.INSERT, entity)
         self.write_request(req)
 
+    def insert_many(self, entities, batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                    max_bytes=DEFAULT_WRITE_BATCH_BYTES):
+        """
+        Inserts the given entities, packing up to batch_size updates or
+        max_bytes bytes in each WriteRequest. A new request is started when
+        the entity type changes, so that entities inserted after the ones they
+        depend on (e.g. groups after members) are never in the same batch.
+        Stops at the first failed batch: the P4RuntimeWriteException indices
+        are positions in entities, and the updates of that batch that
+        succeeded are still undone by autocleanup.
+        """
+        for req, batch in self._pack_updates(
+                enumerate(entities), batch_size, max_bytes):
+            try:
+                self.write_request(req)
+            except P4RuntimeWriteException as e:
+                self._handle_batch_error(req, batch, e)
+                raise e
+
+    def insert_pipelined(self, entities, window=DEFAULT_WINDOW,
+                         batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                         max_bytes=DEFAULT_WRITE_BATCH_BYTES):
+        """
+        Same as insert_many, but keeps up to window WriteRequests in flight.
+        Entities are written in dependency order (see pipeline.stages), with
+        a barrier between stages. When requests fail, the errors of the
+        whole stage are gathered in the P4RuntimeWriteException raised, and
+        the following stages are not written. Returns the WritePipeline, with
+        the achieved throughput.
+        """
+        pipeline = WritePipeline(self.stub, window)
+        for stage in stages(entities):
+            sent = []
+            try:
+                for req, batch in self._pack_updates(stage, batch_size,
+                                                     max_bytes):
+                    pipeline.submit(req, batch)
+                    sent.append(req)
+            finally:
+                # Requests in flight must be waited for and recorded for
+                # undo_write_requests, even if a submit failed.
+                errors = pipeline.barrier()
+                failed = set(id(req) for req, _, _ in errors)
+                self.reqs.extend(req for req in sent if id(req) not in failed)
+            if not errors:
+                continue
+            exception = None
+            for req, batch, error in errors:
+                if not isinstance(error, grpc.RpcError) \
+                        or error.code() != grpc.StatusCode.UNKNOWN:
+                    raise error
+                e = P4RuntimeWriteException(error)
+                self._handle_batch_error(req, batch, e)
+                if exception is None:
+                    exception = e
+                else:
+                    exception.errors.extend(e.errors)
+                    exception.entities.extend(e.entities)
+            raise exception
+        return pipeline
+
+    def _pack_updates(self, indexed_entities, batch_size, max_bytes):
+        # Generator of (WriteRequest, [(index, entity)]) inserting the given
+        # (index, entity) pairs.
+        updates = ((item, self.add_update(p4runtime_pb2.WriteRequest(),
+                                          p4runtime_pb2.Update.INSERT,
+                                          item[1]))
+                   for item in indexed_entities)
+        return pack_updates(self.get_new_write_request, updates, batch_size,
+                            max_bytes)
+
+    def _handle_batch_error(self, req, batch, e):
+        # Stores the updates of the failed request that succeeded, for
+        # autocleanup, and maps the error indices to the inserted entities.
+        failed = set(idx for idx, _ in e.errors)
+        # Without one status per update, we can't tell which succeeded.
+        if e.num_statuses == len(req.updates) \
+                and len(failed) < len(req.updates):
+            done = self.get_new_write_request()
+            for idx, update in enumerate(req.updates):
+                if idx not in failed:
+                    done.updates.add().CopyFrom(update)
+            self.reqs.append(done)
+        e.entities = [batch[idx][1] for idx, _ in e.errors]
+        e.errors = [(batch[idx][0], p4_error) for idx, p4_error in e.errors]
+
+    @contextmanager
+    def batch_writes(self, batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                     max_bytes=DEFAULT_WRITE_BATCH_BYTES):
+        """
+        Queues the entities passed to insert() in the with block, and inserts
+        them with insert_many() when the block exits without errors.
+        """
+        if self._batch is not None:
+            # Nested block, entities are inserted by the outer one.
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+            entities = self._batch
+        finally:
+            self._batch = None
+        self.insert_many(entities, batch_size, max_bytes)
+
+    def reserve_switch_ids(self):
+        """
+        Reads the action profile members and groups on the switch, so that
+        their ids are never allocated by get_next_mbr_id/get_next_grp_id.
+        """
+        self.helper.mbr_ids.reserve(
+            m.member_id for m in self.reader.act_prof_members())
+        self.helper.grp_ids.reserve(
+            g.group_id for g in self.reader.act_prof_groups())
+
     def get_new_write_request(self):
         req = p4runtime_pb2.WriteRequest()
         req.device_id = self.device_id
@@ -513,18 +723,66 @@ class P4RuntimeTest(BaseTest):
 
     # iterates over all requests in reverse order; if they are INSERT updates,
     # replay them as DELETE updates; this is a convenient way to clean-up a lot
-    # of switch state
-    def undo_write_requests(self, reqs):
-        updates = []
-        for req in reversed(reqs):
-            for update in reversed(req.updates):
-                if update.type == p4runtime_pb2.Update.INSERT:
-                    updates.append(update)
-        new_req = self.get_new_write_request()
-        for update in updates:
-            update.type = p4runtime_pb2.Update.DELETE
-            new_req.updates.add().CopyFrom(update)
-        self._write(new_req)
+    # of switch state. DELETEs are chunked and sent in dependency order (see
+    # cleanup.Cleanup), and errors are raised only once all chunks are done.
+    # With wipe=True, or if some DELETEs failed, all entries of the tables,
+    # action profiles and PRE entries written by reqs are read from the switch
+    # and deleted instead.
+    def undo_write_requests(self, reqs, wipe=None):
+        if wipe is None:
+            wipe = self.wipe_on_cleanup
+        cleanup = Cleanup(self.stub, self.device_id,
+                          self.get_new_write_request,
+                          DEFAULT_WRITE_BATCH_SIZE, DEFAULT_WRITE_BATCH_BYTES)
+        if wipe:
+            errors = cleanup.wipe(reqs)
+        else:
+            errors = cleanup.undo(reqs)
+            if errors:
+                # E.g. entries modified by the test, retry with what the
+                # switch actually has.
+                errors = cleanup.wipe(reqs)
+        # Members of groups built with reuse=True have been deleted.
+        self.helper.member_pool.reset()
+        if not errors:
+            # Ids taken from the helper's allocators can be used again.
+            release_ids(self.helper, reqs)
+        exception = None
+        for req, error in errors:
+            if not isinstance(error, grpc.RpcError) \
+                    or error.code() != grpc.StatusCode.UNKNOWN:
+                raise error
+            e = P4RuntimeWriteException(error)
+            e.entities = [req.updates[idx].entity for idx, _ in e.errors]
+            if exception is None:
+                exception = e
+            else:
+                exception.errors.extend(e.errors)
+                exception.entities.extend(e.entities)
+        if exception is not None:
+            raise exception
+
+
+def release_ids(helper, reqs):
+    """
+    Gives the action profile member and group ids inserted by reqs, once
+    deleted, back to the allocators of helper. Ids not taken from them
+    (e.g. chosen by the test) are ignored.
+    """
+    member_ids = []
+    group_ids = []
+    for req in reqs:
+        for update in req.updates:
+            if update.type != p4runtime_pb2.Update.INSERT:
+                continue
+            entity = update.entity
+            field = entity.WhichOneof("entity")
+            if field == "action_profile_member":
+                member_ids.append(entity.action_profile_member.member_id)
+            elif field == "action_profile_group":
+                group_ids.append(entity.action_profile_group.group_id)
+    helper.mbr_ids.discard(member_ids)
+    helper.grp_ids.discard(group_ids)
 
 
 # this decorator can be used on the runTest method of P4Runtime PTF tests
@@ -0,0 +1,417 @@
+#!/usr/bin/env python2
+
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Microbenchmarks for the PTF support library. Run them inside the PTF
+# container after building the P4 program, e.g.:
+#     ./lib/bench.py --p4info /p4c-out/p4info.txt
+#     ./lib/bench.py --p4info /p4c-out/p4info.txt lookups
+#
+import argparse
+import sys
+import threading
+import time
+import timeit
+from collections import OrderedDict
+
+import google.protobuf.text_format
+from p4.config.v1 import p4info_pb2
+
+import convert
+from allocator import IdAllocator
+from helper import P4InfoHelper, P4InfoIndex, P4INFO_CACHE_SUFFIX, \
+    get_match_field_value, load_p4info
+from state import TableEntryIndex
+
+BENCHMARKS = OrderedDict()
+
+# P4Runtime entities of main.p4 used by the benchmarks.
+L2_EXACT_TABLE = "IngressPipeImpl.l2_exact_table"
+SET_EGRESS_PORT = "IngressPipeImpl.set_egress_port"
+ROUTING_V6_TABLE = "IngressPipeImpl.routing_v6_table"
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__[len("bench_"):]] = f
+    return f
+
+
+def time_once(fn):
+    start = time.time()
+    fn()
+    return time.time() - start
+
+
+def time_per_call(fn, number):
+    """
+    Returns the best time in microseconds of a single call of fn.
+    """
+    best = min(timeit.Timer(fn).repeat(repeat=3, number=number))
+    return best * 1e6 / number
+
+
+def report_rate(name, count, seconds):
+    print "%-32s %10d in %8.3f s  %12.0f /s" % (
+        name, count, seconds, count / seconds if seconds else float("inf"))
+
+
+def report(name, baseline_us, optimized_us,
+           baseline_label="before", optimized_label="after"):
+    print "%-32s %s %10.2f us  %s %10.2f us  speedup x%.1f" % (
+        name, baseline_label, baseline_us, optimized_label, optimized_us,
+        baseline_us / optimized_us if optimized_us else float("inf"))
+
+
+# Linear scans equivalent to the P4InfoHelper lookups before the introduction
+# of P4InfoIndex, kept here as the baseline.
+def _scan_get(p4info, entity_type, name):
+    for o in getattr(p4info, entity_type):
+        if o.preamble.name == name:
+            return o
+
+
+def _scan_match_field(p4info, table_name, name):
+    for t in p4info.tables:
+        if t.preamble.name == table_name:
+            for mf in t.match_fields:
+                if mf.name == name:
+                    return mf
+
+
+def _scan_action_param(p4info, action_name, name):
+    for a in p4info.actions:
+        if a.preamble.name == action_name:
+            for p in a.params:
+                if p.name == name:
+                    return p
+
+
+@benchmark
+def bench_lookups(helper, args):
+    p4info = helper.p4info
+    keys = []
+    for t in p4info.tables:
+        keys.append(("table", t.preamble.name, None))
+        for mf in t.match_fields:
+            keys.append(("match_field", t.preamble.name, mf.name))
+    for a in p4info.actions:
+        keys.append(("action", a.preamble.name, None))
+        for p in a.params:
+            keys.append(("param", a.preamble.name, p.name))
+
+    def scan():
+        for kind, name, sub in keys:
+            if kind == "table":
+                _scan_get(p4info, "tables", name)
+            elif kind == "action":
+                _scan_get(p4info, "actions", name)
+            elif kind == "match_field":
+                _scan_match_field(p4info, name, sub)
+            else:
+                _scan_action_param(p4info, name, sub)
+
+    def indexed():
+        for kind, name, sub in keys:
+            if kind == "table":
+                helper.get("tables", name=name)
+            elif kind == "action":
+                helper.get("actions", name=name)
+            elif kind == "match_field":
+                helper.get_match_field(name, sub)
+            else:
+                helper.get_action_param(name, sub)
+
+    number = args.number
+    report("lookups (%d keys)" % len(keys),
+           time_per_call(scan, number) / len(keys),
+           time_per_call(indexed, number) / len(keys),
+           "scan", "indexed")
+
+
+@benchmark
+def bench_p4info_load(helper, args):
+    with open(args.p4info, "rb") as f:
+        text = f.read()
+    # Make sure the binary cache exists.
+    load_p4info(args.p4info)
+    with open(args.p4info + P4INFO_CACHE_SUFFIX, "rb") as f:
+        f.readline()
+        binary = f.read()
+
+    def parse_text():
+        google.protobuf.text_format.Merge(text, p4info_pb2.P4Info())
+
+    def parse_binary():
+        p4info_pb2.P4Info().ParseFromString(binary)
+
+    # What a new process does on load_p4info(): parse, then build the index
+    # maps, which are not cached.
+    def load_text():
+        p4info = p4info_pb2.P4Info()
+        google.protobuf.text_format.Merge(text, p4info)
+        P4InfoIndex(p4info)
+
+    def load_binary():
+        P4InfoIndex(p4info_pb2.P4Info.FromString(binary))
+
+    number = max(1, args.number / 100)
+    report("p4info parse", time_per_call(parse_text, number),
+           time_per_call(parse_binary, number), "text", "binary")
+    report("p4info parse + index", time_per_call(load_text, number),
+           time_per_call(load_binary, number), "text", "binary")
+
+
+@benchmark
+def bench_encoders(helper, args):
+    values = [
+        (convert.MAC, 48, "00:00:00:00:aa:01"),
+        (convert.IPV4, 32, "10.0.0.1"),
+        (convert.IPV6, 128, "2001:0000:85a3::8a2e:370:1111"),
+        (convert.UINT, 9, 255),
+    ]
+    for kind, bitwidth, value in values:
+        enc = convert.bind_encoder(kind, bitwidth)
+        report("encode %s" % kind,
+               time_per_call(lambda: convert.encode(value, bitwidth),
+                             args.number * 10),
+               time_per_call(lambda: enc(value), args.number * 10),
+               "inferred", "typed")
+
+
+@benchmark
+def bench_encode_many(helper, args):
+    n = args.entries
+    macs = list(gen_macs(n))
+    ports = [i % 512 for i in xrange(n)]
+    encoded_ports = convert.encode_many(convert.UINT, ports, 9)
+
+    def encode_macs():
+        return [convert.encodeMac(m) for m in macs]
+
+    def encode_ports():
+        return [convert.encodeNum(p, 9) for p in ports]
+
+    def decode_ports():
+        return [convert.decodeNum(x) for x in encoded_ports]
+
+    report("encode MAC column",
+           time_per_call(encode_macs, 1) / n,
+           time_per_call(
+               lambda: convert.encode_many(convert.MAC, macs, 48), 1) / n,
+           "per-item", "column")
+    report("encode 9-bit column",
+           time_per_call(encode_ports, 1) / n,
+           time_per_call(
+               lambda: convert.encode_many(convert.UINT, ports, 9), 1) / n,
+           "per-item", "column")
+    report("decode 9-bit column",
+           time_per_call(decode_ports, 1) / n,
+           time_per_call(
+               lambda: convert.decode_many(convert.UINT, encoded_ports, 9),
+               1) / n,
+           "per-item", "column")
+
+
+def gen_macs(n):
+    for i in xrange(n):
+        yield "00:00:%02x:%02x:%02x:%02x" % (
+            (i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+
+
+def gen_ipv6_addrs(n):
+    for i in xrange(n):
+        yield "2001:db8::%x:%x" % (i >> 16, i & 0xffff)
+
+
+@benchmark
+def bench_table_entries(helper, args):
+    n = args.entries
+    macs = list(gen_macs(n))
+    ipv6_addrs = list(gen_ipv6_addrs(n))
+
+    def l2_one_by_one():
+        for mac in macs:
+            helper.build_table_entry(
+                table_name=L2_EXACT_TABLE,
+                match_fields={"hdr.ethernet.dst_addr": mac},
+                action_name=SET_EGRESS_PORT,
+                action_params={"port_num": 1})
+
+    def l2_batch():
+        for _ in helper.build_table_entries(
+                L2_EXACT_TABLE, SET_EGRESS_PORT,
+                ((mac, 1) for mac in macs)):
+            pass
+
+    def v6_one_by_one():
+        for addr in ipv6_addrs:
+            helper.build_table_entry(
+                table_name=ROUTING_V6_TABLE,
+                match_fields={"hdr.ipv6.dst_addr": (addr, 128)},
+                group_id=1)
+
+    def v6_batch():
+        for _ in helper.build_table_entries(
+                ROUTING_V6_TABLE, None,
+                (((addr, 128), 1) for addr in ipv6_addrs)):
+            pass
+
+    report("l2_exact_table entry", time_per_call(l2_one_by_one, 1) / n,
+           time_per_call(l2_batch, 1) / n, "single", "batch")
+    report("routing_v6_table entry", time_per_call(v6_one_by_one, 1) / n,
+           time_per_call(v6_batch, 1) / n, "single", "batch")
+
+
+@benchmark
+def bench_decode(helper, args):
+    n = args.entries
+    entries = list(helper.build_table_entries(
+        L2_EXACT_TABLE, SET_EGRESS_PORT,
+        ((mac, 1) for mac in gen_macs(n))))
+
+    # Decoding of the values as done before the decoder, with the
+    # conversions of convert.py at the time.
+    def decode_mac(x):
+        return ':'.join(c.encode('hex') for c in x)
+
+    def decode_num(x):
+        return int(x.encode('hex'), 16)
+
+    def decode_with_lookups():
+        for entry in entries:
+            table_name = helper.get_tables_name(entry.table_id)
+            action = entry.action.action
+            action_name = helper.get_actions_name(action.action_id)
+            {
+                "table_name": table_name,
+                "match_fields": {
+                    helper.get_match_field_name(table_name, m.field_id):
+                        decode_mac(get_match_field_value(m))
+                    for m in entry.match},
+                "action_name": action_name,
+                "action_params": {
+                    helper.get_action_param_name(action_name, p.param_id):
+                        decode_num(p.value) for p in action.params},
+            }
+
+    def decode_with_decoder():
+        for entry in entries:
+            helper.decode(entry)
+
+    report("decode l2_exact_table entry",
+           time_per_call(decode_with_lookups, 1) / n,
+           time_per_call(decode_with_decoder, 1) / n,
+           "lookups", "decoder")
+
+
+@benchmark
+def bench_entry_index(helper, args):
+    n = args.entries
+    current_rows = [(mac, 1) for mac in gen_macs(n)]
+    # 10% of the entries change action, 10% are replaced by new ones.
+    desired_rows = [(mac, 2 if i % 10 == 0 else 1)
+                    for i, mac in enumerate(gen_macs(n + n / 10))
+                    if i % 10 != 1]
+    current = list(helper.build_table_entries(
+        L2_EXACT_TABLE, SET_EGRESS_PORT, current_rows))
+    desired = list(helper.build_table_entries(
+        L2_EXACT_TABLE, SET_EGRESS_PORT, desired_rows))
+
+    indexes = []
+    seconds = time_once(lambda: indexes.append(TableEntryIndex(current)))
+    report_rate("index table entries", n, seconds)
+    indexes.append(TableEntryIndex(desired))
+    updates = []
+    seconds = time_once(lambda: updates.extend(indexes[0].diff(indexes[1])))
+    report_rate("diff table entries", n, seconds)
+
+
+class _LockedCounter(object):
+    # Baseline for bench_id_alloc: a shared counter taking a lock for each id.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = 1
+
+    def allocate(self):
+        with self._lock:
+            id_ = self._next
+            self._next += 1
+            return id_
+
+
+def _allocate_concurrently(allocator, threads, count):
+    ids = [[] for _ in xrange(threads)]
+
+    def worker(out):
+        allocate = allocator.allocate
+        for _ in xrange(count):
+            out.append(allocate())
+
+    workers = [threading.Thread(target=worker, args=(out,)) for out in ids]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    seconds = time.time() - start
+    all_ids = [i for out in ids for i in out]
+    if len(set(all_ids)) != len(all_ids):
+        raise Exception("Duplicate ids allocated")
+    return seconds
+
+
+@benchmark
+def bench_id_alloc(helper, args):
+    for threads in (1, 4, 16):
+        count = args.entries / threads
+        total = count * threads
+        report_rate("locked counter, %d threads" % threads, total,
+                    _allocate_concurrently(_LockedCounter(), threads, count))
+        report_rate("IdAllocator, %d threads" % threads, total,
+                    _allocate_concurrently(IdAllocator(), threads, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run microbenchmarks of the PTF support library")
+    parser.add_argument('--p4info',
+                        help='Location of p4info proto in text format',
+                        type=str, action="store", required=True)
+    parser.add_argument('--number',
+                        help='Iterations per timing run',
+                        type=int, default=1000)
+    parser.add_argument('--entries',
+                        help='Number of entries built by bulk benchmarks',
+                        type=int, default=100000)
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run (default: all), one of: %s'
+                             % ', '.join(BENCHMARKS.keys()))
+    args = parser.parse_args()
+
+    names = args.benchmarks or BENCHMARKS.keys()
+    for name in names:
+        if name not in BENCHMARKS:
+            print "Unknown benchmark '{}'".format(name)
+            sys.exit(1)
+
+    helper = P4InfoHelper(args.p4info)
+    for name in names:
+        BENCHMARKS[name](helper, args)
+
+
+if __name__ == '__main__':
+    main()
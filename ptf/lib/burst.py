@@ -0,0 +1,175 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import itertools
+import threading
+import time
+
+from p4.v1 import p4runtime_pb2
+
+"""
+Bursts of PacketOuts sent on a P4Runtime StreamChannel. A burst is iterated
+by the gRPC thread consuming the stream requests (see
+session.P4RuntimeSession.send_burst), which serializes each request before
+asking for the next one: all the packets of a burst are sent by mutating a
+single preallocated StreamMessageRequest.
+"""
+
+
+class PacketOutBurst(object):
+    """
+    Burst of the packets given by packets: an iterable, or a callable
+    returning the i-th packet (None after the last one). Packets are
+    PacketOut messages or raw payloads (without metadata). Iterating yields
+    the same StreamMessageRequest, filled by fill() with the i-th packet,
+    optionally paced to pps packets per second. Once iterated, sent and
+    seconds give the achieved rate. Subclasses can override fill() instead
+    of giving packets.
+    """
+
+    def __init__(self, packets=None, count=None, pps=None):
+        if packets is None and type(self).fill == PacketOutBurst.fill:
+            raise ValueError("No packets for the burst")
+        self.count = count
+        self.pps = pps
+        self.sent = 0
+        self.seconds = 0.0
+        self._done = threading.Event()
+        self._source = packets if callable(packets) else None
+        self._packets = None if packets is None or self._source \
+            else iter(packets)
+
+    def init(self, req):
+        """
+        Sets the fields of req common to all packets.
+        """
+        pass
+
+    def fill(self, req, i):
+        """
+        Sets req.packet to the i-th packet, returns False after the last one.
+        """
+        if self._source is not None:
+            packet = self._source(i)
+        else:
+            packet = next(self._packets, None)
+        if packet is None:
+            return False
+        if isinstance(packet, p4runtime_pb2.PacketOut):
+            req.packet.CopyFrom(packet)
+        else:
+            req.packet.payload = packet
+        return True
+
+    def __iter__(self):
+        req = p4runtime_pb2.StreamMessageRequest()
+        self.init(req)
+        interval = 1.0 / self.pps if self.pps else 0
+        indexes = itertools.count() if self.count is None \
+            else xrange(self.count)
+        start = time.time()
+        try:
+            for i in indexes:
+                if not self.fill(req, i):
+                    break
+                if interval:
+                    delay = start + i * interval - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                yield req
+                self.sent += 1
+        finally:
+            self.seconds = time.time() - start
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the burst to be sent, returns False on timeout.
+        """
+        return self._done.wait(timeout)
+
+    def rate(self):
+        """
+        Returns the achieved rate, in packets per second.
+        """
+        return self.sent / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        text = "%d PacketOuts in %.3f s, %.0f pps" % (
+            self.sent, self.seconds, self.rate())
+        if self.pps:
+            text += " (target %.0f pps)" % self.pps
+        return text
+
+
+class PacketOutList(PacketOutBurst):
+    """
+    Burst of the given PacketOut messages or raw payloads (without
+    metadata).
+    """
+
+    def __init__(self, packets, pps=None):
+        super(PacketOutList, self).__init__(packets, pps=pps)
+
+
+class PacketOutTemplate(PacketOutBurst):
+    """
+    Burst of count copies of a template PacketOut (built with
+    P4InfoHelper.build_packet_out from payload and metadata), with field
+    variations: the i-th packet has payload_variations[offset][i % n]
+    written in the payload at each offset, and metadata
+    metadata_variations[name][i % n] for each metadata name.
+    """
+
+    def __init__(self, helper, payload, metadata=None, count=1, pps=None,
+                 payload_variations=None, metadata_variations=None):
+        super(PacketOutTemplate, self).__init__(count=count, pps=pps)
+        metadata = dict(metadata or {})
+        metadata_variations = metadata_variations or {}
+        for name, values in metadata_variations.iteritems():
+            metadata.setdefault(name, values[0])
+        self.template = helper.build_packet_out(str(payload), metadata)
+        self._payload = bytearray(self.template.payload)
+        self._payload_variations = sorted(
+            (offset, [str(v) for v in values])
+            for offset, values in (payload_variations or {}).iteritems())
+        for offset, values in self._payload_variations:
+            for v in values:
+                if offset + len(v) > len(self._payload):
+                    raise ValueError("Variation %r at offset %d exceeds the "
+                                     "payload" % (v, offset))
+        # (index in PacketOut.metadata, encoded values)
+        self._metadata_variations = []
+        ids = [m.metadata_id for m in self.template.metadata]
+        for name, values in sorted(metadata_variations.iteritems()):
+            encode = helper.index.get_encoder(
+                "packet_metadata", "packet_out", name)
+            meta_id = helper.get_packet_metadata("packet_out", name).id
+            self._metadata_variations.append(
+                (ids.index(meta_id), [encode(v) for v in values]))
+
+    def init(self, req):
+        req.packet.CopyFrom(self.template)
+
+    def fill(self, req, i):
+        packet = req.packet
+        if self._payload_variations:
+            payload = self._payload
+            for offset, values in self._payload_variations:
+                v = values[i % len(values)]
+                payload[offset:offset + len(v)] = v
+            packet.payload = str(payload)
+        for meta_idx, values in self._metadata_variations:
+            packet.metadata[meta_idx].value = values[i % len(values)]
+        return True
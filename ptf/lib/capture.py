@@ -0,0 +1,213 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import threading
+import time
+from binascii import hexlify
+
+# Max number of PacketIns kept by a PacketInCapture.
+DEFAULT_CAPTURE_CAPACITY = 65536
+
+
+class PayloadMatcher(object):
+    """
+    Matches raw payloads against an expected packet, on the bytes selected by
+    a mask. The expected packet can be a byte string, a scapy packet or a
+    ptf.mask.Mask. Comparisons are done on Python ints, without dissecting
+    the payload.
+    """
+
+    def __init__(self, expected, mask=None):
+        if hasattr(expected, "exp_pkt") and hasattr(expected, "mask"):
+            # ptf.mask.Mask
+            mask = bytearray(expected.mask)
+            expected = expected.exp_pkt
+        self.expected = expected
+        expected = str(expected)
+        self.length = len(expected)
+        if mask is None:
+            self._mask = None
+            self._value = expected
+        else:
+            mask = str(bytearray(mask))
+            if len(mask) != self.length:
+                raise ValueError("Mask length %d does not match packet "
+                                 "length %d" % (len(mask), self.length))
+            self._mask = int(hexlify(mask), 16) if mask else 0
+            self._value = (int(hexlify(expected), 16) if expected else 0) \
+                & self._mask
+
+    def __call__(self, payload):
+        if len(payload) != self.length:
+            return False
+        if self._mask is None:
+            return payload == self._value
+        if not payload:
+            return True
+        return int(hexlify(payload), 16) & self._mask == self._value
+
+
+class CaptureStats(object):
+    """
+    Result of PacketInCapture.verify.
+    """
+
+    def __init__(self, expected, received, mismatched, rate, latencies):
+        self.expected = expected
+        self.received = received
+        self.mismatched = mismatched
+        self.lost = expected - received
+        # PacketIns per second, between the first and last received.
+        self.rate = rate
+        latencies = sorted(latencies)
+        self.latency_avg = sum(latencies) / len(latencies) \
+            if latencies else None
+        self.latency_max = latencies[-1] if latencies else None
+        self.latency_p99 = latencies[int(len(latencies) * 0.99)] \
+            if latencies else None
+        # (payload, ingress port) of the first mismatched PacketIn
+        self.first_mismatch = None
+
+    def __str__(self):
+        text = "%d/%d PacketIns received, %d lost, %d mismatched, " \
+               "%.0f pps" % (self.received, self.expected, self.lost,
+                             self.mismatched, self.rate)
+        if self.latency_avg is not None:
+            text += ", latency avg %.3f ms, p99 %.3f ms, max %.3f ms" % (
+                self.latency_avg * 1e3, self.latency_p99 * 1e3,
+                self.latency_max * 1e3)
+        return text
+
+
+class PacketInCapture(object):
+    """
+    Stores the PacketIns received on a session.StreamDispatcher in a
+    preallocated ring buffer, as (payload, ingress port, receive time). Only
+    the ingress_port metadata is decoded. When the buffer is full, the oldest
+    PacketIns are overwritten and counted in overwritten.
+    """
+
+    def __init__(self, dispatcher, helper,
+                 capacity=DEFAULT_CAPTURE_CAPACITY):
+        self.dispatcher = dispatcher
+        self.capacity = capacity
+        self._payloads = [None] * capacity
+        self._ports = [None] * capacity
+        self._times = [0.0] * capacity
+        # Number of PacketIns captured and consumed since start().
+        self._count = 0
+        self._read = 0
+        self.overwritten = 0
+        self._cond = threading.Condition()
+        self._port_id = helper.get_packet_metadata(
+            "packet_in", "ingress_port").id
+        self._decode_port = helper.index.get_decoder(
+            "packet_metadata", "packet_in", "ingress_port")
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            self.dispatcher.subscribe("packet", self._on_packet)
+            self._started = True
+        return self
+
+    def stop(self):
+        if self._started:
+            self.dispatcher.unsubscribe("packet", self._on_packet)
+            self._started = False
+
+    def _on_packet(self, msg):
+        # Called from the stream receiver thread.
+        now = time.time()
+        packet = msg.packet
+        port = None
+        for m in packet.metadata:
+            if m.metadata_id == self._port_id:
+                port = self._decode_port(m.value)
+        with self._cond:
+            i = self._count % self.capacity
+            self._payloads[i] = packet.payload
+            self._ports[i] = port
+            self._times[i] = now
+            self._count += 1
+            if self._count - self._read > self.capacity:
+                self._read += 1
+                self.overwritten += 1
+            self._cond.notify()
+
+    def __len__(self):
+        """
+        Number of PacketIns captured and not consumed yet.
+        """
+        return self._count - self._read
+
+    def next(self, timeout=None):
+        """
+        Returns the oldest captured PacketIn not consumed yet, as (payload,
+        ingress port, receive time), waiting up to timeout seconds for one.
+        Returns None on timeout.
+        """
+        with self._cond:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self._read == self._count:
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            i = self._read % self.capacity
+            self._read += 1
+            return self._payloads[i], self._ports[i], self._times[i]
+
+    def verify(self, expected, count, ingress_port=None, mask=None,
+               timeout=2, sent_times=None):
+        """
+        Consumes count PacketIns, matching their payload against expected
+        (see PayloadMatcher) and their ingress port, if given. Waits up to
+        timeout seconds for each PacketIn; missing ones are counted as lost.
+        If sent_times is given, the i-th PacketIn latency is measured from
+        sent_times[i]. Returns a CaptureStats.
+        """
+        match = expected if isinstance(expected, PayloadMatcher) \
+            else PayloadMatcher(expected, mask)
+        received = 0
+        mismatched = 0
+        first_mismatch = None
+        first_time = last_time = None
+        latencies = []
+        for i in xrange(count):
+            captured = self.next(timeout)
+            if captured is None:
+                break
+            payload, port, rx_time = captured
+            received += 1
+            if first_time is None:
+                first_time = rx_time
+            last_time = rx_time
+            if sent_times is not None and i < len(sent_times):
+                latencies.append(rx_time - sent_times[i])
+            if not match(payload) \
+                    or (ingress_port is not None and port != ingress_port):
+                mismatched += 1
+                if first_mismatch is None:
+                    first_mismatch = payload, port
+        duration = (last_time - first_time) if received > 1 else 0
+        stats = CaptureStats(count, received, mismatched,
+                             (received - 1) / duration if duration else 0.0,
+                             latencies)
+        stats.first_mismatch = first_mismatch
+        return stats
@@ -0,0 +1,139 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from p4.v1 import p4runtime_pb2
+
+from pipeline import DEFAULT_WINDOW, WritePipeline, pack_updates
+from reader import P4RuntimeReader
+
+# Entities are deleted in this order, i.e. before the entities they reference.
+# Entities of other types are deleted last.
+DELETE_ORDER = (
+    "table_entry",
+    "action_profile_group",
+    "action_profile_member",
+    "packet_replication_engine_entry",
+)
+
+
+class Cleanup(object):
+    """
+    Deletes switch state in chunks of at most batch_size updates or max_bytes
+    bytes, stage by stage in DELETE_ORDER. The chunks of a stage are written
+    concurrently, and a failed chunk does not stop the cleanup: failed
+    requests are returned as a list of (WriteRequest, grpc.RpcError).
+    """
+
+    def __init__(self, stub, device_id, new_write_request, batch_size,
+                 max_bytes, window=DEFAULT_WINDOW):
+        self.stub = stub
+        self.device_id = device_id
+        self.new_write_request = new_write_request
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.window = window
+        self.reader = P4RuntimeReader(stub, device_id)
+
+    def undo(self, reqs):
+        """
+        Deletes the entities inserted by the given WriteRequests.
+        """
+        entities = []
+        for req in reversed(reqs):
+            for update in reversed(req.updates):
+                if update.type == p4runtime_pb2.Update.INSERT:
+                    entities.append(update.entity)
+        return self.delete(entities)
+
+    def wipe(self, reqs):
+        """
+        Deletes all entries of the tables, action profiles and PRE entries
+        written by the given WriteRequests, as read from the switch.
+        """
+        entities = affected(reqs)
+        if not entities:
+            return []
+        return self.delete(self.reader.read(entities))
+
+    def delete(self, entities):
+        """
+        Deletes the given p4runtime_pb2.Entity messages.
+        """
+        by_stage = {}
+        for entity in entities:
+            field = entity.WhichOneof("entity")
+            if field == "table_entry" and entity.table_entry.is_default_action:
+                # Default entries can't be deleted.
+                continue
+            stage = DELETE_ORDER.index(field) if field in DELETE_ORDER \
+                else len(DELETE_ORDER)
+            by_stage.setdefault(stage, []).append(entity)
+
+        pipeline = WritePipeline(self.stub, self.window)
+        for stage in sorted(by_stage):
+            for req, _ in pack_updates(self.new_write_request,
+                                       _deletes(by_stage[stage]),
+                                       self.batch_size, self.max_bytes):
+                pipeline.submit(req)
+            pipeline.barrier()
+        return [(req, error) for req, _, error in pipeline.errors]
+
+
+def _deletes(entities):
+    # (key, Update) pairs for pack_updates.
+    for entity in entities:
+        update = p4runtime_pb2.Update()
+        update.type = p4runtime_pb2.Update.DELETE
+        update.entity.CopyFrom(entity)
+        yield None, update
+
+
+def affected(reqs):
+    """
+    Returns the wildcard entities to read all the tables, action profiles and
+    PRE entries written by the given WriteRequests.
+    """
+    table_ids = set()
+    act_prof_ids = set()
+    pre_types = set()
+    for req in reqs:
+        for update in req.updates:
+            entity = update.entity
+            field = entity.WhichOneof("entity")
+            if field == "table_entry":
+                table_ids.add(entity.table_entry.table_id)
+            elif field == "action_profile_member":
+                act_prof_ids.add(entity.action_profile_member
+                                 .action_profile_id)
+            elif field == "action_profile_group":
+                act_prof_ids.add(entity.action_profile_group
+                                 .action_profile_id)
+            elif field == "packet_replication_engine_entry":
+                pre_types.add(entity.packet_replication_engine_entry
+                              .WhichOneof("type"))
+
+    entities = []
+    for table_id in sorted(table_ids):
+        entities.append(p4runtime_pb2.Entity())
+        entities[-1].table_entry.table_id = table_id
+    for act_prof_id in sorted(act_prof_ids):
+        entities.append(p4runtime_pb2.Entity())
+        entities[-1].action_profile_member.action_profile_id = act_prof_id
+        entities.append(p4runtime_pb2.Entity())
+        entities[-1].action_profile_group.action_profile_id = act_prof_id
+    for pre_type in sorted(pre_types):
+        entities.append(p4runtime_pb2.Entity())
+        getattr(entities[-1].packet_replication_engine_entry,
+                pre_type).SetInParent()
+    return entities
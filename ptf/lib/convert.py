@@ -12,12 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import binascii
 import math
 import re
 import socket
+import struct
 
 import ipaddress
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 """
 This package contains several helper functions for encoding to and decoding from
 byte strings:
@@ -29,6 +36,9 @@ byte strings:
 
 mac_pattern = re.compile(r'^([\da-fA-F]{2}:){5}([\da-fA-F]{2})$')
 
+# Hex digits of each byte value, for decodeMac.
+_HEX_BYTES = ['%02x' % i for i in range(256)]
+
 
 def matchesMac(mac_addr_string):
     return mac_pattern.match(mac_addr_string) is not None
@@ -39,7 +49,7 @@ def encodeMac(mac_addr_string):
 
 
 def decodeMac(encoded_mac_addr):
-    return ':'.join(s.encode('hex') for s in encoded_mac_addr)
+    return ':'.join([_HEX_BYTES[ord(c)] for c in encoded_mac_addr])
 
 
 ip_pattern = re.compile(r'^(\d{1,3}\.){3}(\d{1,3})$')
@@ -75,6 +85,8 @@ def bitwidthToBytes(bitwidth):
 
 def encodeNum(number, bitwidth):
     byte_len = bitwidthToBytes(bitwidth)
+    if number < 0:
+        raise Exception("Negative number, %d, cannot be encoded" % number)
     num_str = '%x' % number
     if number >= 2 ** bitwidth:
         raise Exception(
@@ -83,7 +95,7 @@ def encodeNum(number, bitwidth):
 
 
 def decodeNum(encoded_number):
-    return int(encoded_number.encode('hex'), 16)
+    return int(binascii.hexlify(encoded_number), 16)
 
 
 def encode(x, bitwidth):
@@ -110,6 +122,262 @@ def encode(x, bitwidth):
     return encoded_bytes
 
 
+# Kinds of explicit encoders, see bind_encoder().
+MAC = "mac"
+IPV4 = "ipv4"
+IPV6 = "ipv6"
+UINT = "uint"
+RAW = "raw"
+
+
+def guess_encoder_kind(name, bitwidth):
+    """
+    Returns the encoder kind for a P4Info match field, action param or packet
+    metadata with the given name and bitwidth.
+    """
+    if bitwidth == 48:
+        return MAC
+    if bitwidth == 128:
+        return IPV6
+    if bitwidth == 32 and ("addr" in name or "ipv4" in name):
+        return IPV4
+    return UINT
+
+
+def bind_encoder(kind, bitwidth):
+    """
+    Returns a function encoding a single value of the given kind into a byte
+    string of bitwidth bits, without inferring the type of the value. Values
+    that do not have the form expected by the encoder (e.g. an integer given
+    to a MAC encoder) are handed over to encode().
+    """
+    byte_len = bitwidthToBytes(bitwidth)
+
+    if kind == UINT:
+        hex_len = byte_len * 2
+        limit = 1 << bitwidth
+
+        def enc(x):
+            if (type(x) == int or type(x) == long) and 0 <= x < limit:
+                return ('%0*x' % (hex_len, x)).decode('hex')
+            return encode(x, bitwidth)
+
+    elif kind == MAC:
+        if byte_len != 6:
+            raise Exception("MAC encoder needs 48 bits, not %d" % bitwidth)
+
+        def enc(x):
+            if type(x) == str and len(x) == 17:
+                try:
+                    encoded = x.replace(':', '').decode('hex')
+                    if len(encoded) == 6:
+                        return encoded
+                except TypeError:
+                    pass
+            return encode(x, bitwidth)
+
+    elif kind == IPV4:
+        if byte_len != 4:
+            raise Exception("IPv4 encoder needs 32 bits, not %d" % bitwidth)
+
+        def enc(x):
+            if type(x) == str and len(x) != 4:
+                try:
+                    return socket.inet_pton(socket.AF_INET, x)
+                except socket.error:
+                    pass
+            return encode(x, bitwidth)
+
+    elif kind == IPV6:
+        if byte_len != 16:
+            raise Exception("IPv6 encoder needs 128 bits, not %d" % bitwidth)
+
+        def enc(x):
+            # 16-char strings may be either already encoded or an address.
+            if type(x) == str and len(x) != 16:
+                try:
+                    return socket.inet_pton(socket.AF_INET6, x)
+                except socket.error:
+                    pass
+            return encode(x, bitwidth)
+
+    elif kind == RAW:
+        def enc(x):
+            if type(x) == str and len(x) == byte_len:
+                return x
+            return encode(x, bitwidth)
+
+    else:
+        raise Exception("Unknown encoder kind %r" % kind)
+    return enc
+
+
+def bind_decoder(kind, bitwidth):
+    """
+    Returns a function decoding a byte string into a value of the given kind
+    (see bind_encoder). Byte strings shorter than bitwidth, such as the
+    canonical representation used by P4Runtime servers, are accepted.
+    """
+    byte_len = bitwidthToBytes(bitwidth)
+    if kind == UINT:
+        return lambda x: int(binascii.hexlify(x), 16) if x else 0
+    elif kind == MAC:
+        return lambda x: decodeMac(x.rjust(byte_len, '\x00'))
+    elif kind == IPV4:
+        return lambda x: decodeIPv4(x.rjust(byte_len, '\x00'))
+    elif kind == IPV6:
+        return lambda x: socket.inet_ntop(socket.AF_INET6,
+                                          x.rjust(byte_len, '\x00'))
+    elif kind == RAW:
+        return lambda x: x
+    raise Exception("Unknown encoder kind %r" % kind)
+
+
+class EncodedColumn(object):
+    """
+    Sequence of fixed-width encoded values packed in a single byte string, as
+    returned by encode_many(). Items are byte strings, use view() to access
+    them without copies.
+    """
+
+    def __init__(self, buf, width):
+        self.buf = buf
+        self.width = width
+
+    def __len__(self):
+        return len(self.buf) // self.width
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("EncodedColumn index out of range")
+        offset = idx * self.width
+        return self.buf[offset:offset + self.width]
+
+    def __iter__(self):
+        buf, width = self.buf, self.width
+        for offset in xrange(0, len(buf), width):
+            yield buf[offset:offset + width]
+
+    def view(self, idx):
+        offset = idx * self.width
+        return memoryview(self.buf)[offset:offset + self.width]
+
+
+def _is_int_column(values):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.dtype.kind in "iu"
+    return len(values) > 0 and all(type(v) == int or type(v) == long
+                                   for v in values)
+
+
+def _is_str_column(values):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.dtype.kind == "S"
+    return all(isinstance(v, str) for v in values)
+
+
+def _pack_uints(values, bitwidth):
+    byte_len = bitwidthToBytes(bitwidth)
+    n = len(values)
+    is_array = numpy is not None and isinstance(values, numpy.ndarray)
+    if n and (values.min() if is_array else min(values)) < 0:
+        raise Exception("Negative numbers cannot be encoded")
+    if bitwidth > 64:
+        # No fixed-size integer type to pack into, go through hex.
+        if n and max(values) >> bitwidth:
+            raise Exception("Numbers do not fit in %d bits" % bitwidth)
+        return ''.join('%0*x' % (byte_len * 2, v) for v in values) \
+            .decode('hex')
+    if is_array:
+        if n and bitwidth < 64 and values.max() >> bitwidth:
+            raise Exception("Numbers do not fit in %d bits" % bitwidth)
+        packed = values.astype('>u8').view(numpy.uint8).reshape(n, 8)
+        return packed[:, 8 - byte_len:].tobytes()
+    if n and max(values) >> bitwidth:
+        raise Exception("Numbers do not fit in %d bits" % bitwidth)
+    packed = struct.pack('>%dQ' % n, *values)
+    if byte_len == 8:
+        return packed
+    # Keep the last byte_len bytes of each 8-byte word, one strided copy per
+    # byte position instead of one slice per value.
+    out = bytearray(n * byte_len)
+    for k in xrange(byte_len):
+        out[k::byte_len] = packed[8 - byte_len + k::8]
+    return str(out)
+
+
+def encode_many(kind, values, bitwidth):
+    """
+    Encodes a sequence (or NumPy array) of values of the given kind (see
+    bind_encoder) into an EncodedColumn of bitwidth-bit values. Integers are
+    accepted for all kinds and packed without per-value string conversions.
+    Columns mixing integers and strings are encoded value by value.
+    """
+    byte_len = bitwidthToBytes(bitwidth)
+    if not hasattr(values, '__len__'):
+        values = list(values)
+    if _is_int_column(values):
+        buf = _pack_uints(values, bitwidth)
+    elif not _is_str_column(values):
+        enc = bind_encoder(kind, bitwidth)
+        buf = ''.join([enc(v) for v in values])
+    elif kind == MAC:
+        joined = ''.join(values)
+        if len(joined) != 17 * len(values):
+            raise Exception("Invalid MAC address in column")
+        buf = joined.replace(':', '').decode('hex')
+    elif kind == IPV4:
+        buf = ''.join([socket.inet_aton(v) for v in values])
+    elif kind == IPV6:
+        buf = ''.join([socket.inet_pton(socket.AF_INET6, v) for v in values])
+    elif kind == RAW or kind == UINT:
+        # Already encoded strings
+        buf = ''.join(values)
+    else:
+        raise Exception("Unknown encoder kind %r" % kind)
+    if len(buf) != byte_len * len(values):
+        raise Exception("Column values do not encode to %d bytes each"
+                        % byte_len)
+    return EncodedColumn(buf, byte_len)
+
+
+def decode_many(kind, column, bitwidth):
+    """
+    Decodes an EncodedColumn, or a byte string of packed bitwidth-bit values,
+    into a list of values of the given kind.
+    """
+    byte_len = bitwidthToBytes(bitwidth)
+    buf = column.buf if isinstance(column, EncodedColumn) else column
+    n = len(buf) // byte_len
+    if kind == UINT:
+        if byte_len > 8:
+            return [decodeNum(buf[o:o + byte_len])
+                    for o in xrange(0, len(buf), byte_len)]
+        if numpy is not None:
+            padded = numpy.zeros((n, 8), dtype=numpy.uint8)
+            padded[:, 8 - byte_len:] = numpy.frombuffer(
+                buf, dtype=numpy.uint8).reshape(n, byte_len)
+            return padded.view('>u8').ravel().tolist()
+        padded = bytearray(n * 8)
+        for k in xrange(byte_len):
+            padded[8 - byte_len + k::8] = buf[k::byte_len]
+        return list(struct.unpack('>%dQ' % n, str(padded)))
+    elif kind == MAC:
+        hex_buf = buf.encode('hex')
+        return [':'.join([hex_buf[o + i:o + i + 2] for i in xrange(0, 12, 2)])
+                for o in xrange(0, len(hex_buf), 12)]
+    elif kind == IPV4:
+        return [socket.inet_ntoa(buf[o:o + 4]) for o in xrange(0, len(buf), 4)]
+    elif kind == IPV6:
+        return [socket.inet_ntop(socket.AF_INET6, buf[o:o + 16])
+                for o in xrange(0, len(buf), 16)]
+    elif kind == RAW:
+        return [buf[o:o + byte_len] for o in xrange(0, len(buf), byte_len)]
+    raise Exception("Unknown encoder kind %r" % kind)
+
+
 def test():
     # TODO These tests should be moved out of main eventually
     mac = "aa:bb:cc:dd:ee:ff"
@@ -147,6 +415,41 @@ def test():
     assert (encode((num,), 5 * 8) == enc_num)
     assert (encode([num], 5 * 8) == enc_num)
 
+    assert (guess_encoder_kind('hdr.ipv6.dst_addr', 128) == IPV6)
+    assert (guess_encoder_kind('hdr.ethernet.dst_addr', 48) == MAC)
+    assert (guess_encoder_kind('hdr.ipv4.dst_addr', 32) == IPV4)
+    assert (guess_encoder_kind('port_num', 9) == UINT)
+    assert (bind_encoder(MAC, 48)(mac) == enc_mac)
+    assert (bind_encoder(MAC, 48)(enc_mac) == enc_mac)
+    assert (bind_encoder(MAC, 48)(0xaabbccddeeff) == enc_mac)
+    assert (bind_encoder(IPV4, 32)(ip) == enc_ip)
+    assert (bind_encoder(IPV6, 128)('1:2:3:4:5:6:7:8')
+            == encode('1:2:3:4:5:6:7:8', 128))
+    assert (bind_encoder(UINT, 5 * 8)(num) == enc_num)
+    assert (bind_encoder(UINT, 5 * 8)([num]) == enc_num)
+    assert (bind_encoder(RAW, 5 * 8)(enc_num) == enc_num)
+
+    assert (bind_decoder(MAC, 48)('\x01') == '00:00:00:00:00:01')
+    assert (bind_decoder(IPV4, 32)(enc_ip) == ip)
+    assert (bind_decoder(IPV6, 128)('\x01') == '::1')
+    assert (bind_decoder(UINT, 5 * 8)(enc_num) == num)
+    assert (bind_decoder(UINT, 5 * 8)('') == 0)
+
+    macs = [mac, "00:00:00:00:00:01"]
+    col = encode_many(MAC, macs, 48)
+    assert (len(col) == 2 and col[0] == enc_mac)
+    assert (col[1] == encodeMac(macs[1]))
+    assert (col.view(1).tobytes() == col[1])
+    assert (decode_many(MAC, col, 48) == macs)
+    nums = [0, 1, 255, 256, 511]
+    col = encode_many(UINT, nums, 9)
+    assert (list(col) == [encodeNum(x, 9) for x in nums])
+    assert (decode_many(UINT, col, 9) == nums)
+    assert (encode_many(UINT, [num], 5 * 8)[0] == enc_num)
+    assert (decode_many(IPV4, encode_many(IPV4, [ip], 32), 32) == [ip])
+    assert (decode_many(IPV6, encode_many(IPV6, ['1::2'], 128), 128)
+            == ['1::2'])
+
     num = 256
     try:
         encodeNum(num, 8)
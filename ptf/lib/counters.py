@@ -0,0 +1,297 @@
+#!/usr/bin/env python2
+
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Polls the direct counters of all tables (e.g. srv6_my_sid and
+# srv6_transit) and exports per-entry deltas and rates, e.g.:
+#     ./lib/counters.py --p4info /p4c-out/p4info.txt \
+#         --grpc-addr localhost:50001 --interval 1 --out counters.json
+# writes one JSON line per entry and poll to counters.json, rotated when it
+# exceeds --max-bytes. From Python, use DirectCounterPoller.
+#
+import argparse
+import json
+import logging
+import logging.handlers
+import threading
+import time
+
+import grpc
+from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
+
+from helper import P4InfoHelper
+from reader import P4RuntimeReader
+from state import table_entry_key
+
+logger = logging.getLogger("DirectCounterPoller")
+
+
+class CounterSample(object):
+    """
+    Counter values of a table entry at a poll, with the change since the
+    previous poll. Entries not seen at the previous poll, or whose counters
+    decreased (i.e. were reset), have deltas and rates computed from zero.
+    """
+    __slots__ = ("table_name", "match", "priority", "packets", "bytes",
+                 "delta_packets", "delta_bytes", "pps", "bps", "timestamp")
+
+    def __init__(self, table_name, match, priority, packets, bytes_,
+                 delta_packets, delta_bytes, seconds, timestamp):
+        self.table_name = table_name
+        self.match = match
+        self.priority = priority
+        self.packets = packets
+        self.bytes = bytes_
+        self.delta_packets = delta_packets
+        self.delta_bytes = delta_bytes
+        self.pps = delta_packets / seconds if seconds else 0.0
+        self.bps = delta_bytes * 8 / seconds if seconds else 0.0
+        self.timestamp = timestamp
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class PollStats(object):
+    """
+    Cost of the polls, to tune the interval: a poll taking longer than the
+    interval is counted in overruns.
+    """
+
+    def __init__(self):
+        self.polls = 0
+        self.entries = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+        self.overruns = 0
+
+    def avg_seconds(self):
+        return self.seconds / self.polls if self.polls else 0.0
+
+    def __str__(self):
+        return "%d polls, %d entries, avg %.3f s, max %.3f s, %d overruns" % (
+            self.polls, self.entries, self.avg_seconds(), self.max_seconds,
+            self.overruns)
+
+
+class DirectCounterPoller(object):
+    """
+    Periodically reads the direct counters of the given tables (default: all
+    tables with a direct counter in the P4Info) in a single Read call, and
+    computes per-entry deltas and rates from the previous snapshot. Samples
+    of the last poll are returned by latest(), passed to the subscribed
+    callbacks, and written as JSON lines to out_path, if given.
+    """
+
+    def __init__(self, stub, device_id, helper, table_names=None,
+                 interval=1.0, out_path=None, max_bytes=10 * 1024 * 1024,
+                 backup_count=5):
+        self.reader = P4RuntimeReader(stub, device_id, helper)
+        self.helper = helper
+        self.interval = interval
+        if table_names is None:
+            table_names = [helper.get_tables_name(c.direct_table_id)
+                           for c in helper.p4info.direct_counters]
+        self.table_names = table_names
+        self._entities = []
+        for table_name in table_names:
+            entity = p4runtime_pb2.Entity()
+            entity.direct_counter_entry.table_entry.table_id = \
+                helper.get_tables_id(table_name)
+            self._entities.append(entity)
+        # table entry key -> (packets, bytes)
+        self._snapshot = {}
+        self._snapshot_time = None
+        # table entry key -> (table name, decoded match, priority), decoded
+        # once per entry.
+        self._decoded = {}
+        self._latest = []
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self.stats = PollStats()
+        self._export = None
+        if out_path is not None:
+            handler = logging.handlers.RotatingFileHandler(
+                out_path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._export = logging.getLogger("DirectCounterPoller.%s"
+                                             % out_path)
+            self._export.propagate = False
+            self._export.setLevel(logging.INFO)
+            self._export.addHandler(handler)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _describe(self, key, table_entry):
+        described = self._decoded.get(key)
+        if described is None:
+            decoded = self.helper.decode(table_entry)
+            described = self._decoded[key] = (
+                decoded["table_name"], decoded["match_fields"],
+                table_entry.priority)
+        return described
+
+    def poll(self):
+        """
+        Reads all counters once. Returns the list of CounterSample.
+        """
+        start = time.time()
+        snapshot = {}
+        counter_entries = []
+        for entity in self.reader.read(self._entities):
+            counter_entry = entity.direct_counter_entry
+            key = table_entry_key(counter_entry.table_entry)
+            snapshot[key] = (counter_entry.data.packet_count,
+                             counter_entry.data.byte_count)
+            counter_entries.append((key, counter_entry.table_entry))
+        now = time.time()
+
+        previous = self._snapshot
+        seconds = now - self._snapshot_time if self._snapshot_time else 0
+        samples = []
+        for key, table_entry in counter_entries:
+            packets, bytes_ = snapshot[key]
+            prev_packets, prev_bytes = previous.get(key, (0, 0))
+            if packets < prev_packets or bytes_ < prev_bytes:
+                # Counter reset (e.g. entry modified or counter written).
+                prev_packets, prev_bytes = 0, 0
+            table_name, match, priority = self._describe(key, table_entry)
+            samples.append(CounterSample(
+                table_name, match, priority, packets, bytes_,
+                packets - prev_packets, bytes_ - prev_bytes, seconds, now))
+        for key in self._decoded.keys():
+            if key not in snapshot:
+                # Entry deleted since the previous poll.
+                del self._decoded[key]
+        self._snapshot = snapshot
+        self._snapshot_time = now
+
+        elapsed = time.time() - start
+        with self._lock:
+            self._latest = samples
+            stats = self.stats
+            stats.polls += 1
+            stats.entries += len(samples)
+            stats.seconds += elapsed
+            stats.last_seconds = elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+            if elapsed > self.interval:
+                stats.overruns += 1
+            callbacks = self._callbacks
+        if self._export is not None:
+            for sample in samples:
+                self._export.info(json.dumps(sample.to_dict(),
+                                             sort_keys=True))
+        for callback in callbacks:
+            callback(samples)
+        return samples
+
+    def latest(self):
+        """
+        Returns the samples of the last poll.
+        """
+        with self._lock:
+            return self._latest
+
+    def subscribe(self, callback):
+        """
+        Calls callback(samples) after each poll, from the polling thread.
+        """
+        with self._lock:
+            self._callbacks = self._callbacks + [callback]
+
+    def _run(self):
+        next_poll = time.time()
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except grpc.RpcError as e:
+                logger.warning("Failed to read counters: %s", e)
+            except Exception:
+                # Keep polling, e.g. after an error in a callback.
+                logger.exception("Failed to poll counters")
+            next_poll += self.interval
+            delay = next_poll - time.time()
+            if delay < 0:
+                # Skip the polls we're late for.
+                next_poll = time.time()
+                delay = 0
+            self._stop.wait(delay)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Poll direct counters and export deltas and rates")
+    parser.add_argument('--p4info',
+                        help='Location of p4info proto in text format',
+                        type=str, action="store", required=True)
+    parser.add_argument('--grpc-addr',
+                        help='Address to use to connect to P4 Runtime server',
+                        type=str, default='localhost:50051')
+    parser.add_argument('--device-id',
+                        help='Device id for device under test',
+                        type=int, default=1)
+    parser.add_argument('--table', dest='tables', action='append',
+                        help='Table to poll (default: all tables with a '
+                             'direct counter), can be repeated')
+    parser.add_argument('--interval',
+                        help='Seconds between polls',
+                        type=float, default=1.0)
+    parser.add_argument('--out',
+                        help='JSON lines file with the samples',
+                        type=str, required=True)
+    parser.add_argument('--max-bytes',
+                        help='Size at which the output file is rotated',
+                        type=int, default=10 * 1024 * 1024)
+    parser.add_argument('--backup-count',
+                        help='Number of rotated files kept',
+                        type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    channel = grpc.insecure_channel(args.grpc_addr)
+    stub = p4runtime_pb2_grpc.P4RuntimeStub(channel)
+    poller = DirectCounterPoller(
+        stub, args.device_id, P4InfoHelper(args.p4info),
+        table_names=args.tables, interval=args.interval, out_path=args.out,
+        max_bytes=args.max_bytes, backup_count=args.backup_count)
+    poller.start()
+    try:
+        while True:
+            time.sleep(10)
+            logger.info("%s", poller.stats)
+    except KeyboardInterrupt:
+        poller.stop()
+        logger.info("%s", poller.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python2
+
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Generates a Python module with constants for all P4Info ids and prebuilt
+# match/action builders, so that tests and tools can use them without any
+# lookup, e.g.:
+#     ./lib/gen_bindings.py --p4info /p4c-out/p4info.txt
+# writes /p4c-out/p4info_bindings.py. From Python, use load_bindings(), which
+# regenerates the module when the P4Info has changed, or the bindings
+# attribute of P4InfoHelper (e.g. self.helper.bindings in tests), which uses
+# the encoders set with the helper's set_encoder(). Importing a module
+# generated from a different P4Info raises StaleBindingsError.
+#
+import argparse
+import hashlib
+import imp
+import os
+import re
+import sys
+
+from p4.config.v1 import p4info_pb2
+
+from helper import load_p4info
+
+HEADER = """\
+# Generated by gen_bindings.py from %(p4info_path)s, DO NOT EDIT.
+%(regenerate)s
+from p4.v1 import p4runtime_pb2
+
+import gen_bindings
+from convert import bind_encoder
+
+P4INFO_PATH = %(p4info_path)r
+P4INFO_SHA256 = %(sha256)r
+
+gen_bindings.check_fresh(P4INFO_PATH, P4INFO_SHA256)
+"""
+
+
+class StaleBindingsError(Exception):
+    """
+    Raised when a bindings module does not match the P4Info it was generated
+    from.
+    """
+    pass
+
+
+def check_fresh(p4info_path, sha256):
+    if not os.path.exists(p4info_path):
+        raise StaleBindingsError(
+            "Cannot check P4Info bindings: %s not found" % p4info_path)
+    with open(p4info_path, "rb") as f:
+        actual = hashlib.sha256(f.read()).hexdigest()
+    if actual != sha256:
+        raise StaleBindingsError(
+            "P4Info bindings are stale: %s has changed since they were "
+            "generated, run gen_bindings.py again" % p4info_path)
+
+
+def bindings_path(p4info_path, encoder_kinds=None):
+    """
+    Returns the path of the bindings module for the given P4Info. Bindings
+    using encoders set with set_encoder() (encoder_kinds of a P4InfoIndex)
+    get their own module, named after a hash of the encoder kinds.
+    """
+    suffix = "_bindings"
+    if encoder_kinds:
+        suffix += "_" + hashlib.sha1(
+            repr(sorted(encoder_kinds.items()))).hexdigest()[:8]
+    return os.path.splitext(p4info_path)[0] + suffix + ".py"
+
+
+def identifier(*parts):
+    return "_".join(re.sub(r"\W", "_", p) for p in parts)
+
+
+def _alias(o):
+    return o.preamble.alias or o.preamble.name
+
+
+class _Writer(object):
+    def __init__(self):
+        self.lines = []
+        self.names = set()
+
+    def line(self, text=""):
+        self.lines.append(text)
+
+    def assign(self, name, expr):
+        name = name.upper()
+        if name in self.names:
+            raise Exception("Duplicate name %s in generated bindings" % name)
+        self.names.add(name)
+        self.line("%s = %s" % (name, expr))
+
+    def constant(self, name, value):
+        self.assign(name, repr(value))
+
+
+def _args(names):
+    args = []
+    for name in names:
+        arg = identifier(name).lower()
+        while arg in args:
+            arg += "_"
+        args.append(arg)
+    return args
+
+
+def _gen_table(w, table):
+    t_name = table.preamble.name
+    alias = identifier(_alias(table)).lower()
+    args = _args(mf.name for mf in table.match_fields)
+    w.line()
+    w.line()
+    w.line("def build_%s_match(%s):" % (alias, ", ".join(
+        "%s=None" % a for a in args)))
+    w.line('    """')
+    w.line("    Returns the FieldMatch messages of a %s entry." % t_name)
+    w.line('    """')
+    w.line("    match = []")
+    for mf, arg in zip(table.match_fields, args):
+        suffix = identifier(alias, mf.name).upper()
+        const = "MF_%s" % suffix
+        enc = "_ENC_MF_%s" % suffix
+        w.line("    if %s is not None:" % arg)
+        w.line("        m = p4runtime_pb2.FieldMatch(field_id=%s)" % const)
+        if mf.match_type == p4info_pb2.MatchField.EXACT:
+            w.line("        m.exact.value = %s(%s)" % (enc, arg))
+        elif mf.match_type == p4info_pb2.MatchField.LPM:
+            w.line("        m.lpm.value = %s(%s[0])" % (enc, arg))
+            w.line("        m.lpm.prefix_len = %s[1]" % arg)
+        elif mf.match_type == p4info_pb2.MatchField.TERNARY:
+            w.line("        m.ternary.value = %s(%s[0])" % (enc, arg))
+            w.line("        m.ternary.mask = %s(%s[1])" % (enc, arg))
+        elif mf.match_type == p4info_pb2.MatchField.RANGE:
+            w.line("        m.range.low = %s(%s[0])" % (enc, arg))
+            w.line("        m.range.high = %s(%s[1])" % (enc, arg))
+        else:
+            raise Exception("Unsupported match type with type %r"
+                            % mf.match_type)
+        w.line("        match.append(m)")
+    w.line("    return match")
+
+
+def _gen_action(w, action):
+    alias = identifier(_alias(action)).lower()
+    args = _args(p.name for p in action.params)
+    w.line()
+    w.line()
+    w.line("def build_%s_action(%s):" % (alias, ", ".join(args)))
+    w.line('    """')
+    w.line("    Returns the Action message of %s." % action.preamble.name)
+    w.line('    """')
+    w.line("    action = p4runtime_pb2.Action(action_id=ACTION_%s)"
+           % alias.upper())
+    for p, arg in zip(action.params, args):
+        suffix = identifier(alias, p.name).upper()
+        w.line("    p = action.params.add()")
+        w.line("    p.param_id = PARAM_%s" % suffix)
+        w.line("    p.value = _ENC_PARAM_%s(%s)" % (suffix, arg))
+    w.line("    return action")
+
+
+def generate(p4info_path, out_path, index=None):
+    """
+    Writes to out_path the bindings module for the given P4Info, with the
+    encoders of the given P4InfoIndex (default: load_p4info(p4info_path)).
+    """
+    if index is None:
+        index = load_p4info(p4info_path)
+    p4info = index.p4info
+    if index.encoder_kinds:
+        regenerate = ["# Regenerated by load_bindings(), with the encoders "
+                      "set with set_encoder():"]
+        for key, kind in sorted(index.encoder_kinds.items()):
+            regenerate.append("#     %s: %s" % ("/".join(key), kind))
+    else:
+        regenerate = ["# Regenerate with:",
+                      "#     gen_bindings.py --p4info %s --out %s"
+                      % (os.path.abspath(p4info_path),
+                         os.path.abspath(out_path))]
+    w = _Writer()
+    w.line(HEADER % {"p4info_path": os.path.abspath(p4info_path),
+                     "regenerate": "\n".join(regenerate),
+                     "sha256": index.sha256})
+
+    for entity_type in sorted(index.by_id.keys()):
+        entities = getattr(p4info, entity_type)
+        if not entities:
+            continue
+        kind = entity_type[:-1] if entity_type.endswith("s") else entity_type
+        w.line("# %s" % entity_type)
+        for o in entities:
+            w.constant(identifier(kind, _alias(o)), o.preamble.id)
+        w.line()
+
+    w.line("# match fields")
+    for t in p4info.tables:
+        for mf in t.match_fields:
+            w.constant(identifier("mf", _alias(t), mf.name), mf.id)
+    w.line()
+    w.line("# action params")
+    for a in p4info.actions:
+        for p in a.params:
+            w.constant(identifier("param", _alias(a), p.name), p.id)
+    w.line()
+    w.line("# controller packet metadata")
+    for c in p4info.controller_packet_metadata:
+        for m in c.metadata:
+            w.constant(identifier(c.preamble.name, m.name), m.id)
+    w.line()
+
+    w.line("# encoders")
+    for t in p4info.tables:
+        for mf in t.match_fields:
+            kind = index.get_encoder_kind(
+                "match_fields", t.preamble.name, mf.name)
+            w.assign(identifier("_enc_mf", _alias(t), mf.name),
+                     "bind_encoder(%r, %d)" % (kind, mf.bitwidth))
+    for a in p4info.actions:
+        for p in a.params:
+            kind = index.get_encoder_kind(
+                "action_params", a.preamble.name, p.name)
+            w.assign(identifier("_enc_param", _alias(a), p.name),
+                     "bind_encoder(%r, %d)" % (kind, p.bitwidth))
+
+    for t in p4info.tables:
+        _gen_table(w, t)
+    for a in p4info.actions:
+        _gen_action(w, a)
+
+    tmp_path = "%s.%d.tmp" % (out_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(w.lines) + "\n")
+    os.rename(tmp_path, out_path)
+
+
+def load_bindings(p4info_path, out_path=None, index=None):
+    """
+    Returns the bindings module for the given P4Info, (re)generating it when
+    missing or generated from a different P4Info. index is the P4InfoIndex
+    whose encoders the module uses, see generate().
+    """
+    if index is None:
+        index = load_p4info(p4info_path)
+    if out_path is None:
+        out_path = bindings_path(p4info_path, index.encoder_kinds)
+    sha256 = index.sha256
+    module_name = os.path.splitext(os.path.basename(out_path))[0]
+    module = sys.modules.get(module_name)
+    if module is not None and getattr(module, "P4INFO_SHA256", None) == sha256:
+        return module
+    if os.path.exists(out_path):
+        try:
+            return imp.load_source(module_name, out_path)
+        except StaleBindingsError:
+            pass
+    generate(p4info_path, out_path, index)
+    return imp.load_source(module_name, out_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a Python module of P4Info bindings")
+    parser.add_argument('--p4info',
+                        help='Location of p4info proto in text format',
+                        type=str, action="store", required=True)
+    parser.add_argument('--out',
+                        help='Location of the generated module '
+                             '(default: <p4info>_bindings.py)',
+                        type=str, action="store", required=False)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.p4info):
+        print "P4Info file {} not found".format(args.p4info)
+        sys.exit(1)
+    out_path = args.out or bindings_path(args.p4info)
+    generate(args.p4info, out_path)
+    print "Generated {}".format(out_path)
+
+
+if __name__ == '__main__':
+    main()
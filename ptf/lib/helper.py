@@ -12,13 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import copy
+import hashlib
+import logging
+import os
 import re
+import threading
+from itertools import islice, izip
 
 import google.protobuf.text_format
 from p4.config.v1 import p4info_pb2
 from p4.v1 import p4runtime_pb2
 
-from convert import encode
+from allocator import IdAllocator
+from convert import bitwidthToBytes, bind_decoder, bind_encoder, \
+    guess_encoder_kind
+
+logger = logging.getLogger("P4InfoHelper")
+
+# Binary P4Info caches are stored next to the text file, with this suffix.
+P4INFO_CACHE_SUFFIX = ".bin"
+
+# SHA-256 of the text P4Info -> P4InfoIndex, shared by all users in this
+# process.
+_p4info_indexes = {}
+_p4info_indexes_lock = threading.Lock()
 
 
 def get_match_field_value(match_field):
@@ -37,46 +55,763 @@ def get_match_field_value(match_field):
         raise Exception("Unsupported match type with type %r" % match_type)
 
 
-class P4InfoHelper(object):
-    def __init__(self, p4_info_filepath):
-        p4info = p4info_pb2.P4Info()
-        # Load the p4info file into a skeleton P4Info object
-        with open(p4_info_filepath) as p4info_f:
-            google.protobuf.text_format.Merge(p4info_f.read(), p4info)
-        self.p4info = p4info
-
-        self.next_mbr_id = 1
-        self.next_grp_id = 1
+class P4InfoIndex(object):
+    """
+    Lookup tables for a P4Info message, built once so that name/id
+    resolution is a dict access instead of a scan of the repeated fields.
+    """
 
-    def get_next_mbr_id(self):
-        mbr_id = self.next_mbr_id
-        self.next_mbr_id = self.next_mbr_id + 1
-        return mbr_id
+    def __init__(self, p4info, sha256=None):
+        self.p4info = p4info
+        # SHA-256 of the P4Info text file this index was loaded from, if any.
+        self.sha256 = sha256
+        # entity type (e.g. "tables") -> {name: entity} / {id: entity}
+        self.by_name = {}
+        self.by_id = {}
+        for field in p4info.DESCRIPTOR.fields:
+            if field.label != field.LABEL_REPEATED \
+                    or field.message_type is None \
+                    or "preamble" not in field.message_type.fields_by_name:
+                continue
+            names = self.by_name[field.name] = {}
+            ids = self.by_id[field.name] = {}
+            for o in getattr(p4info, field.name):
+                names[o.preamble.name] = o
+                ids[o.preamble.id] = o
+        # table name -> ({match field name: mf}, {match field id: mf})
+        self.match_fields = {}
+        for t in p4info.tables:
+            self.match_fields[t.preamble.name] = (
+                {mf.name: mf for mf in t.match_fields},
+                {mf.id: mf for mf in t.match_fields})
+        # action name -> ({param name: param}, {param id: param})
+        self.action_params = {}
+        for a in p4info.actions:
+            self.action_params[a.preamble.name] = (
+                {p.name: p for p in a.params},
+                {p.id: p for p in a.params})
+        # controller header name -> ({meta name: meta}, {meta id: meta})
+        self.packet_metadata = {}
+        for c in p4info.controller_packet_metadata:
+            self.packet_metadata[c.preamble.name] = (
+                {m.name: m for m in c.metadata},
+                {m.id: m for m in c.metadata})
+        # (scope, scope name, name) -> kind / bound encoder / bound decoder,
+        # see get_encoder_kind()
+        self.encoder_kinds = {}
+        self.encoders = {}
+        self.decoders = {}
 
-    def get_next_grp_id(self):
-        grp_id = self.next_grp_id
-        self.next_grp_id = self.next_grp_id + 1
-        return grp_id
+    def view(self):
+        """
+        Returns an index sharing the P4Info lookups of this one, with its own
+        encoders: set_encoder() on the view doesn't affect other users of
+        the P4Info.
+        """
+        index = copy.copy(self)
+        index.encoder_kinds = {}
+        index.encoders = {}
+        index.decoders = {}
+        return index
 
     def get(self, entity_type, name=None, id=None):
         if name is not None and id is not None:
             raise AssertionError("name or id must be None")
+        if entity_type not in self.by_name:
+            raise AttributeError("P4Info has no entities of type %r"
+                                 % entity_type)
+        if name:
+            o = self.by_name[entity_type].get(name)
+            if o is None:
+                raise AttributeError("Could not find %r of type %s"
+                                     % (name, entity_type))
+        else:
+            o = self.by_id[entity_type].get(id)
+            if o is None:
+                raise AttributeError("Could not find id %r of type %s"
+                                     % (id, entity_type))
+        return o
 
-        for o in getattr(self.p4info, entity_type):
-            pre = o.preamble
-            if name:
-                if pre.name == name:
-                    return o
-            else:
-                if pre.id == id:
-                    return o
+    def get_match_field(self, table_name, name=None, id=None):
+        if table_name not in self.match_fields:
+            raise AttributeError("No such table %r in P4Info" % table_name)
+        by_name, by_id = self.match_fields[table_name]
+        mf = by_name.get(name) if name is not None else by_id.get(id)
+        if mf is None:
+            raise AttributeError(
+                "%r has no match field %r (check your P4Info)"
+                % (table_name, name if name is not None else id))
+        return mf
 
-        if name:
-            raise AttributeError("Could not find %r of type %s"
-                                 % (name, entity_type))
+    def get_action_param(self, action_name, name=None, id=None):
+        by_name, by_id = self.action_params.get(action_name, ({}, {}))
+        p = by_name.get(name) if name is not None else by_id.get(id)
+        if p is None:
+            raise AttributeError(
+                "Action %r has no param %r (check your P4Info)"
+                % (action_name, name if name is not None else id))
+        return p
+
+    def get_packet_metadata(self, meta_type, name=None, id=None):
+        by_name, by_id = self.packet_metadata.get(meta_type, ({}, {}))
+        m = by_name.get(name) if name is not None else by_id.get(id)
+        if m is None:
+            raise AttributeError(
+                "ControllerPacketMetadata %r has no metadata %r "
+                "(check your P4Info)"
+                % (meta_type, name if name is not None else id))
+        return m
+
+    def get_encoder_kind(self, scope, scope_name, name):
+        """
+        Returns the encoder kind (see convert.bind_encoder) of a match field
+        ("match_fields" scope, scope_name is the table name), an action param
+        ("action_params", action name) or a packet metadata
+        ("packet_metadata", controller header name). Unless set with
+        set_encoder(), the kind is guessed from the P4Info name and bitwidth.
+        """
+        kind = self.encoder_kinds.get((scope, scope_name, name))
+        if kind is None:
+            obj = self._get_encoded_object(scope, scope_name, name)
+            kind = guess_encoder_kind(obj.name, obj.bitwidth)
+        return kind
+
+    def get_encoder(self, scope, scope_name, name):
+        """
+        Returns the encoder bound to a match field, action param or packet
+        metadata, see get_encoder_kind().
+        """
+        key = (scope, scope_name, name)
+        enc = self.encoders.get(key)
+        if enc is None:
+            obj = self._get_encoded_object(scope, scope_name, name)
+            enc = bind_encoder(self.get_encoder_kind(scope, scope_name, name),
+                               obj.bitwidth)
+            self.encoders[key] = enc
+        return enc
+
+    def get_decoder(self, scope, scope_name, name):
+        """
+        Returns the decoder matching get_encoder().
+        """
+        key = (scope, scope_name, name)
+        dec = self.decoders.get(key)
+        if dec is None:
+            obj = self._get_encoded_object(scope, scope_name, name)
+            dec = bind_decoder(self.get_encoder_kind(scope, scope_name, name),
+                               obj.bitwidth)
+            self.decoders[key] = dec
+        return dec
+
+    def set_encoder(self, scope, scope_name, name, kind):
+        """
+        Binds an encoder (and decoder) of the given kind to a match field,
+        action param or packet metadata. Use P4InfoHelper.set_encoder, which
+        also drops the entry plans and decoders built with the previous
+        encoder.
+        """
+        key = (scope, scope_name, name)
+        obj = self._get_encoded_object(scope, scope_name, name)
+        self.encoders[key] = bind_encoder(kind, obj.bitwidth)
+        self.decoders.pop(key, None)
+        self.encoder_kinds[key] = kind
+
+    def _get_encoded_object(self, scope, scope_name, name):
+        if scope == "match_fields":
+            return self.get_match_field(scope_name, name=name)
+        elif scope == "action_params":
+            return self.get_action_param(scope_name, name=name)
+        elif scope == "packet_metadata":
+            return self.get_packet_metadata(scope_name, name=name)
+        raise Exception("Unknown encoder scope %r" % scope)
+
+
+def _parse_p4info(p4info_path, text, sha256):
+    """
+    Parses the given P4Info text, going through the binary cache next to
+    p4info_path when the cache was written for the same file content.
+    """
+    p4info = p4info_pb2.P4Info()
+    cache_path = p4info_path + P4INFO_CACHE_SUFFIX
+    try:
+        with open(cache_path, "rb") as cache_f:
+            if cache_f.readline().strip() == sha256:
+                p4info.ParseFromString(cache_f.read())
+                return p4info
+    except IOError:
+        pass
+    google.protobuf.text_format.Merge(text, p4info)
+    # Write to a temporary file first so that concurrent readers never see a
+    # partially written cache.
+    tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as cache_f:
+            cache_f.write(sha256 + "\n")
+            cache_f.write(p4info.SerializeToString())
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as e:
+        logger.debug("Unable to write P4Info cache %s: %s", cache_path, e)
+    return p4info
+
+
+def load_p4info(p4info_path):
+    """
+    Returns the P4InfoIndex for the given P4Info text file. The P4Info is
+    parsed at most once per process for a given file content, all callers
+    share the same (read-only) P4Info message.
+    """
+    with open(p4info_path, "rb") as p4info_f:
+        text = p4info_f.read()
+    sha256 = hashlib.sha256(text).hexdigest()
+    with _p4info_indexes_lock:
+        index = _p4info_indexes.get(sha256)
+        if index is None:
+            index = P4InfoIndex(_parse_p4info(p4info_path, text, sha256),
+                                sha256=sha256)
+            _p4info_indexes[sha256] = index
+    return index
+
+
+def _match_setter(field_id, match_type, enc):
+    """
+    Returns a function that appends to a TableEntry the FieldMatch for the
+    given field, encoding the row value with enc.
+    """
+    if match_type == p4info_pb2.MatchField.EXACT:
+        def set_match(entry, value):
+            m = entry.match.add()
+            m.field_id = field_id
+            m.exact.value = enc(value)
+    elif match_type == p4info_pb2.MatchField.LPM:
+        def set_match(entry, value):
+            m = entry.match.add()
+            m.field_id = field_id
+            m.lpm.value = enc(value[0])
+            m.lpm.prefix_len = value[1]
+    elif match_type == p4info_pb2.MatchField.TERNARY:
+        def set_match(entry, value):
+            # None is a don't care match, which P4Runtime omits.
+            if value is None:
+                return
+            m = entry.match.add()
+            m.field_id = field_id
+            m.ternary.value = enc(value[0])
+            m.ternary.mask = enc(value[1])
+    elif match_type == p4info_pb2.MatchField.RANGE:
+        def set_match(entry, value):
+            if value is None:
+                return
+            m = entry.match.add()
+            m.field_id = field_id
+            m.range.low = enc(value[0])
+            m.range.high = enc(value[1])
+    else:
+        raise Exception("Unsupported match type with type %r" % match_type)
+    return set_match
+
+
+class TableEntryPlan(object):
+    """
+    Precompiled recipe to build TableEntry messages for a given table and
+    action. P4Info ids, byte widths, match kinds and encoders are resolved
+    once, rows are then turned into entries without any lookup.
+
+    A row is a sequence with one value per match field (same format as the
+    values of build_table_entry's match_fields), followed by one value per
+    action param. When action_name is None, the table must be implemented by
+    an action profile and the match values are followed by a group id.
+    """
+
+    def __init__(self, index, table_name, action_name=None,
+                 match_fields=None, action_params=None, priority=None):
+        table = index.get("tables", name=table_name)
+        self.table_id = table.preamble.id
+        self.action_id = None
+        self.priority = priority
+        if match_fields is None:
+            match_fields = [mf.name for mf in table.match_fields]
+        # (name, id, byte width, match type) for each match field
+        self.match_fields = []
+        self._match_setters = []
+        for name in match_fields:
+            mf = index.get_match_field(table_name, name=name)
+            self.match_fields.append(
+                (mf.name, mf.id, bitwidthToBytes(mf.bitwidth), mf.match_type))
+            self._match_setters.append(_match_setter(
+                mf.id, mf.match_type,
+                index.get_encoder("match_fields", table_name, mf.name)))
+        # (name, id, byte width) for each action param
+        self.action_params = []
+        self._param_encoders = []
+        if action_name is not None:
+            action = index.get("actions", name=action_name)
+            self.action_id = action.preamble.id
+            if action_params is None:
+                action_params = [p.name for p in action.params]
+            for name in action_params:
+                p = index.get_action_param(action_name, name=name)
+                self.action_params.append(
+                    (p.name, p.id, bitwidthToBytes(p.bitwidth)))
+                self._param_encoders.append(
+                    (p.id, index.get_encoder("action_params", action_name,
+                                             p.name)))
+            self.row_len = len(self.match_fields) + len(self.action_params)
         else:
-            raise AttributeError("Could not find id %r of type %s"
-                                 % (id, entity_type))
+            if not table.implementation_id:
+                raise Exception("Table %r is not implemented by an action "
+                                "profile, an action is required" % table_name)
+            self.row_len = len(self.match_fields) + 1
+
+    def build(self, row):
+        if len(row) != self.row_len:
+            raise Exception("Expected %d values per row, got %d: %r"
+                            % (self.row_len, len(row), row))
+        entry = p4runtime_pb2.TableEntry()
+        entry.table_id = self.table_id
+        if self.priority is not None:
+            entry.priority = self.priority
+        for set_match, value in izip(self._match_setters, row):
+            set_match(entry, value)
+        n_match = len(self._match_setters)
+        if self.action_id is None:
+            entry.action.action_profile_group_id = row[n_match]
+            return entry
+        action = entry.action.action
+        action.action_id = self.action_id
+        for (param_id, enc), value in izip(self._param_encoders,
+                                           islice(row, n_match, None)):
+            param = action.params.add()
+            param.param_id = param_id
+            param.value = enc(value)
+        return entry
+
+    def build_many(self, rows):
+        """
+        Generator of TableEntry messages, one per row, so that arbitrarily
+        large iterables of rows can be streamed without holding all entries.
+        """
+        build = self.build
+        for row in rows:
+            yield build(row)
+
+
+def _match_getter(match_type, dec):
+    """
+    Returns a function extracting and decoding the value of a FieldMatch of
+    the given type, in the format accepted by build_table_entry.
+    """
+    if match_type == p4info_pb2.MatchField.EXACT:
+        return lambda m: dec(m.exact.value)
+    elif match_type == p4info_pb2.MatchField.LPM:
+        return lambda m: (dec(m.lpm.value), m.lpm.prefix_len)
+    elif match_type == p4info_pb2.MatchField.TERNARY:
+        return lambda m: (dec(m.ternary.value), dec(m.ternary.mask))
+    elif match_type == p4info_pb2.MatchField.RANGE:
+        return lambda m: (dec(m.range.low), dec(m.range.high))
+    raise Exception("Unsupported match type with type %r" % match_type)
+
+
+def _by_id(items):
+    """
+    Returns a list with the values of the given (id, value) pairs at their
+    id, for ids numbered from 1 as assigned by p4c, or a dict otherwise.
+    """
+    items = list(items)
+    max_id = max([i for i, _ in items] or [0])
+    if max_id > 4 * len(items) + 1:
+        return dict(items)
+    by_id = [None] * (max_id + 1)
+    for i, value in items:
+        by_id[i] = value
+    return by_id
+
+
+class P4RuntimeDecoder(object):
+    """
+    Turns P4Runtime messages into dicts of P4Info names and decoded values
+    (see P4InfoIndex.get_decoder). The decoders for a given table, action or
+    controller header are built the first time its id is seen.
+
+    Decoded table entries and action profile members use the keyword
+    arguments of build_table_entry and build_act_prof_member as keys.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        # table id -> function decoding a TableEntry
+        self._tables = {}
+        # action id -> function decoding an Action
+        self._actions = {}
+        # action profile id -> name
+        self._act_profs = {}
+        # controller header name -> {metadata id: (name, decoder)}
+        self._packet_metadata = {}
+        self._dispatch = {
+            p4runtime_pb2.TableEntry: self.decode_table_entry,
+            p4runtime_pb2.Action: self.decode_action,
+            p4runtime_pb2.ActionProfileMember: self.decode_act_prof_member,
+            p4runtime_pb2.ActionProfileGroup: self.decode_act_prof_group,
+            p4runtime_pb2.PacketIn: self.decode_packet_in,
+            p4runtime_pb2.PacketOut: self.decode_packet_out,
+            p4runtime_pb2.DirectCounterEntry: self.decode_direct_counter,
+            p4runtime_pb2.PacketReplicationEngineEntry: self.decode_pre_entry,
+        }
+
+    def clear(self):
+        """
+        Drops the decoders built so far, e.g. after an encoder change.
+        """
+        self._tables = {}
+        self._actions = {}
+        self._act_profs = {}
+        self._packet_metadata = {}
+
+    def decode(self, msg):
+        decode = self._dispatch.get(type(msg))
+        if decode is None:
+            raise Exception("Decoding %r messages is not supported"
+                            % type(msg))
+        return decode(msg)
+
+    def _compile_table(self, table_id):
+        # Returns a function decoding the entries of the given table, with
+        # the field names and getters bound by field id.
+        table = self.index.get("tables", id=table_id)
+        table_name = table.preamble.name
+        fields = _by_id((mf.id, (mf.name, _match_getter(
+            mf.match_type,
+            self.index.get_decoder("match_fields", table_name, mf.name))))
+            for mf in table.match_fields)
+        decode_action = self.decode_action
+
+        def decode(entry):
+            match = {}
+            for m in entry.match:
+                name, getter = fields[m.field_id]
+                match[name] = getter(m)
+            decoded = {"table_name": table_name, "match_fields": match}
+            if entry.priority:
+                decoded["priority"] = entry.priority
+            if entry.is_default_action:
+                decoded["default_action"] = True
+            table_action = entry.action
+            action_type = table_action.WhichOneof("type")
+            if action_type == "action":
+                decoded.update(decode_action(table_action.action))
+            elif action_type == "action_profile_member_id":
+                decoded["member_id"] = table_action.action_profile_member_id
+            elif action_type == "action_profile_group_id":
+                decoded["group_id"] = table_action.action_profile_group_id
+            return decoded
+        return decode
+
+    def _compile_action(self, action_id):
+        # Same as _compile_table, for the actions.
+        action = self.index.get("actions", id=action_id)
+        action_name = action.preamble.name
+        params = _by_id((p.id, (p.name, self.index.get_decoder(
+            "action_params", action_name, p.name))) for p in action.params)
+
+        def decode(action):
+            decoded_params = {}
+            for p in action.params:
+                name, dec = params[p.param_id]
+                decoded_params[name] = dec(p.value)
+            return {"action_name": action_name,
+                    "action_params": decoded_params}
+        return decode
+
+    def _act_prof_name(self, act_prof_id):
+        name = self._act_profs.get(act_prof_id)
+        if name is None:
+            name = self.index.get("action_profiles", id=act_prof_id) \
+                .preamble.name
+            self._act_profs[act_prof_id] = name
+        return name
+
+    def _metadata(self, meta_type):
+        metadata = self._packet_metadata.get(meta_type)
+        if metadata is None:
+            metadata = {}
+            by_name, _ = self.index.packet_metadata.get(meta_type, ({}, {}))
+            for m in by_name.itervalues():
+                metadata[m.id] = (m.name, self.index.get_decoder(
+                    "packet_metadata", meta_type, m.name))
+            self._packet_metadata[meta_type] = metadata
+        return metadata
+
+    def decode_table_entry(self, entry):
+        table_id = entry.table_id
+        decode = self._tables.get(table_id)
+        if decode is None:
+            decode = self._tables[table_id] = self._compile_table(table_id)
+        return decode(entry)
+
+    def decode_action(self, action):
+        action_id = action.action_id
+        decode = self._actions.get(action_id)
+        if decode is None:
+            decode = self._actions[action_id] = self._compile_action(
+                action_id)
+        return decode(action)
+
+    def decode_act_prof_member(self, member):
+        decoded = {
+            "act_prof_name": self._act_prof_name(member.action_profile_id),
+            "member_id": member.member_id,
+        }
+        decoded.update(self.decode_action(member.action))
+        return decoded
+
+    def decode_act_prof_group(self, group):
+        return {
+            "act_prof_name": self._act_prof_name(group.action_profile_id),
+            "group_id": group.group_id,
+            "members": [(m.member_id, m.weight) for m in group.members],
+            "max_size": group.max_size,
+        }
+
+    def decode_direct_counter(self, counter_entry):
+        return {
+            "table_entry": self.decode_table_entry(counter_entry.table_entry),
+            "byte_count": counter_entry.data.byte_count,
+            "packet_count": counter_entry.data.packet_count,
+        }
+
+    def decode_pre_entry(self, pre_entry):
+        pre_type = pre_entry.WhichOneof("type")
+        entry = getattr(pre_entry, pre_type)
+        decoded = {"replicas": [(r.egress_port, r.instance)
+                                for r in entry.replicas]}
+        if pre_type == "multicast_group_entry":
+            decoded["multicast_group_id"] = entry.multicast_group_id
+        else:
+            decoded["session_id"] = entry.session_id
+            decoded["class_of_service"] = entry.class_of_service
+            decoded["packet_length_bytes"] = entry.packet_length_bytes
+        return decoded
+
+    def _decode_packet(self, packet, meta_type):
+        metadata = self._metadata(meta_type)
+        decoded_meta = {}
+        for m in packet.metadata:
+            name, dec = metadata[m.metadata_id]
+            decoded_meta[name] = dec(m.value)
+        return {"payload": packet.payload, "metadata": decoded_meta}
+
+    def decode_packet_in(self, packet_in):
+        return self._decode_packet(packet_in, "packet_in")
+
+    def decode_packet_out(self, packet_out):
+        return self._decode_packet(packet_out, "packet_out")
+
+
+class ActionProfileMemberPool(object):
+    """
+    Action profile members shared by groups. Members are identified by their
+    content (action profile, action and encoded params), groups using the
+    same action get the same member id. An action listed n times in a group
+    uses n members (the first n copies of the action), unless merging is
+    asked, in which case it uses one member of weight n. Members are
+    refcounted by the groups using them, and messages are built only for
+    members that must be inserted or deleted on the switch. The ids of the
+    members to delete are given back to helper.mbr_ids right away, so the
+    deletes must be written before inserting members built afterwards.
+    """
+
+    def __init__(self, helper):
+        self.helper = helper
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all members and groups, e.g. once they have been deleted from
+        the switch.
+        """
+        # (act prof id, action id, sorted encoded params, copy)
+        #   -> [member id, refs]
+        self._members = {}
+        # member id -> content key
+        self._keys = {}
+        # (act prof id, group id) -> {member id: weight}
+        self._groups = {}
+        # (act prof id, group id) of the groups with an allocated id
+        self._allocated_groups = set()
+
+    def __len__(self):
+        return len(self._members)
+
+    def acquire(self, act_prof_name, action_name, action_params=None, copy=0):
+        """
+        Takes a reference to the member with the given action (and copy
+        number, for actions listed more than once in a group). Returns the
+        member id and the ActionProfileMember to insert, or None if the member
+        is already in use.
+        """
+        act_prof_id = self.helper.get_id("action_profiles", act_prof_name)
+        action = self.helper.build_action(action_name, action_params)
+        key = (act_prof_id, action.action_id,
+               tuple(sorted((p.param_id, p.value) for p in action.params)),
+               copy)
+        refs = self._members.get(key)
+        if refs is not None:
+            refs[1] += 1
+            return refs[0], None
+        member = p4runtime_pb2.ActionProfileMember()
+        member.action_profile_id = act_prof_id
+        member.member_id = self.helper.get_next_mbr_id()
+        member.action.CopyFrom(action)
+        self._members[key] = [member.member_id, 1]
+        self._keys[member.member_id] = key
+        return member.member_id, member
+
+    def release(self, member_id):
+        """
+        Drops a reference to the given member. Returns the
+        ActionProfileMember to delete when the member is not used anymore,
+        None otherwise. The id of a member to delete is released.
+        """
+        key = self._keys[member_id]
+        refs = self._members[key]
+        refs[1] -= 1
+        if refs[1] > 0:
+            return None
+        del self._members[key]
+        del self._keys[member_id]
+        self.helper.mbr_ids.release(member_id)
+        member = p4runtime_pb2.ActionProfileMember()
+        member.action_profile_id = key[0]
+        member.member_id = member_id
+        return member
+
+    def _acquire_all(self, act_prof_name, actions, merge):
+        # Same action listed more than once -> one member per copy, or with
+        # merge, one member with higher weight.
+        weights = {}
+        inserts = []
+        for action in actions:
+            action_params = action[1] if len(action) > 1 else None
+            copy = 0
+            while True:
+                member_id, member = self.acquire(
+                    act_prof_name, action[0], action_params, copy)
+                if merge or member_id not in weights:
+                    break
+                # Already in this group, try the next copy.
+                self.release(member_id)
+                copy += 1
+            if member_id in weights:
+                weights[member_id] += 1
+                self.release(member_id)
+            else:
+                weights[member_id] = 1
+            if member is not None:
+                inserts.append(member)
+        return weights, inserts
+
+    def _build_group(self, act_prof_id, group_id, weights):
+        group = p4runtime_pb2.ActionProfileGroup()
+        group.action_profile_id = act_prof_id
+        group.group_id = group_id
+        for member_id in sorted(weights):
+            group_member = group.members.add()
+            group_member.member_id = member_id
+            group_member.weight = weights[member_id]
+        return group
+
+    def build_group(self, act_prof_name, group_id, actions=(), merge=False):
+        """
+        Same as P4InfoHelper.build_act_prof_group, but returns only the
+        members that do not exist yet, followed by the group. With merge,
+        actions listed more than once use a single member with a higher
+        weight. If group_id is None, the group id is taken from
+        helper.grp_ids, and released by delete_group().
+        """
+        act_prof_id = self.helper.get_id("action_profiles", act_prof_name)
+        if group_id is None:
+            group_id = self.helper.get_next_grp_id()
+            self._allocated_groups.add((act_prof_id, group_id))
+        if (act_prof_id, group_id) in self._groups:
+            raise Exception("Group %d of %r already exists, use "
+                            "build_group_delta to modify it"
+                            % (group_id, act_prof_name))
+        weights, inserts = self._acquire_all(act_prof_name, actions, merge)
+        self._groups[(act_prof_id, group_id)] = weights
+        return inserts + [self._build_group(act_prof_id, group_id, weights)]
+
+    def build_group_delta(self, act_prof_name, group_id, actions=(),
+                          merge=False):
+        """
+        Changes the actions of an existing group. Returns a tuple with the
+        members to insert, the group to modify and the members to delete
+        afterwards, in this order. merge is the same as for build_group.
+        """
+        act_prof_id = self.helper.get_id("action_profiles", act_prof_name)
+        old_weights = self._groups[(act_prof_id, group_id)]
+        # Acquire before releasing so that members in both the old and the
+        # new group are never deleted.
+        weights, inserts = self._acquire_all(act_prof_name, actions, merge)
+        deletes = [m for m in (self.release(member_id)
+                               for member_id in old_weights)
+                   if m is not None]
+        self._groups[(act_prof_id, group_id)] = weights
+        return inserts, self._build_group(act_prof_id, group_id,
+                                          weights), deletes
+
+    def delete_group(self, act_prof_name, group_id):
+        """
+        Returns the group to delete, followed by the members to delete
+        afterwards. Allocated ids are released, see build_group().
+        """
+        act_prof_id = self.helper.get_id("action_profiles", act_prof_name)
+        weights = self._groups.pop((act_prof_id, group_id))
+        if (act_prof_id, group_id) in self._allocated_groups:
+            self._allocated_groups.discard((act_prof_id, group_id))
+            self.helper.grp_ids.release(group_id)
+        group = p4runtime_pb2.ActionProfileGroup()
+        group.action_profile_id = act_prof_id
+        group.group_id = group_id
+        return [group] + [m for m in (self.release(member_id)
+                                      for member_id in weights)
+                          if m is not None]
+
+
+class P4InfoHelper(object):
+    def __init__(self, p4_info_filepath):
+        self.p4_info_filepath = p4_info_filepath
+        # Encoders set with set_encoder() are private to this helper.
+        self.index = load_p4info(p4_info_filepath).view()
+        self._bindings = None
+        self.p4info = self.index.p4info
+
+        # Safe to use from multiple threads, see IdAllocator.
+        self.mbr_ids = IdAllocator()
+        self.grp_ids = IdAllocator()
+
+        # (table, action, match fields, params, priority) -> TableEntryPlan
+        self._plans = {}
+        self.decoder = P4RuntimeDecoder(self.index)
+        # Members of groups built with build_act_prof_group(..., reuse=True)
+        self.member_pool = ActionProfileMemberPool(self)
+
+    def set_encoder(self, scope, scope_name, name, kind):
+        """
+        Binds an encoder of the given kind to a match field, action param or
+        packet metadata of this helper, see P4InfoIndex.get_encoder_kind.
+        """
+        self.index.set_encoder(scope, scope_name, name, kind)
+        self._plans = {}
+        self._bindings = None
+        self.decoder.clear()
+
+    def get_next_mbr_id(self):
+        return self.mbr_ids.allocate()
+
+    def get_next_grp_id(self):
+        return self.grp_ids.allocate()
+
+    def get(self, entity_type, name=None, id=None):
+        return self.index.get(entity_type, name=name, id=id)
 
     def get_id(self, entity_type, name):
         return self.get(entity_type, name=name).preamble.id
@@ -84,57 +819,52 @@ class P4InfoHelper(object):
     def get_name(self, entity_type, id):
         return self.get(entity_type, id=id).preamble.name
 
+    @property
+    def bindings(self):
+        """
+        The generated bindings module of this P4Info (see gen_bindings.py),
+        with constants for all ids and prebuilt match/action builders that
+        use the encoders of this helper. Generated next to the P4Info on
+        first use.
+        """
+        if self._bindings is None:
+            # gen_bindings imports this module.
+            from gen_bindings import load_bindings
+            self._bindings = load_bindings(self.p4_info_filepath,
+                                           index=self.index)
+        return self._bindings
+
     def __getattr__(self, attr):
         # Synthesize convenience functions for name to id lookups for top-level
         # entities e.g. get_tables_id(name_string) or
         # get_actions_id(name_string)
+        # The functions are cached on the instance, so this runs once per
+        # attribute name.
         m = re.search(r"^get_(\w+)_id$", attr)
         if m:
             primitive = m.group(1)
-            return lambda name: self.get_id(primitive, name)
+            f = lambda name: self.get_id(primitive, name)
+            setattr(self, attr, f)
+            return f
 
         # Synthesize convenience functions for id to name lookups
         # e.g. get_tables_name(id) or get_actions_name(id)
         m = re.search(r"^get_(\w+)_name$", attr)
         if m:
             primitive = m.group(1)
-            return lambda x: self.get_name(primitive, x)
+            f = lambda x: self.get_name(primitive, x)
+            setattr(self, attr, f)
+            return f
 
         raise AttributeError(
             "%r object has no attribute %r (check your P4Info)"
             % (self.__class__, attr))
 
     def get_match_field(self, table_name, name=None, id=None):
-        t = None
-        for t in self.p4info.tables:
-            if t.preamble.name == table_name:
-                break
-        if not t:
-            raise AttributeError("No such table %r in P4Info" % table_name)
-        for mf in t.match_fields:
-            if name is not None:
-                if mf.name == name:
-                    return mf
-            elif id is not None:
-                if mf.id == id:
-                    return mf
-        raise AttributeError("%r has no match field %r (check your P4Info)"
-                             % (table_name, name if name is not None else id))
+        return self.index.get_match_field(table_name, name=name, id=id)
 
     def get_packet_metadata(self, meta_type, name=None, id=None):
-        for t in self.p4info.controller_packet_metadata:
-            pre = t.preamble
-            if pre.name == meta_type:
-                for m in t.metadata:
-                    if name is not None:
-                        if m.name == name:
-                            return m
-                    elif id is not None:
-                        if m.id == id:
-                            return m
-        raise AttributeError(
-            "ControllerPacketMetadata %r has no metadata %r (check your P4Info)"
-            % (meta_type, name if name is not None else id))
+        return self.index.get_packet_metadata(meta_type, name=name, id=id)
 
     def get_match_field_id(self, table_name, match_field_name):
         return self.get_match_field(table_name, name=match_field_name).id
@@ -142,45 +872,37 @@ class P4InfoHelper(object):
     def get_match_field_name(self, table_name, match_field_id):
         return self.get_match_field(table_name, id=match_field_id).name
 
+    def decode(self, msg):
+        return self.decoder.decode(msg)
+
     def get_match_field_pb(self, table_name, match_field_name, value):
         p4info_match = self.get_match_field(table_name, match_field_name)
-        bitwidth = p4info_match.bitwidth
+        enc = self.index.get_encoder(
+            "match_fields", table_name, match_field_name)
         p4runtime_match = p4runtime_pb2.FieldMatch()
         p4runtime_match.field_id = p4info_match.id
         match_type = p4info_match.match_type
         if match_type == p4info_pb2.MatchField.EXACT:
             exact = p4runtime_match.exact
-            exact.value = encode(value, bitwidth)
+            exact.value = enc(value)
         elif match_type == p4info_pb2.MatchField.LPM:
             lpm = p4runtime_match.lpm
-            lpm.value = encode(value[0], bitwidth)
+            lpm.value = enc(value[0])
             lpm.prefix_len = value[1]
         elif match_type == p4info_pb2.MatchField.TERNARY:
             lpm = p4runtime_match.ternary
-            lpm.value = encode(value[0], bitwidth)
-            lpm.mask = encode(value[1], bitwidth)
+            lpm.value = enc(value[0])
+            lpm.mask = enc(value[1])
         elif match_type == p4info_pb2.MatchField.RANGE:
             lpm = p4runtime_match.range
-            lpm.low = encode(value[0], bitwidth)
-            lpm.high = encode(value[1], bitwidth)
+            lpm.low = enc(value[0])
+            lpm.high = enc(value[1])
         else:
             raise Exception("Unsupported match type with type %r" % match_type)
         return p4runtime_match
 
     def get_action_param(self, action_name, name=None, id=None):
-        for a in self.p4info.actions:
-            pre = a.preamble
-            if pre.name == action_name:
-                for p in a.params:
-                    if name is not None:
-                        if p.name == name:
-                            return p
-                    elif id is not None:
-                        if p.id == id:
-                            return p
-        raise AttributeError(
-            "Action %r has no param %r (check your P4Info)"
-            % (action_name, name if name is not None else id))
+        return self.index.get_action_param(action_name, name=name, id=id)
 
     def get_action_param_id(self, action_name, param_name):
         return self.get_action_param(action_name, name=param_name).id
@@ -192,7 +914,8 @@ class P4InfoHelper(object):
         p4info_param = self.get_action_param(action_name, param_name)
         p4runtime_param = p4runtime_pb2.Action.Param()
         p4runtime_param.param_id = p4info_param.id
-        p4runtime_param.value = encode(value, p4info_param.bitwidth)
+        p4runtime_param.value = self.index.get_encoder(
+            "action_params", action_name, param_name)(value)
         return p4runtime_param
 
     def build_table_entry(self,
@@ -227,6 +950,37 @@ class P4InfoHelper(object):
 
         return table_entry
 
+    def get_table_entry_plan(self, table_name, action_name=None,
+                             match_fields=None, action_params=None,
+                             priority=None):
+        key = (table_name, action_name,
+               tuple(match_fields) if match_fields is not None else None,
+               tuple(action_params) if action_params is not None else None,
+               priority)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = TableEntryPlan(self.index, table_name, action_name,
+                                  match_fields=match_fields,
+                                  action_params=action_params,
+                                  priority=priority)
+            self._plans[key] = plan
+        return plan
+
+    def build_table_entries(self, table_name, action_name, rows,
+                            match_fields=None, action_params=None,
+                            priority=None):
+        """
+        Returns a generator of TableEntry messages for the given table and
+        action, one per row (see TableEntryPlan). match_fields and
+        action_params give the names of the values in each row, they default
+        to all match fields and params in P4Info order.
+        """
+        plan = self.get_table_entry_plan(table_name, action_name,
+                                         match_fields=match_fields,
+                                         action_params=action_params,
+                                         priority=priority)
+        return plan.build_many(rows)
+
     def build_action(self, action_name, action_params=None):
         action = p4runtime_pb2.Action()
         action.action_id = self.get_actions_id(action_name)
@@ -246,7 +1000,12 @@ class P4InfoHelper(object):
         member.action.CopyFrom(self.build_action(action_name, action_params))
         return member
 
-    def build_act_prof_group(self, act_prof_name, group_id, actions=()):
+    def build_act_prof_group(self, act_prof_name, group_id, actions=(),
+                             reuse=False, merge=False):
+        if reuse:
+            # Share members with the other groups built with reuse=True.
+            return self.member_pool.build_group(
+                act_prof_name, group_id, actions, merge)
         messages = []
         group = p4runtime_pb2.ActionProfileGroup()
         group.action_profile_id = self.get_action_profiles_id(act_prof_name)
@@ -276,7 +1035,8 @@ class P4InfoHelper(object):
             p4info_meta = self.get_packet_metadata("packet_out", name)
             meta = packet_out.metadata.add()
             meta.metadata_id = p4info_meta.id
-            meta.value = encode(value, p4info_meta.bitwidth)
+            meta.value = self.index.get_encoder(
+                "packet_metadata", "packet_out", name)(value)
         return packet_out
 
     def build_packet_in(self, payload, metadata=None):
@@ -288,5 +1048,6 @@ class P4InfoHelper(object):
             p4info_meta = self.get_packet_metadata("packet_in", name)
             meta = packet_in.metadata.add()
             meta.metadata_id = p4info_meta.id
-            meta.value = encode(value, p4info_meta.bitwidth)
+            meta.value = self.index.get_encoder(
+                "packet_metadata", "packet_in", name)(value)
         return packet_in
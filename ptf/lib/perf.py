@@ -0,0 +1,211 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import atexit
+import csv
+import heapq
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Latency recorder for the PTF support library: base_test and the modules it
+uses record the duration of each operation (e.g. "Write", "Write[table]",
+"StreamWait[packet]", "setUp") in RECORDER. The report of a run lists the
+operations and the slowest tests, see PerfRecorder.report.
+"""
+
+# Number of slowest tests and single operations kept in reports.
+REPORT_TOP = 20
+
+# Histograms have one bucket per power of 2 microseconds, up to ~1 hour.
+NUM_BUCKETS = 32
+
+
+class Histogram(object):
+    """
+    Durations histogram with log2 buckets: bucket i counts durations in
+    [2^(i-1), 2^i) microseconds.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # Number of updates and bytes carried by the operations, if any.
+        self.updates = 0
+        self.bytes = 0
+
+    def add(self, seconds, updates=0, bytes_=0):
+        usecs = int(seconds * 1e6)
+        self.buckets[min(usecs.bit_length(), NUM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.updates += updates
+        self.bytes += bytes_
+
+    def percentile(self, p):
+        """
+        Returns an upper bound of the p-th percentile (0 < p <= 100), in
+        seconds.
+        """
+        rank = self.count * p / 100.0
+        cumulated = 0
+        for i, n in enumerate(self.buckets):
+            cumulated += n
+            if n and cumulated >= rank:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "avg_ms": self.total / self.count * 1e3 if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1e3,
+            "p99_ms": self.percentile(99) * 1e3,
+            "max_ms": self.max * 1e3,
+            "updates": self.updates,
+            "bytes": self.bytes,
+        }
+
+
+class PerfRecorder(object):
+    """
+    Histograms of the operations of a process, by operation name, and
+    total duration of each test. Thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # operation name -> Histogram
+        self.operations = {}
+        # test id -> seconds
+        self.tests = {}
+        # test id -> "ok", "fail", "error" or "skip"
+        self.outcomes = {}
+        # Heap of the slowest single operations: (seconds, name, test id)
+        self._slowest = []
+        self.current_test = None
+        # table id -> name, used to name per-table operations
+        self.table_names = {}
+        self._report_paths = []
+
+    def record(self, name, seconds, updates=0, bytes_=0):
+        with self._lock:
+            hist = self.operations.get(name)
+            if hist is None:
+                hist = self.operations[name] = Histogram()
+            hist.add(seconds, updates, bytes_)
+            item = (seconds, name, self.current_test)
+            if len(self._slowest) < REPORT_TOP:
+                heapq.heappush(self._slowest, item)
+            elif seconds > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+
+    @contextmanager
+    def timed(self, name, updates=0, bytes_=0):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start, updates, bytes_)
+
+    def record_test(self, test_id, seconds):
+        with self._lock:
+            self.tests[test_id] = self.tests.get(test_id, 0.0) + seconds
+
+    def record_outcome(self, test_id, outcome):
+        with self._lock:
+            self.outcomes[test_id] = outcome
+
+    def record_write(self, name, req, seconds):
+        """
+        Records a WriteRequest under name, and under name[table] for each
+        table with entries in the request (see table_names).
+        """
+        self.record(name, seconds, len(req.updates), req.ByteSize())
+        per_table = {}
+        for update in req.updates:
+            if update.entity.HasField("table_entry"):
+                table_id = update.entity.table_entry.table_id
+                per_table[table_id] = per_table.get(table_id, 0) + 1
+        for table_id, updates in per_table.iteritems():
+            self.record("%s[%s]" % (name, self.table_names.get(
+                table_id, table_id)), seconds, updates)
+
+    def report(self):
+        """
+        Returns the report as a dict: operations sorted by total time, and
+        the slowest tests and single operations.
+        """
+        with self._lock:
+            operations = [dict(hist.to_dict(), name=name)
+                          for name, hist in self.operations.iteritems()]
+            tests = sorted(self.tests.iteritems(), key=lambda t: -t[1])
+            slowest = sorted(self._slowest, reverse=True)
+            outcomes = dict(self.outcomes)
+        operations.sort(key=lambda o: -o["total_s"])
+        return {
+            "operations": operations,
+            "slowest_tests": [{"test": test, "seconds": seconds}
+                              for test, seconds in tests[:REPORT_TOP]],
+            "slowest_operations": [
+                {"name": name, "test": test, "seconds": seconds}
+                for seconds, name, test in slowest],
+            "total_tests": len(tests),
+            # Seconds of every test, e.g. to balance test shards.
+            "test_seconds": dict(tests),
+            # Outcome of every test, e.g. to cache passes.
+            "test_outcomes": outcomes,
+        }
+
+    def write_report(self, path):
+        """
+        Writes the report to path, as CSV if path ends with .csv, as JSON
+        otherwise.
+        """
+        report = self.report()
+        with open(path, "w") as f:
+            if not path.endswith(".csv"):
+                json.dump(report, f, indent=2, sort_keys=True)
+                return
+            fields = ["section", "name", "test", "count", "total_s",
+                      "avg_ms", "p50_ms", "p99_ms", "max_ms", "updates",
+                      "bytes", "seconds"]
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            for o in report["operations"]:
+                writer.writerow(dict(o, section="operation"))
+            for t in report["slowest_tests"]:
+                writer.writerow(dict(t, section="slowest_test"))
+            for o in report["slowest_operations"]:
+                writer.writerow(dict(o, section="slowest_operation"))
+
+    def report_at_exit(self, path):
+        """
+        Writes the report to path when the process exits.
+        """
+        with self._lock:
+            if path in self._report_paths:
+                return
+            self._report_paths.append(path)
+        atexit.register(self.write_report, path)
+
+
+RECORDER = PerfRecorder()
@@ -0,0 +1,146 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import threading
+import time
+
+from p4.v1 import p4runtime_pb2
+
+from perf import RECORDER
+
+# Default number of WriteRequests in flight.
+DEFAULT_WINDOW = 8
+
+# Entities of a lower rank can be referenced by entities of a higher rank
+# (members by groups, groups and members by table entries, multicast groups
+# by table entry actions), so they must be written first.
+DEPENDENCY_RANKS = {
+    p4runtime_pb2.PacketReplicationEngineEntry: 0,
+    p4runtime_pb2.ActionProfileMember: 0,
+    p4runtime_pb2.ActionProfileGroup: 1,
+    p4runtime_pb2.TableEntry: 2,
+}
+
+
+def stages(entities):
+    """
+    Splits entities in lists of (position in entities, entity) that can be
+    written in parallel, in dependency order.
+    """
+    by_rank = {}
+    for i, entity in enumerate(entities):
+        by_rank.setdefault(DEPENDENCY_RANKS.get(type(entity), 0), []) \
+            .append((i, entity))
+    return [by_rank[rank] for rank in sorted(by_rank)]
+
+
+def pack_updates(new_write_request, updates, batch_size, max_bytes):
+    """
+    Packs (key, p4runtime_pb2.Update) pairs in WriteRequests of at most
+    batch_size updates or max_bytes bytes, each with a single kind of entity.
+    Generator of (WriteRequest, [key]).
+    """
+    req = new_write_request()
+    keys = []
+    req_bytes = 0
+    kind = None
+    for key, update in updates:
+        update_bytes = update.ByteSize()
+        update_kind = update.entity.WhichOneof("entity")
+        if keys and (len(keys) >= batch_size
+                     or req_bytes + update_bytes > max_bytes
+                     or update_kind != kind):
+            yield req, keys
+            req = new_write_request()
+            keys = []
+            req_bytes = 0
+        req.updates.add().CopyFrom(update)
+        keys.append(key)
+        req_bytes += update_bytes
+        kind = update_kind
+    if keys:
+        yield req, keys
+
+
+class WritePipeline(object):
+    """
+    Sends WriteRequests asynchronously with stub.Write.future, keeping at most
+    window requests in flight: submit() blocks until a slot is free. Requests
+    in flight are not ordered, call barrier() between requests that depend
+    on each other. Failed requests are gathered in errors as (request,
+    context, grpc.RpcError) tuples, where context is the value passed to
+    submit().
+    """
+
+    def __init__(self, stub, window=DEFAULT_WINDOW):
+        self.stub = stub
+        self.window = window
+        self._slots = threading.Semaphore(window)
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self.errors = []
+        # Successful requests and updates
+        self.requests = 0
+        self.updates = 0
+        self._start = None
+        self.seconds = 0.0
+
+    def submit(self, req, context=None):
+        self._slots.acquire()
+        with self._cond:
+            self._in_flight += 1
+            if self._start is None:
+                self._start = time.time()
+        start = time.time()
+        try:
+            future = self.stub.Write.future(req)
+        except Exception:
+            # Not sent: only give the slot back.
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+            self._slots.release()
+            raise
+        future.add_done_callback(
+            lambda f: self._finish(req, context, f.exception(), start))
+
+    def _finish(self, req, context, error, start):
+        # Called from a gRPC thread.
+        RECORDER.record_write("WriteAsync", req, time.time() - start)
+        with self._cond:
+            if error is None:
+                self.requests += 1
+                self.updates += len(req.updates)
+            else:
+                self.errors.append((req, context, error))
+            self._in_flight -= 1
+            self.seconds = time.time() - self._start
+            self._cond.notify_all()
+        self._slots.release()
+
+    def barrier(self):
+        """
+        Waits for all requests in flight to complete. Returns the errors
+        gathered so far.
+        """
+        with self._cond:
+            while self._in_flight:
+                self._cond.wait()
+        return self.errors
+
+    def rate(self):
+        """
+        Returns the achieved throughput, in updates per second.
+        """
+        return self.updates / self.seconds if self.seconds else 0.0
@@ -0,0 +1,149 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import time
+from collections import deque
+
+from p4.v1 import p4runtime_pb2
+
+from perf import RECORDER
+
+# Number of Read calls kept in ReadStats.history.
+READ_HISTORY_SIZE = 1000
+
+
+class ReadStats(object):
+    """
+    Statistics of the Read calls of a P4RuntimeReader. history holds the
+    last calls as (entities, seconds to the first response, total seconds).
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.entities = 0
+        self.seconds = 0.0
+        self.history = deque(maxlen=READ_HISTORY_SIZE)
+
+    def record(self, entities, first_seconds, seconds):
+        self.calls += 1
+        self.entities += entities
+        self.seconds += seconds
+        self.history.append((entities, first_seconds, seconds))
+
+    def __str__(self):
+        return "%d reads, %d entities in %.3f s" % (
+            self.calls, self.entities, self.seconds)
+
+
+class P4RuntimeReader(object):
+    """
+    Reads entities from a P4Runtime server. Reads are generators yielding
+    entities as the ReadResponse messages are streamed by the server, so
+    memory use does not depend on the number of entities read. With
+    decode=True, each entity is decoded with P4InfoHelper.decode when it is
+    yielded.
+    """
+
+    def __init__(self, stub, device_id, helper=None):
+        self.stub = stub
+        self.device_id = device_id
+        self.helper = helper
+        self.stats = ReadStats()
+
+    def read(self, entities):
+        """
+        Generator of the p4runtime_pb2.Entity messages matching the given
+        (possibly wildcard) entities, read in a single Read call.
+        """
+        req = p4runtime_pb2.ReadRequest()
+        req.device_id = self.device_id
+        req.entities.extend(entities)
+        count = 0
+        first_seconds = None
+        start = time.time()
+        try:
+            for rep in self.stub.Read(req):
+                if first_seconds is None:
+                    first_seconds = time.time() - start
+                for entity in rep.entities:
+                    count += 1
+                    yield entity
+        finally:
+            seconds = time.time() - start
+            self.stats.record(count, first_seconds, seconds)
+            RECORDER.record("Read", seconds, count)
+
+    def _read_field(self, entity, decode):
+        field = entity.WhichOneof("entity")
+        for e in self.read([entity]):
+            msg = getattr(e, field)
+            yield self.helper.decode(msg) if decode else msg
+
+    def table_entries(self, table_name=None, decode=False):
+        """
+        Reads the entries of the given table, or of all tables if None.
+        Default entries are not included.
+        """
+        entity = p4runtime_pb2.Entity()
+        entity.table_entry.SetInParent()
+        if table_name is not None:
+            entity.table_entry.table_id = self.helper.get_tables_id(
+                table_name)
+        return self._read_field(entity, decode)
+
+    def act_prof_members(self, act_prof_name=None, decode=False):
+        entity = p4runtime_pb2.Entity()
+        entity.action_profile_member.SetInParent()
+        if act_prof_name is not None:
+            entity.action_profile_member.action_profile_id = \
+                self.helper.get_action_profiles_id(act_prof_name)
+        return self._read_field(entity, decode)
+
+    def act_prof_groups(self, act_prof_name=None, decode=False):
+        entity = p4runtime_pb2.Entity()
+        entity.action_profile_group.SetInParent()
+        if act_prof_name is not None:
+            entity.action_profile_group.action_profile_id = \
+                self.helper.get_action_profiles_id(act_prof_name)
+        return self._read_field(entity, decode)
+
+    def direct_counters(self, table_name=None, decode=False):
+        """
+        Reads the direct counters of all entries of the given table, or of
+        all tables if None.
+        """
+        entity = p4runtime_pb2.Entity()
+        entity.direct_counter_entry.table_entry.SetInParent()
+        if table_name is not None:
+            entity.direct_counter_entry.table_entry.table_id = \
+                self.helper.get_tables_id(table_name)
+        return self._read_field(entity, decode)
+
+    def multicast_groups(self, group_id=0, decode=False):
+        """
+        Reads the given multicast group, or all groups if 0.
+        """
+        entity = p4runtime_pb2.Entity()
+        entity.packet_replication_engine_entry.multicast_group_entry \
+            .multicast_group_id = group_id
+        return self._read_field(entity, decode)
+
+    def clone_sessions(self, session_id=0, decode=False):
+        """
+        Reads the given clone session, or all sessions if 0.
+        """
+        entity = p4runtime_pb2.Entity()
+        entity.packet_replication_engine_entry.clone_session_entry \
+            .session_id = session_id
+        return self._read_field(entity, decode)
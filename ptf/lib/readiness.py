@@ -0,0 +1,158 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import os
+import socket
+import time
+
+import grpc
+
+from session import get_session, record_timing
+
+"""
+Startup readiness probes: instead of sleeping for a fixed time after
+starting stratum_bmv2, wait for its interfaces, gRPC server and P4Runtime
+stream to be up, polling with exponential backoff until a deadline. The
+duration of each phase is recorded as "Ready[phase]" (see
+session.record_timing).
+"""
+
+SYS_CLASS_NET = "/sys/class/net"
+
+# Default total time to wait for the switch to be ready.
+DEFAULT_READY_TIMEOUT = 30.0
+
+# Backoff between probes: from INITIAL_DELAY, doubled up to MAX_DELAY.
+INITIAL_DELAY = 0.01
+MAX_DELAY = 1.0
+
+logger = logging.getLogger("readiness")
+
+
+class NotReadyError(Exception):
+    def __init__(self, phase, msg):
+        super(NotReadyError, self).__init__()
+        self.phase = phase
+        self.msg = msg
+
+    def __str__(self):
+        return "Switch not ready (%s): %s" % (self.phase, self.msg)
+
+
+def missing_ifaces(ifaces):
+    """
+    Returns the sorted list of the given interfaces that don't exist.
+    """
+    return sorted(iface for iface in set(ifaces)
+                  if not os.path.exists(os.path.join(SYS_CLASS_NET, iface)))
+
+
+def backoff(deadline, initial=INITIAL_DELAY, maximum=MAX_DELAY):
+    """
+    Generator of the delays to wait between probes, doubled each time up to
+    maximum and cut to the deadline (as returned by time.time()). Stops when
+    the deadline is reached.
+    """
+    delay = initial
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        yield min(delay, remaining)
+        delay = min(delay * 2, maximum)
+
+
+def _timed(phase, start):
+    seconds = time.time() - start
+    record_timing("Ready[%s]" % phase, seconds)
+    logger.info("%s ready in %.3f s", phase, seconds)
+    return seconds
+
+
+def wait_for_ifaces(ifaces, deadline):
+    start = time.time()
+    missing = missing_ifaces(ifaces)
+    for delay in backoff(deadline):
+        if not missing:
+            break
+        time.sleep(delay)
+        missing = missing_ifaces(missing)
+    if missing:
+        raise NotReadyError("ifaces", "missing %s" % ", ".join(missing))
+    return _timed("ifaces", start)
+
+
+def wait_for_port(grpc_addr, deadline):
+    """
+    Waits for the server to accept TCP connections. Probing the port first
+    avoids the first gRPC connection attempt failing, after which gRPC waits
+    at least 1 s before retrying.
+    """
+    start = time.time()
+    host, port = grpc_addr.rsplit(":", 1)
+    for delay in backoff(deadline):
+        try:
+            socket.create_connection((host, int(port)), timeout=delay).close()
+            return _timed("port", start)
+        except socket.error:
+            time.sleep(delay)
+    raise NotReadyError("port", "%s not listening" % grpc_addr)
+
+
+def wait_for_channel(channel, deadline):
+    """
+    Waits for the gRPC channel to connect.
+    """
+    start = time.time()
+    try:
+        grpc.channel_ready_future(channel).result(
+            timeout=max(deadline - start, 0))
+    except grpc.FutureTimeoutError:
+        raise NotReadyError("channel", "cannot connect")
+    return _timed("channel", start)
+
+
+def wait_for_arbitration(session, election_id, deadline):
+    """
+    Opens the session stream and sends arbitration requests until the server
+    replies, each time waiting longer for the reply.
+    """
+    start = time.time()
+    for delay in backoff(deadline, initial=0.1):
+        if session.arbitrate(election_id, timeout=delay):
+            return _timed("arbitration", start)
+    raise NotReadyError("arbitration", "no reply from server")
+
+
+def wait_until_ready(grpc_addr, device_id, ifaces=(), election_id=1,
+                     timeout=DEFAULT_READY_TIMEOUT):
+    """
+    Waits for the interfaces, the gRPC server port and channel, and a
+    successful arbitration, within timeout seconds in total. The arbitrated
+    session is kept (see session.get_session). Returns {phase: seconds},
+    raises NotReadyError if the switch is not ready in time.
+    """
+    start = time.time()
+    deadline = start + timeout
+    phases = {}
+    if ifaces:
+        phases["ifaces"] = wait_for_ifaces(ifaces, deadline)
+    phases["port"] = wait_for_port(grpc_addr, deadline)
+    session = get_session(grpc_addr, device_id)
+    phases["channel"] = wait_for_channel(session.channel, deadline)
+    phases["arbitration"] = wait_for_arbitration(session, election_id,
+                                                 deadline)
+    phases["total"] = _timed("total", start)
+    return phases
@@ -15,23 +15,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import Queue
 import argparse
+import ast
+import hashlib
+import heapq
 import json
 import logging
 import os
 import re
+import socket
 import subprocess
 import sys
 import threading
 import time
 from collections import OrderedDict
 
-import google.protobuf.text_format
 import grpc
-from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
+from p4.v1 import p4runtime_pb2
+
+from helper import load_p4info
+from readiness import DEFAULT_READY_TIMEOUT, NotReadyError, backoff, \
+    missing_ifaces, wait_until_ready
+from session import close_session, get_session
+from testcache import ResultCache, changed_names, defines_run_test, \
+    select_changed
+import worker
 
 PTF_ROOT = os.path.dirname(os.path.realpath(__file__))
+# Output of the PTF worker started by --worker, kept out of the PTF directory.
+WORKER_LOG = "/tmp/ptf-worker.log"
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("PTF runner")
@@ -57,11 +69,10 @@ def check_ifaces(ifaces):
     """
     Checks that required interfaces exist.
     """
-    ifconfig_out = subprocess.check_output(['ifconfig'])
-    iface_list = re.findall(r'^([a-zA-Z0-9]+)', ifconfig_out, re.S | re.M)
-    present_ifaces = set(iface_list)
-    ifaces = set(ifaces)
-    return ifaces <= present_ifaces
+    missing = missing_ifaces(ifaces)
+    if missing:
+        error("Missing interfaces: %s", ", ".join(missing))
+    return not missing
 
 
 def build_bmv2_config(bmv2_json_path):
@@ -72,64 +83,62 @@ def build_bmv2_config(bmv2_json_path):
         return f.read()
 
 
-def update_config(p4info_path, bmv2_json_path, grpc_addr, device_id):
+def pipeline_cookie(p4info_path, bmv2_json_path, bmv2_config=None):
     """
-    Performs a SetForwardingPipelineConfig on the device
+    Returns the cookie identifying the pipeline config, a 64-bit hash of the
+    P4Info and BMv2 JSON.
     """
-    channel = grpc.insecure_channel(grpc_addr)
-    stub = p4runtime_pb2_grpc.P4RuntimeStub(channel)
-
-    debug("Sending P4 config")
-
-    # Send master arbitration via stream channel
-    # This should go in library, to be re-used also by base_test.py.
-    stream_out_q = Queue.Queue()
-    stream_in_q = Queue.Queue()
+    if bmv2_config is None:
+        bmv2_config = build_bmv2_config(bmv2_json_path)
+    h = hashlib.sha256(load_p4info(p4info_path).sha256)
+    h.update(bmv2_config)
+    return int(h.hexdigest()[:16], 16)
 
-    def stream_req_iterator():
-        while True:
-            p = stream_out_q.get()
-            if p is None:
-                break
-            yield p
 
-    def stream_recv(stream):
-        for p in stream:
-            stream_in_q.put(p)
-
-    def get_stream_packet(type_, timeout=1):
-        start = time.time()
-        try:
-            while True:
-                remaining = timeout - (time.time() - start)
-                if remaining < 0:
-                    break
-                msg = stream_in_q.get(timeout=remaining)
-                if not msg.HasField(type_):
-                    continue
-                return msg
-        except:  # timeout expired
-            pass
+def get_config_cookie(stub, device_id):
+    """
+    Returns the cookie of the pipeline config on the device, or None if it
+    can't be read (e.g. no config pushed yet).
+    """
+    request = p4runtime_pb2.GetForwardingPipelineConfigRequest()
+    request.device_id = device_id
+    request.response_type = \
+        p4runtime_pb2.GetForwardingPipelineConfigRequest.COOKIE_ONLY
+    try:
+        response = stub.GetForwardingPipelineConfig(request)
+    except grpc.RpcError as e:
+        debug("Cannot read pipeline config cookie: %s", e.details())
+        return None
+    if not response.config.HasField("cookie"):
         return None
+    return response.config.cookie.cookie
 
-    stream = stub.StreamChannel(stream_req_iterator())
-    stream_recv_thread = threading.Thread(target=stream_recv, args=(stream,))
-    stream_recv_thread.start()
-
-    req = p4runtime_pb2.StreamMessageRequest()
-    arbitration = req.arbitration
-    arbitration.device_id = device_id
-    election_id = arbitration.election_id
-    election_id.high = 0
-    election_id.low = 1
-    stream_out_q.put(req)
-
-    rep = get_stream_packet("arbitration", timeout=5)
-    if rep is None:
-        error("Failed to establish handshake")
-        return False
 
+def update_config(p4info_path, bmv2_json_path, grpc_addr, device_id,
+                  reconcile=False, force=False, close=True):
+    """
+    Performs a SetForwardingPipelineConfig on the device, unless it already
+    runs the same config (as identified by its cookie) and force is False.
+    With reconcile, uses RECONCILE_AND_COMMIT to preserve the forwarding
+    state. With close, the session (see session.get_session) is closed
+    afterwards, so that the tests run by another process can become primary.
+    """
+    start = time.time()
+    bmv2_config = build_bmv2_config(bmv2_json_path)
+    cookie = pipeline_cookie(p4info_path, bmv2_json_path, bmv2_config)
+
+    session = get_session(grpc_addr, device_id)
     try:
+        if not force and get_config_cookie(session.stub, device_id) == cookie:
+            info("Device already runs this pipeline config (cookie %x), "
+                 "skipping push (%.3f s)", cookie, time.time() - start)
+            return True
+
+        debug("Sending P4 config")
+        if not session.arbitrate(1, timeout=5):
+            error("Failed to establish handshake")
+            return False
+
         # Set pipeline config.
         request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
         request.device_id = device_id
@@ -137,28 +146,32 @@ def update_config(p4info_path, bmv2_json_path, grpc_addr, device_id):
         election_id.high = 0
         election_id.low = 1
         config = request.config
-        with open(p4info_path, 'r') as p4info_f:
-            google.protobuf.text_format.Merge(p4info_f.read(), config.p4info)
-        config.p4_device_config = build_bmv2_config(bmv2_json_path)
-        request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
+        config.p4info.CopyFrom(load_p4info(p4info_path).p4info)
+        config.p4_device_config = bmv2_config
+        config.cookie.cookie = cookie
+        if reconcile:
+            request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.RECONCILE_AND_COMMIT
+        else:
+            request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
+        push_start = time.time()
         try:
-            stub.SetForwardingPipelineConfig(request)
+            session.stub.SetForwardingPipelineConfig(request)
         except Exception as e:
             error("Error during SetForwardingPipelineConfig")
             error(str(e))
             return False
+        info("Pushed pipeline config (cookie %x, %s) in %.3f s, "
+             "%.3f s total", cookie,
+             p4runtime_pb2.SetForwardingPipelineConfigRequest.Action.Name(
+                 request.action),
+             time.time() - push_start, time.time() - start)
         return True
     finally:
-        stream_out_q.put(None)
-        stream_recv_thread.join()
+        if close:
+            close_session(grpc_addr, device_id)
 
 
-def run_test(p4info_path, grpc_addr, device_id, cpu_port, ptfdir, port_map_path,
-             extra_args=()):
-    """
-    Runs PTF tests included in provided directory.
-    Device must be running and configfured with appropriate P4 program.
-    """
+def load_port_map(port_map_path):
     # TODO: check schema?
     # "ptf_port" is ignored for now, we assume that ports are provided by
     # increasing values of ptf_port, in the range [0, NUM_IFACES[.
@@ -169,30 +182,64 @@ def run_test(p4info_path, grpc_addr, device_id, cpu_port, ptfdir, port_map_path,
             p4_port = entry["p4_port"]
             iface_name = entry["iface_name"]
             port_map[p4_port] = iface_name
+    return port_map
 
-    if not check_ifaces(port_map.values()):
-        error("Some interfaces are missing")
-        return False
 
+def ptf_test_params(p4info_path, grpc_addr, device_id, cpu_port,
+                    perf_report=None):
+    """
+    Returns the PTF test params string read by base_test.
+    """
+    test_params = 'p4info=\'{}\''.format(p4info_path)
+    test_params += ';grpcaddr=\'{}\''.format(grpc_addr)
+    test_params += ';device_id=\'{}\''.format(device_id)
+    test_params += ';cpu_port=\'{}\''.format(cpu_port)
+    if perf_report:
+        test_params += ';perf_report=\'{}\''.format(
+            os.path.abspath(perf_report))
+    return test_params
+
+
+def ptf_command(p4info_path, grpc_addr, device_id, cpu_port, ptfdir, port_map,
+                extra_args=(), perf_report=None):
+    """
+    Returns the PTF command line to run the tests in ptfdir, with the
+    interfaces in port_map (P4 port -> interface name).
+    """
     ifaces = []
     # FIXME
     # find base_test.py
     pypath = os.path.dirname(os.path.abspath(__file__))
-    if 'PYTHONPATH' in os.environ:
-        os.environ['PYTHONPATH'] += ":" + pypath
-    else:
+    if 'PYTHONPATH' not in os.environ:
         os.environ['PYTHONPATH'] = pypath
+    elif pypath not in os.environ['PYTHONPATH'].split(":"):
+        os.environ['PYTHONPATH'] += ":" + pypath
     for iface_idx, iface_name in port_map.items():
         ifaces.extend(['-i', '{}@{}'.format(iface_idx, iface_name)])
     cmd = ['ptf']
     cmd.extend(['--test-dir', ptfdir])
     cmd.extend(ifaces)
-    test_params = 'p4info=\'{}\''.format(p4info_path)
-    test_params += ';grpcaddr=\'{}\''.format(grpc_addr)
-    test_params += ';device_id=\'{}\''.format(device_id)
-    test_params += ';cpu_port=\'{}\''.format(cpu_port)
-    cmd.append('--test-params={}'.format(test_params))
+    cmd.append('--test-params={}'.format(ptf_test_params(
+        p4info_path, grpc_addr, device_id, cpu_port, perf_report)))
     cmd.extend(extra_args)
+    return cmd
+
+
+def run_test(p4info_path, grpc_addr, device_id, cpu_port, ptfdir, port_map_path,
+             extra_args=(), perf_report=None, outcomes=None):
+    """
+    Runs PTF tests included in provided directory.
+    Device must be running and configfured with appropriate P4 program.
+    The outcome of each test is added to outcomes, if given (this needs a
+    perf_report).
+    """
+    port_map = load_port_map(port_map_path)
+    if not check_ifaces(port_map.values()):
+        error("Some interfaces are missing")
+        return False
+
+    cmd = ptf_command(p4info_path, grpc_addr, device_id, cpu_port, ptfdir,
+                      port_map, extra_args, perf_report)
     debug("Executing PTF command: {}".format(' '.join(cmd)))
 
     try:
@@ -202,9 +249,256 @@ def run_test(p4info_path, grpc_addr, device_id, cpu_port, ptfdir, port_map_path,
     except:
         error("Error when running PTF tests")
         return False
+    if outcomes is not None and perf_report:
+        read_outcomes(perf_report, outcomes)
     return p.returncode == 0
 
 
+def start_worker(socket_path, p4info_path, bmv2_json_path, grpc_addr,
+                 device_id, cpu_port, ptfdir, port_map_path, ready_timeout,
+                 perf_report=None):
+    """
+    Starts a PTF worker (see worker.py) in the background, logging to
+    WORKER_LOG, and waits for it to accept requests.
+    """
+    cmd = [sys.executable, os.path.join(PTF_ROOT, "worker.py"),
+           "--socket", socket_path, "serve",
+           "--p4info", p4info_path,
+           "--bmv2-json", bmv2_json_path,
+           "--grpc-addr", grpc_addr,
+           "--device-id", str(device_id),
+           "--cpu-port", str(cpu_port),
+           "--ptf-dir", ptfdir,
+           "--port-map", port_map_path,
+           "--ready-timeout", str(ready_timeout)]
+    if perf_report:
+        cmd.extend(["--perf-report", perf_report])
+    info("Starting PTF worker on {}".format(socket_path))
+    with open(WORKER_LOG, "a") as log:
+        p = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT,
+                             preexec_fn=os.setsid)
+    # The worker waits for the switch itself, give it some extra time to
+    # start.
+    for delay in backoff(time.time() + ready_timeout + 30, maximum=0.5):
+        if worker.is_running(socket_path):
+            return True
+        if p.poll() is not None:
+            break
+        time.sleep(delay)
+    error("PTF worker failed to start, see {}".format(WORKER_LOG))
+    return False
+
+
+def run_on_worker(socket_path, specs, outcomes=None):
+    """
+    Runs the tests matching specs on the PTF worker listening on
+    socket_path. The outcome of each test is added to outcomes, if given.
+    """
+    try:
+        reply = worker.run_tests(socket_path, specs)
+    except (socket.error, worker.WorkerError) as e:
+        error("PTF worker request failed: {}".format(e))
+        return False
+    if outcomes is not None:
+        outcomes.update((t["test"], t["status"]) for t in reply["tests"])
+    return reply["success"]
+
+
+def read_outcomes(perf_report, outcomes):
+    """
+    Adds the test outcomes of a perf report (see perf.py) to outcomes.
+    """
+    if os.path.exists(perf_report):
+        with open(perf_report) as f:
+            outcomes.update(json.load(f).get("test_outcomes", {}))
+
+
+def discover_tests(ptfdir):
+    """
+    Returns the test classes (classes defining runTest, or inheriting it
+    from a class of the same module) of the modules in ptfdir, as a list of
+    ("module.Class", groups), without importing them.
+    """
+    tests = []
+    for filename in sorted(os.listdir(ptfdir)):
+        if not filename.endswith(".py"):
+            continue
+        module = filename[:-3]
+        with open(os.path.join(ptfdir, filename)) as f:
+            tree = ast.parse(f.read(), filename)
+        classes = dict((n.name, n) for n in tree.body
+                       if isinstance(n, ast.ClassDef))
+        for node in tree.body:
+            if not isinstance(node, ast.ClassDef) \
+                    or not defines_run_test(node, classes):
+                continue
+            groups = set()
+            for dec in node.decorator_list:
+                if isinstance(dec, ast.Call) \
+                        and getattr(dec.func, "id", None) == "group" \
+                        and dec.args and isinstance(dec.args[0], ast.Str):
+                    groups.add(dec.args[0].s)
+            tests.append(("{}.{}".format(module, node.name), groups))
+    return tests
+
+
+def select_tests(tests, args):
+    """
+    Splits args in the test specs (module, module.Class or group names) and
+    the other PTF arguments. Returns the tests matching the specs (all tests
+    if none), and the other arguments.
+    """
+    names = set()
+    for spec, groups in tests:
+        names.add(spec)
+        names.add(spec.split(".")[0])
+        names.update(groups)
+    specs = [a for a in args if a in names]
+    other_args = [a for a in args if a not in names]
+    if not specs:
+        return [spec for spec, _ in tests], other_args
+    selected = []
+    for spec, groups in tests:
+        if any(s == spec or s == spec.split(".")[0] or s in groups
+               for s in specs):
+            selected.append(spec)
+    return selected, other_args
+
+
+def balance_shards(tests, durations, shards):
+    """
+    Distributes tests in shards with similar total durations (longest
+    processing time first). Tests without a known duration are assumed to
+    take the average duration.
+    """
+    known = [durations[t] for t in tests if t in durations]
+    default = sum(known) / len(known) if known else 1.0
+    loads = [(0.0, k) for k in range(shards)]
+    assignment = [[] for _ in range(shards)]
+    for test in sorted(tests, key=lambda t: (-durations.get(t, default), t)):
+        load, k = heapq.heappop(loads)
+        assignment[k].append(test)
+        heapq.heappush(loads, (load + durations.get(test, default), k))
+    return assignment
+
+
+def shard_grpc_addr(grpc_addr, shard):
+    host, port = grpc_addr.rsplit(":", 1)
+    return "{}:{}".format(host, int(port) + shard)
+
+
+def shard_port_map(port_map, shard):
+    """
+    Returns the port map of the given switch instance: interfaces vethN are
+    renamed to veth(N + 16 * shard), see start_bmv2.sh.
+    """
+    shard_map = OrderedDict()
+    for p4_port, iface_name in port_map.items():
+        m = re.match(r"^veth(\d+)$", iface_name)
+        if m is None:
+            raise ValueError("Cannot shard interface {}".format(iface_name))
+        shard_map[p4_port] = "veth{}".format(int(m.group(1)) + 16 * shard)
+    return shard_map
+
+
+def load_durations(durations_path):
+    if durations_path is None or not os.path.exists(durations_path):
+        return {}
+    with open(durations_path) as f:
+        return json.load(f)
+
+
+def run_shards(p4info_path, grpc_addr, device_id, cpu_port, ptfdir,
+               port_map_path, shards, out_dir, durations_path=None,
+               extra_args=(), outcomes=None):
+    """
+    Runs the tests in ptfdir on several switch instances concurrently (one
+    PTF process per instance), with test classes balanced by the durations
+    of previous runs. Output, logs and perf report of shard k are written to
+    out_dir/shard-k. Merged logs and a summary report are written to
+    out_dir, and the test durations are updated. The outcome of each test
+    is added to outcomes, if given.
+    """
+    ptfdir = os.path.abspath(ptfdir)
+    p4info_path = os.path.abspath(p4info_path)
+    out_dir = os.path.abspath(out_dir)
+    tests, extra_args = select_tests(discover_tests(ptfdir), extra_args)
+    durations = load_durations(durations_path)
+    assignment = balance_shards(tests, durations, shards)
+    port_map = load_port_map(port_map_path)
+
+    procs = []
+    for k, shard_tests in enumerate(assignment):
+        if not shard_tests:
+            continue
+        shard_map = shard_port_map(port_map, k)
+        if not check_ifaces(shard_map.values()):
+            error("Some interfaces of shard {} are missing".format(k))
+            return False
+        shard_dir = os.path.join(out_dir, "shard-{}".format(k))
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+        cmd = ptf_command(p4info_path, shard_grpc_addr(grpc_addr, k),
+                          device_id, cpu_port, ptfdir, shard_map,
+                          list(extra_args) + shard_tests,
+                          perf_report=os.path.join(shard_dir, "perf.json"))
+        debug("Executing PTF command for shard {}: {}".format(
+            k, ' '.join(cmd)))
+        expected = sum(durations.get(t, 0) for t in shard_tests)
+        info("Shard {}: {} tests, expected {:.1f} s".format(
+            k, len(shard_tests), expected))
+        output = open(os.path.join(shard_dir, "output.log"), "w")
+        # PTF writes its log and pcap files in the current directory.
+        p = subprocess.Popen(cmd, stdout=output, stderr=subprocess.STDOUT,
+                             cwd=shard_dir)
+        procs.append((k, shard_tests, shard_dir, p, output, time.time()))
+
+    summary = []
+    for k, shard_tests, shard_dir, p, output, start in procs:
+        p.wait()
+        output.close()
+        summary.append({
+            "shard": k,
+            "grpc_addr": shard_grpc_addr(grpc_addr, k),
+            "tests": shard_tests,
+            "returncode": p.returncode,
+            "seconds": time.time() - start,
+        })
+
+    # Merge outputs and logs, in shard order.
+    with open(os.path.join(out_dir, "ptf.log"), "w") as merged_log:
+        for k, shard_tests, shard_dir, _, _, _ in procs:
+            with open(os.path.join(shard_dir, "output.log")) as f:
+                print "===== Shard {} ({}) =====".format(
+                    k, ", ".join(shard_tests))
+                sys.stdout.write(f.read())
+            log_path = os.path.join(shard_dir, "ptf.log")
+            if os.path.exists(log_path):
+                merged_log.write("===== Shard {} =====\n".format(k))
+                with open(log_path) as f:
+                    merged_log.write(f.read())
+            perf_path = os.path.join(shard_dir, "perf.json")
+            if os.path.exists(perf_path):
+                with open(perf_path) as f:
+                    for test_id, seconds in json.load(f).get(
+                            "test_seconds", {}).items():
+                        # "module.Class.runTest" -> "module.Class"
+                        durations[test_id.rsplit(".", 1)[0]] = seconds
+                if outcomes is not None:
+                    read_outcomes(perf_path, outcomes)
+
+    success = all(s["returncode"] == 0 for s in summary)
+    with open(os.path.join(out_dir, "report.json"), "w") as f:
+        json.dump({"success": success, "shards": summary}, f, indent=2)
+    for s in summary:
+        info("Shard {shard} ({grpc_addr}): returncode {returncode}, "
+             "{seconds:.1f} s".format(**s))
+    if durations_path is not None:
+        with open(durations_path, "w") as f:
+            json.dump(durations, f, indent=2, sort_keys=True)
+    return success
+
+
 def check_ptf():
     try:
         with open(os.devnull, 'w') as devnull:
@@ -217,6 +511,109 @@ def check_ptf():
         return False
 
 
+def plan_tests(cache, ptfdir, p4info_path, bmv2_json_path, args,
+               only_changed=False):
+    """
+    Returns the tests selected by args (see select_tests), the ones among
+    them that need to run, and the other PTF arguments. Tests with a cached
+    pass are skipped. With only_changed, only the test groups referencing the
+    P4 entities changed since the base of each test (see ResultCache) are
+    selected.
+    """
+    tests, other_args = select_tests(discover_tests(ptfdir), args)
+    selected = tests
+    if only_changed:
+        by_base = OrderedDict()
+        for test in tests:
+            by_base.setdefault(cache.base_paths(test), []).append(test)
+        affected = set()
+        for base, base_tests in by_base.items():
+            if base is None:
+                info("No base pipeline for: {}".format(", ".join(base_tests)))
+                affected.update(base_tests)
+                continue
+            names = changed_names(base[0], base[1], p4info_path,
+                                  bmv2_json_path)
+            if names is None:
+                info("Pipeline changes affect: {}".format(
+                    ", ".join(base_tests)))
+                affected.update(base_tests)
+                continue
+            # Other tests of the affected groups are selected too.
+            changed = select_changed(ptfdir, tests, names)
+            info("Changed P4 entities since the base of {}: {}; "
+                 "selected {}".format(", ".join(base_tests),
+                                      ", ".join(sorted(names)) or "none",
+                                      ", ".join(changed) or "no tests"))
+            affected.update(changed)
+        selected = [t for t in tests if t in affected]
+    cached = [t for t in selected if cache.has_passed(t)]
+    if cached:
+        info("Skipping {} tests that passed with the same pipeline and "
+             "code: {}".format(len(cached), ", ".join(cached)))
+    return tests, [t for t in selected if t not in cached], other_args
+
+
+def run_on_switches(args, test_args, perf_report, outcomes):
+    """
+    Waits for the switch instances, pushes the pipeline config to them and
+    runs the tests, sharded if needed.
+    """
+    results = [None] * args.shards
+    port_map = load_port_map(args.port_map)
+
+    def update_shard_config(k):
+        grpc_addr = shard_grpc_addr(args.grpc_addr, k)
+        ifaces = port_map.values() if args.shards == 1 \
+            else shard_port_map(port_map, k).values()
+        try:
+            wait_until_ready(grpc_addr, args.device_id, ifaces,
+                             timeout=args.ready_timeout)
+        except NotReadyError as e:
+            error("%s: %s", grpc_addr, e)
+            results[k] = False
+            return
+        results[k] = update_config(
+            p4info_path=args.p4info,
+            bmv2_json_path=args.bmv2_json,
+            grpc_addr=grpc_addr,
+            device_id=args.device_id,
+            reconcile=args.reconcile,
+            force=args.force_push)
+
+    threads = [threading.Thread(target=update_shard_config, args=(k,))
+               for k in range(args.shards)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if not all(results):
+        sys.exit(2)
+
+    if args.shards > 1:
+        return run_shards(p4info_path=args.p4info,
+                          grpc_addr=args.grpc_addr,
+                          device_id=args.device_id,
+                          cpu_port=args.cpu_port,
+                          ptfdir=args.ptf_dir,
+                          port_map_path=args.port_map,
+                          shards=args.shards,
+                          out_dir=args.shard_dir,
+                          durations_path=args.durations,
+                          extra_args=test_args,
+                          outcomes=outcomes)
+
+    return run_test(p4info_path=args.p4info,
+                    device_id=args.device_id,
+                    grpc_addr=args.grpc_addr,
+                    cpu_port=args.cpu_port,
+                    ptfdir=args.ptf_dir,
+                    port_map_path=args.port_map,
+                    extra_args=test_args,
+                    perf_report=perf_report,
+                    outcomes=outcomes)
+
+
 # noinspection PyTypeChecker
 def main():
     parser = argparse.ArgumentParser(
@@ -242,6 +639,53 @@ def main():
     parser.add_argument('--port-map',
                         help='Path to JSON port mapping',
                         type=str, required=True)
+    parser.add_argument('--reconcile',
+                        help='Push the pipeline config with '
+                             'RECONCILE_AND_COMMIT, preserving the '
+                             'forwarding state',
+                        action="store_true")
+    parser.add_argument('--force-push',
+                        help='Push the pipeline config even if the device '
+                             'already runs it',
+                        action="store_true")
+    parser.add_argument('--ready-timeout',
+                        help='Seconds to wait for the switch interfaces, '
+                             'gRPC server and arbitration to be up',
+                        type=float, default=DEFAULT_READY_TIMEOUT)
+    parser.add_argument('--worker',
+                        help='Run the tests on the PTF worker listening on '
+                             'this Unix socket, starting it if needed (see '
+                             'worker.py)',
+                        type=str, required=False)
+    parser.add_argument('--shards',
+                        help='Number of switch instances to run the tests '
+                             'on concurrently (see start_bmv2.sh), instance '
+                             'k listening on --grpc-addr port + k',
+                        type=int, default=1)
+    parser.add_argument('--shard-dir',
+                        help='Directory of the outputs and merged report of '
+                             'sharded runs',
+                        type=str, default='/tmp/ptf-shards')
+    parser.add_argument('--durations',
+                        help='JSON file with the test durations of previous '
+                             'runs, used to balance shards and updated '
+                             'after each sharded run',
+                        type=str, required=False)
+    parser.add_argument('--perf-report',
+                        help='Write a latency report of the run to this '
+                             'file (CSV if it ends with .csv, JSON otherwise)',
+                        type=str, required=False)
+    parser.add_argument('--result-cache',
+                        help='Directory of the test result cache: tests '
+                             'that passed with the same BMv2 JSON, P4Info, '
+                             'test module and PTF library are skipped',
+                        type=str, required=False)
+    parser.add_argument('--select-changed',
+                        help='Only run the test groups referencing the '
+                             'tables, actions, etc. changed since the '
+                             'tests last passed or were checked (needs '
+                             '--result-cache)',
+                        action="store_true")
     args, unknown_args = parser.parse_known_args()
 
     if not check_ptf():
@@ -257,23 +701,58 @@ def main():
     if not os.path.exists(args.port_map):
         print "Port map path '{}' does not exist".format(args.port_map)
         sys.exit(1)
+    if args.select_changed and not args.result_cache:
+        error("--select-changed needs --result-cache")
+        sys.exit(1)
 
     try:
 
-        success = update_config(p4info_path=args.p4info,
-                                bmv2_json_path=args.bmv2_json,
-                                grpc_addr=args.grpc_addr,
-                                device_id=args.device_id)
-        if not success:
-            sys.exit(2)
-
-        success = run_test(p4info_path=args.p4info,
-                           device_id=args.device_id,
-                           grpc_addr=args.grpc_addr,
-                           cpu_port=args.cpu_port,
-                           ptfdir=args.ptf_dir,
-                           port_map_path=args.port_map,
-                           extra_args=unknown_args)
+        outcomes = None
+        perf_report = args.perf_report
+        cache = None
+        test_args = unknown_args
+        if args.result_cache:
+            cache = ResultCache(args.result_cache, args.p4info,
+                                args.bmv2_json, args.ptf_dir)
+            considered, tests, other_args = plan_tests(
+                cache, args.ptf_dir, args.p4info, args.bmv2_json,
+                unknown_args, args.select_changed)
+            if not tests:
+                info("Nothing to run")
+                cache.update_bases(considered)
+                cache.save()
+                return
+            test_args = other_args + tests
+            outcomes = {}
+            if not perf_report:
+                if not os.path.isdir(args.result_cache):
+                    os.makedirs(args.result_cache)
+                perf_report = os.path.join(args.result_cache, "perf.json")
+            if os.path.exists(perf_report):
+                os.remove(perf_report)
+
+        if args.worker:
+            if args.shards > 1:
+                error("--worker and --shards can't be used together")
+                sys.exit(1)
+            if not worker.is_running(args.worker) and not start_worker(
+                    args.worker, os.path.abspath(args.p4info),
+                    os.path.abspath(args.bmv2_json), args.grpc_addr,
+                    args.device_id, args.cpu_port,
+                    os.path.abspath(args.ptf_dir),
+                    os.path.abspath(args.port_map), args.ready_timeout,
+                    args.perf_report):
+                sys.exit(2)
+            success = run_on_worker(args.worker, test_args, outcomes)
+        else:
+            success = run_on_switches(args, test_args, perf_report, outcomes)
+
+        if cache is not None:
+            cache.record(outcomes)
+            # Only the tests selected by the specs are checked with this
+            # pipeline, the others keep their base.
+            cache.update_bases(considered, tests, outcomes)
+            cache.save()
 
         if not success:
             sys.exit(3)
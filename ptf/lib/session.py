@@ -0,0 +1,308 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import atexit
+import logging
+import Queue
+import threading
+import time
+from collections import deque
+
+import grpc
+from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
+
+from perf import RECORDER
+
+logger = logging.getLogger("P4RuntimeSession")
+
+# (grpc address, device id) -> P4RuntimeSession
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Phases recorded with record_timing, e.g. "setUp"
+_phases = set()
+
+# Kinds of StreamMessageResponse, i.e. the fields of its "update" oneof.
+STREAM_KINDS = ("packet", "arbitration", "digest", "idle_timeout_notification",
+                "error", "other")
+
+# Max number of messages of each kind kept by a StreamDispatcher.
+DEFAULT_QUEUE_CAPACITY = 10000
+
+
+class StreamDispatcher(object):
+    """
+    Routes StreamMessageResponse messages to one queue per kind (see
+    STREAM_KINDS), so that waiting for a message of one kind never drops or
+    delays messages of other kinds. When a queue is full, its oldest message
+    is dropped and counted in overflows. Consumers can also subscribe a
+    callback to a kind: its messages are then passed to the callbacks, from
+    the stream receiver thread, instead of being queued.
+    """
+
+    def __init__(self, capacity=DEFAULT_QUEUE_CAPACITY):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._conds = {}
+        self._callbacks = {}
+        for kind in STREAM_KINDS:
+            self._queues[kind] = deque()
+            # One condition per kind, so that a burst of messages of one
+            # kind only wakes up the consumers of that kind.
+            self._conds[kind] = threading.Condition(self._lock)
+            self._callbacks[kind] = []
+        self.received = dict.fromkeys(STREAM_KINDS, 0)
+        self.overflows = dict.fromkeys(STREAM_KINDS, 0)
+
+    def put(self, msg):
+        kind = msg.WhichOneof("update")
+        if kind not in self._queues:
+            kind = "other"
+        callbacks = self._callbacks[kind]
+        with self._lock:
+            self.received[kind] += 1
+            if not callbacks:
+                queue = self._queues[kind]
+                queue.append(msg)
+                if len(queue) > self.capacity:
+                    queue.popleft()
+                    self.overflows[kind] += 1
+                self._conds[kind].notify()
+                return
+        for callback in callbacks:
+            try:
+                callback(msg)
+            except Exception:
+                # Keep the receiver thread and the other subscribers going.
+                logger.exception("Error in %s callback %r", kind, callback)
+
+    def get(self, kind, timeout=None):
+        """
+        Returns the oldest message of the given kind, waiting up to timeout
+        seconds (forever if None) for one. Returns None on timeout.
+        """
+        queue = self._queues[kind]
+        cond = self._conds[kind]
+        with self._lock:
+            if timeout is None:
+                while not queue:
+                    cond.wait()
+            else:
+                deadline = time.time() + timeout
+                while not queue:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    cond.wait(remaining)
+            return queue.popleft()
+
+    def subscribe(self, kind, callback):
+        """
+        Passes the next messages of the given kind to callback(msg). Messages
+        already queued are still returned by get().
+        """
+        with self._lock:
+            self._callbacks[kind] = self._callbacks[kind] + [callback]
+
+    def unsubscribe(self, kind, callback):
+        with self._lock:
+            callbacks = list(self._callbacks[kind])
+            callbacks.remove(callback)
+            self._callbacks[kind] = callbacks
+
+    def flush(self, kind=None):
+        """
+        Drops the queued messages of the given kind (all kinds if None).
+        Returns the number of dropped messages.
+        """
+        kinds = STREAM_KINDS if kind is None else (kind,)
+        count = 0
+        with self._lock:
+            for k in kinds:
+                count += len(self._queues[k])
+                self._queues[k].clear()
+        return count
+
+
+class P4RuntimeSession(object):
+    """
+    gRPC channel and StreamChannel to a P4Runtime server, shared by all the
+    tests of a process (see get_session). The stream is reopened and
+    arbitration is done again only when the stream is down or the election
+    id changes.
+    """
+
+    def __init__(self, grpc_addr, device_id):
+        self.grpc_addr = grpc_addr
+        self.device_id = device_id
+        self.channel = grpc.insecure_channel(grpc_addr)
+        self.stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+        self.stream = None
+        self.stream_out_q = None
+        self.stream_recv_thread = None
+        # Messages received on the stream, kept across stream reconnections.
+        self.dispatcher = StreamDispatcher()
+        # Election id of the last successful arbitration on the stream.
+        self.election_id = None
+
+    def _open_stream(self):
+        stream_out_q = Queue.Queue()
+        dispatcher = self.dispatcher
+
+        def stream_req_iterator():
+            while True:
+                p = stream_out_q.get()
+                if p is None:
+                    break
+                if isinstance(p, p4runtime_pb2.StreamMessageRequest):
+                    yield p
+                else:
+                    # Burst of requests, see send_burst.
+                    for req in p:
+                        yield req
+
+        def stream_recv(stream):
+            try:
+                for p in stream:
+                    dispatcher.put(p)
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.CANCELLED:
+                    logger.warning("StreamChannel to %s closed: %s",
+                                   self.grpc_addr, e.details())
+            except Exception:
+                logger.exception("StreamChannel receiver for %s stopped",
+                                 self.grpc_addr)
+
+        self.stream_out_q = stream_out_q
+        self.stream = self.stub.StreamChannel(stream_req_iterator())
+        self.stream_recv_thread = threading.Thread(
+            target=stream_recv, args=(self.stream,))
+        self.stream_recv_thread.daemon = True
+        self.stream_recv_thread.start()
+        self.election_id = None
+
+    def _close_stream(self):
+        if self.stream is None:
+            return
+        self.stream_out_q.put(None)
+        self.stream.cancel()
+        self.stream_recv_thread.join()
+        self.stream = None
+        self.election_id = None
+
+    def is_stream_up(self):
+        return self.stream_recv_thread is not None \
+               and self.stream_recv_thread.is_alive()
+
+    def arbitrate(self, election_id, timeout=2):
+        """
+        Makes sure the stream is up with the given election id, sending a
+        MasterArbitrationUpdate only when needed. Returns False if the
+        server did not reply to the arbitration request.
+        """
+        if self.is_stream_up() and self.election_id == election_id:
+            return True
+        if not self.is_stream_up():
+            self._close_stream()
+            self._open_stream()
+        # Drop replies to previous arbitration requests.
+        self.dispatcher.flush("arbitration")
+        req = p4runtime_pb2.StreamMessageRequest()
+        arbitration = req.arbitration
+        arbitration.device_id = self.device_id
+        arbitration.election_id.high = 0
+        arbitration.election_id.low = election_id
+        self.stream_out_q.put(req)
+
+        if self.dispatcher.get("arbitration", timeout) is None:
+            return False
+        self.election_id = election_id
+        return True
+
+    def send_burst(self, burst):
+        """
+        Queues an iterable of StreamMessageRequest (e.g. a
+        burst.PacketOutBurst) to be sent on the stream. It is iterated by the
+        gRPC thread sending the requests, which serializes each request
+        before getting the next one, so the same message can be yielded
+        again after being modified.
+        """
+        self.stream_out_q.put(burst)
+
+    def flush(self):
+        """
+        Drops the stream messages received and not consumed, e.g. by a
+        previous test. Returns the number of dropped messages.
+        """
+        return self.dispatcher.flush()
+
+    def close(self):
+        self._close_stream()
+        self.channel.close()
+
+
+def get_session(grpc_addr, device_id):
+    """
+    Returns the session for the given server and device, creating it on the
+    first call.
+    """
+    key = (grpc_addr, device_id)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = P4RuntimeSession(grpc_addr, device_id)
+        return session
+
+
+def close_session(grpc_addr, device_id):
+    with _sessions_lock:
+        session = _sessions.pop((grpc_addr, device_id), None)
+    if session is not None:
+        session.close()
+
+
+@atexit.register
+def close_all():
+    with _sessions_lock:
+        sessions = _sessions.values()
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+    for phase, stats in sorted(timings().iteritems()):
+        logger.info("%s: %d calls, avg %.3f s, max %.3f s, total %.3f s",
+                    phase, stats["count"], stats["avg"], stats["max"],
+                    stats["total"])
+
+
+def record_timing(phase, seconds):
+    _phases.add(phase)
+    RECORDER.record(phase, seconds)
+
+
+def timings():
+    """
+    Returns {phase: {"count", "total", "avg", "max"}} for the durations
+    recorded with record_timing, e.g. test setUp and tearDown.
+    """
+    stats = {}
+    for phase in _phases:
+        hist = RECORDER.operations[phase]
+        stats[phase] = {
+            "count": hist.count,
+            "total": hist.total,
+            "avg": hist.total / hist.count,
+            "max": hist.max,
+        }
+    return stats
@@ -4,13 +4,39 @@ set -xe
 
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 
+# Several instances can run side by side (see runner.py --shards), each with
+# its own gRPC port, veths (veth<16*INSTANCE>..veth<16*INSTANCE+15>),
+# chassis config and persistent config dir.
+INSTANCE=${INSTANCE:-0}
+
 CPU_PORT=255
-GRPC_PORT=28000
+GRPC_PORT=$((28000 + INSTANCE))
+LOCAL_PORT=$((44400 + INSTANCE))
+VETH_BASE=$((INSTANCE * 16))
+
+if [ "${INSTANCE}" -eq 0 ]; then
+    CHASSIS_CONFIG="${DIR}"/chassis_config.pb.txt
+    PERSISTENT_DIR=/tmp
+    LOG_SUFFIX=""
+else
+    PERSISTENT_DIR=/tmp/bmv2-${INSTANCE}
+    CHASSIS_CONFIG=${PERSISTENT_DIR}/chassis_config.pb.txt
+    LOG_SUFFIX="-${INSTANCE}"
+    mkdir -p "${PERSISTENT_DIR}"
+    # Same ports as instance 0, on this instance's veths.
+    awk -v base=${VETH_BASE} '
+        match($0, /"veth[0-9]+"/) {
+            idx = substr($0, RSTART + 5, RLENGTH - 6)
+            $0 = substr($0, 1, RSTART - 1) "\"veth" (idx + base) "\"" \
+                 substr($0, RSTART + RLENGTH)
+        }
+        { print }' "${DIR}"/chassis_config.pb.txt > "${CHASSIS_CONFIG}"
+fi
 
 # Create veths
 for idx in 0 1 2 3 4 5 6 7; do
-    intf0="veth$(($idx*2))"
-    intf1="veth$(($idx*2+1))"
+    intf0="veth$((VETH_BASE + idx*2))"
+    intf1="veth$((VETH_BASE + idx*2+1))"
     if ! ip link show $intf0 &> /dev/null; then
         ip link add name $intf0 type veth peer name $intf1
         ip link set dev $intf0 up
@@ -40,11 +66,12 @@ done
 # shellcheck disable=SC2086
 stratum_bmv2 \
     --external_stratum_urls=0.0.0.0:${GRPC_PORT} \
-    --persistent_config_dir=/tmp \
+    --local_stratum_url=localhost:${LOCAL_PORT} \
+    --persistent_config_dir=${PERSISTENT_DIR} \
     --forwarding_pipeline_configs_file=/dev/null \
-    --chassis_config_file="${DIR}"/chassis_config.pb.txt \
-    --write_req_log_file=p4rt_write.log \
+    --chassis_config_file="${CHASSIS_CONFIG}" \
+    --write_req_log_file=p4rt_write${LOG_SUFFIX}.log \
     --initial_pipeline=/root/dummy.json \
     --bmv2_log_level=trace \
-    --cpu_port 255 \
-    > stratum_bmv2.log 2>&1
+    --cpu_port ${CPU_PORT} \
+    > stratum_bmv2${LOG_SUFFIX}.log 2>&1
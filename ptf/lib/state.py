@@ -0,0 +1,278 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import struct
+
+from p4.v1 import p4runtime_pb2
+
+"""
+Canonical keys for P4Runtime table entries, and an in-memory index of table
+entries keyed by them, to dedupe and diff large sets of entries without
+comparing protobuf messages.
+"""
+
+_MATCH_KINDS = {
+    "exact": 1,
+    "ternary": 2,
+    "lpm": 3,
+    "range": 4,
+    "optional": 5,
+}
+
+# TableEntry fields, other than the action, that are part of the desired
+# state of an entry (i.e. a change requires a MODIFY).
+_VALUE_FIELDS = ("controller_metadata", "meter_config", "idle_timeout_ns",
+                 "metadata")
+
+
+def _bytes(value):
+    # Strip leading zeros as in the P4Runtime canonical representation, so
+    # that padded and canonical values give the same key.
+    value = value.lstrip('\x00')
+    return struct.pack('>H', len(value)) + value
+
+
+def _unpack_bytes(packed, offset):
+    # Inverse of _bytes(), returns (canonical value, next offset). Zero is
+    # canonically a single zero byte.
+    length, = struct.unpack_from('>H', packed, offset)
+    offset += 2
+    return packed[offset:offset + length] or '\x00', offset + length
+
+
+def table_entry_key(entry):
+    """
+    Returns the canonical key of a TableEntry, as a byte string: table id,
+    match fields sorted by id with canonical values, priority and default
+    action flag. Two entries have the same key iff they are the same entry
+    for the P4Runtime server.
+    """
+    parts = [struct.pack('>IiB', entry.table_id, entry.priority,
+                         entry.is_default_action)]
+    for m in sorted(entry.match, key=lambda m: m.field_id):
+        kind = m.WhichOneof("field_match_type")
+        if kind is None:
+            raise ValueError("Match field %d of table %d has no match type"
+                             % (m.field_id, entry.table_id))
+        parts.append(struct.pack('>IB', m.field_id, _MATCH_KINDS[kind]))
+        if kind == "exact":
+            parts.append(_bytes(m.exact.value))
+        elif kind == "ternary":
+            parts.append(_bytes(m.ternary.value) + _bytes(m.ternary.mask))
+        elif kind == "lpm":
+            parts.append(_bytes(m.lpm.value)
+                         + struct.pack('>i', m.lpm.prefix_len))
+        elif kind == "range":
+            parts.append(_bytes(m.range.low) + _bytes(m.range.high))
+        else:
+            parts.append(_bytes(m.optional.value))
+    return ''.join(parts)
+
+
+def table_entry_value(entry):
+    """
+    Returns a byte string identifying the action (and other non-key fields)
+    of a TableEntry: two entries with the same key need a MODIFY iff their
+    values differ. table_entry(key, value) rebuilds the entry.
+    """
+    action_type = entry.action.WhichOneof("type")
+    if action_type == "action":
+        action = entry.action.action
+        parts = [struct.pack('>BIH', 1, action.action_id,
+                             len(action.params))]
+        for p in sorted(action.params, key=lambda p: p.param_id):
+            parts.append(struct.pack('>I', p.param_id) + _bytes(p.value))
+    elif action_type == "action_profile_member_id":
+        parts = [struct.pack('>BI', 2, entry.action.action_profile_member_id)]
+    elif action_type == "action_profile_group_id":
+        parts = [struct.pack('>BI', 3, entry.action.action_profile_group_id)]
+    elif action_type is not None:
+        action = entry.action.SerializeToString()
+        parts = [struct.pack('>BI', 4, len(action)), action]
+    else:
+        parts = ['\x00']
+    # The other fields of the desired state follow as a serialized
+    # TableEntry holding only them.
+    rest = None
+    for field, value in entry.ListFields():
+        if field.name in _VALUE_FIELDS:
+            if rest is None:
+                rest = p4runtime_pb2.TableEntry()
+            if field.type == field.TYPE_MESSAGE:
+                getattr(rest, field.name).CopyFrom(value)
+            else:
+                setattr(rest, field.name, value)
+    if rest is not None:
+        parts.append(rest.SerializeToString())
+    return ''.join(parts)
+
+
+def table_entry(key, value):
+    """
+    Returns the TableEntry with the given table_entry_key() and
+    table_entry_value(). Byte strings are in canonical form, and fields that
+    are not part of the key or value (e.g. counter data) are not set.
+    """
+    entry = p4runtime_pb2.TableEntry()
+    entry.table_id, entry.priority, is_default_action = \
+        struct.unpack_from('>IiB', key)
+    entry.is_default_action = bool(is_default_action)
+    offset = 9
+    while offset < len(key):
+        m = entry.match.add()
+        m.field_id, kind = struct.unpack_from('>IB', key, offset)
+        offset += 5
+        if kind == 1:
+            m.exact.value, offset = _unpack_bytes(key, offset)
+        elif kind == 2:
+            m.ternary.value, offset = _unpack_bytes(key, offset)
+            m.ternary.mask, offset = _unpack_bytes(key, offset)
+        elif kind == 3:
+            m.lpm.value, offset = _unpack_bytes(key, offset)
+            m.lpm.prefix_len, = struct.unpack_from('>i', key, offset)
+            offset += 4
+        elif kind == 4:
+            m.range.low, offset = _unpack_bytes(key, offset)
+            m.range.high, offset = _unpack_bytes(key, offset)
+        else:
+            m.optional.value, offset = _unpack_bytes(key, offset)
+
+    action_type = ord(value[0])
+    if action_type == 1:
+        action = entry.action.action
+        action.action_id, num_params = struct.unpack_from('>IH', value, 1)
+        offset = 7
+        for _ in xrange(num_params):
+            p = action.params.add()
+            p.param_id, = struct.unpack_from('>I', value, offset)
+            p.value, offset = _unpack_bytes(value, offset + 4)
+    elif action_type == 2:
+        entry.action.action_profile_member_id, = \
+            struct.unpack_from('>I', value, 1)
+        offset = 5
+    elif action_type == 3:
+        entry.action.action_profile_group_id, = \
+            struct.unpack_from('>I', value, 1)
+        offset = 5
+    elif action_type == 4:
+        length, = struct.unpack_from('>I', value, 1)
+        offset = 5 + length
+        entry.action.MergeFromString(value[5:offset])
+    else:
+        offset = 1
+    if offset < len(value):
+        entry.MergeFromString(value[offset:])
+    return entry
+
+
+class TableEntryIndex(object):
+    """
+    Set of table entries keyed by table_entry_key(). Only the
+    table_entry_value() of each entry is stored next to its key, not a
+    protobuf message, to keep millions of entries in memory. Entries are
+    rebuilt by table_entry() when returned.
+    """
+
+    def __init__(self, entries=()):
+        # table_entry_key() -> table_entry_value()
+        self._entries = {}
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, entry_or_key):
+        return self._key(entry_or_key) in self._entries
+
+    def __iter__(self):
+        for key, value in self._entries.iteritems():
+            yield table_entry(key, value)
+
+    @staticmethod
+    def _key(entry_or_key):
+        if isinstance(entry_or_key, str):
+            return entry_or_key
+        return table_entry_key(entry_or_key)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def add(self, entry):
+        """
+        Adds an entry, replacing any entry with the same key. Returns the key.
+        """
+        key = table_entry_key(entry)
+        self._entries[key] = table_entry_value(entry)
+        return key
+
+    def remove(self, entry_or_key):
+        """
+        Removes an entry (given as a TableEntry or its key), returns True if
+        it was in the index.
+        """
+        return self._entries.pop(self._key(entry_or_key), None) is not None
+
+    def lookup(self, entry_or_key):
+        """
+        Returns the TableEntry in the index with the same key, or None.
+        """
+        key = self._key(entry_or_key)
+        value = self._entries.get(key)
+        if value is None:
+            return None
+        return table_entry(key, value)
+
+    def apply(self, update_type, entry):
+        """
+        Updates the index after the given update was written to the switch.
+        """
+        if update_type == p4runtime_pb2.Update.DELETE:
+            self.remove(entry)
+        else:
+            self.add(entry)
+
+    def diff(self, desired):
+        """
+        Generator of (update type, TableEntry) tuples that bring the entries
+        in this index to the ones in the desired index: DELETEs first, then
+        MODIFYs and INSERTs. Default entries are never inserted or deleted:
+        they are modified, or reset by a MODIFY without action.
+        """
+        current = self._entries
+        target = desired._entries
+        for key, value in current.iteritems():
+            if key in target:
+                continue
+            entry = table_entry(key, value)
+            if entry.is_default_action:
+                reset = p4runtime_pb2.TableEntry()
+                reset.table_id = entry.table_id
+                reset.is_default_action = True
+                yield p4runtime_pb2.Update.MODIFY, reset
+            else:
+                yield p4runtime_pb2.Update.DELETE, entry
+        inserts = []
+        for key, value in target.iteritems():
+            old_value = current.get(key)
+            if old_value is None:
+                # Byte 8 of the key is the is_default_action flag.
+                if ord(key[8]):
+                    yield p4runtime_pb2.Update.MODIFY, table_entry(key, value)
+                else:
+                    inserts.append(key)
+            elif old_value != value:
+                yield p4runtime_pb2.Update.MODIFY, table_entry(key, value)
+        for key in inserts:
+            yield p4runtime_pb2.Update.INSERT, table_entry(key, target[key])
@@ -0,0 +1,354 @@
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import ast
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from google.protobuf import descriptor
+
+from helper import load_p4info
+
+"""
+Test result cache and change-based test selection for runner.py.
+
+ResultCache remembers the test classes that passed, keyed by the hashes of
+everything the result depends on: the BMv2 JSON, the P4Info, the test module
+and the PTF support library. It also keeps, for each test class, the last
+pipeline the test was checked with (its base). changed_names() diffs a base
+with the current pipeline, and select_changed() returns the test groups
+referencing the changed tables, actions, etc. by name.
+"""
+
+LIB_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RESULTS_FILE = "results.json"
+# Pipelines used as bases, in BASES_DIR/<pipeline hash>/.
+BASES_DIR = "bases"
+BASE_P4INFO_FILE = "p4info.txt"
+BASE_BMV2_JSON_FILE = "bmv2.json"
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def lib_hash(lib_dir=LIB_DIR):
+    """
+    Returns the hash of the Python modules of the PTF support library
+    (base_test.py, helper.py and the modules they use).
+    """
+    h = hashlib.sha256()
+    for filename in sorted(os.listdir(lib_dir)):
+        if filename.endswith(".py"):
+            h.update(filename)
+            h.update(file_hash(os.path.join(lib_dir, filename)))
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Test classes ("module.Class") that passed, with the key of the run. A
+    test with a cached pass for the current key doesn't need to run again.
+    The cache directory also keeps the P4Info and BMv2 JSON each test class
+    was last checked with, its base for changed_names().
+    """
+
+    def __init__(self, cache_dir, p4info_path, bmv2_json_path, ptfdir):
+        self.cache_dir = cache_dir
+        self.p4info_path = p4info_path
+        self.bmv2_json_path = bmv2_json_path
+        self.ptfdir = ptfdir
+        pipeline = "%s:%s" % (file_hash(bmv2_json_path),
+                              file_hash(p4info_path))
+        self._pipeline_key = "%s:%s" % (pipeline, lib_hash())
+        self._base_id = hashlib.sha256(pipeline).hexdigest()
+        self._module_hashes = {}
+        self.passed = {}
+        # "module.Class" -> base id
+        self.bases = {}
+        path = os.path.join(cache_dir, RESULTS_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                results = json.load(f)
+            self.passed = results.get("passed", {})
+            self.bases = results.get("bases", {})
+
+    def key(self, test):
+        module = test.split(".")[0]
+        module_hash = self._module_hashes.get(module)
+        if module_hash is None:
+            module_hash = self._module_hashes[module] = file_hash(
+                os.path.join(self.ptfdir, module + ".py"))
+        return hashlib.sha256("%s:%s" % (
+            self._pipeline_key, module_hash)).hexdigest()
+
+    def has_passed(self, test):
+        return self.passed.get(test) == self.key(test)
+
+    def record(self, outcomes):
+        """
+        Records the outcomes of a run, as {test id: "ok", "fail", "error" or
+        "skip"}. Only passes are cached.
+        """
+        for test_id, outcome in outcomes.iteritems():
+            # "module.Class.runTest" -> "module.Class"
+            test = test_id.rsplit(".", 1)[0]
+            if outcome == "ok":
+                self.passed[test] = self.key(test)
+            else:
+                self.passed.pop(test, None)
+
+    def update_bases(self, tests, ran=(), outcomes=None):
+        """
+        Makes the current pipeline the base of the given tests, except the
+        ones that ran (in ran) without passing: tests that were not run had a
+        cached pass, or were not affected by the changes since their base.
+        """
+        passed = set(test_id.rsplit(".", 1)[0]
+                     for test_id, outcome in (outcomes or {}).iteritems()
+                     if outcome == "ok")
+        ran = set(ran)
+        for test in tests:
+            if test not in ran or test in passed:
+                self.bases[test] = self._base_id
+
+    def _base_dir(self, base_id):
+        return os.path.join(self.cache_dir, BASES_DIR, base_id)
+
+    def save(self):
+        """
+        Writes the cache, with the pipelines used as bases.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        base_dir = self._base_dir(self._base_id)
+        if self._base_id in self.bases.values() \
+                and not os.path.isdir(base_dir):
+            tmp_dir = "%s.%d.tmp" % (base_dir, os.getpid())
+            os.makedirs(tmp_dir)
+            shutil.copyfile(self.p4info_path,
+                            os.path.join(tmp_dir, BASE_P4INFO_FILE))
+            shutil.copyfile(self.bmv2_json_path,
+                            os.path.join(tmp_dir, BASE_BMV2_JSON_FILE))
+            os.rename(tmp_dir, base_dir)
+        path = os.path.join(self.cache_dir, RESULTS_FILE)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"passed": self.passed, "bases": self.bases}, f,
+                      indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+        # Pipelines not used as base by any test anymore.
+        used = set(self.bases.values())
+        bases_dir = os.path.join(self.cache_dir, BASES_DIR)
+        for base_id in os.listdir(bases_dir) \
+                if os.path.isdir(bases_dir) else ():
+            if base_id not in used and not base_id.endswith(".tmp"):
+                shutil.rmtree(self._base_dir(base_id), ignore_errors=True)
+
+    def base_paths(self, test):
+        """
+        Returns the P4Info and BMv2 JSON paths of the base of the given test,
+        or None if it has none.
+        """
+        base_id = self.bases.get(test)
+        if base_id is None:
+            return None
+        base_dir = self._base_dir(base_id)
+        paths = (os.path.join(base_dir, BASE_P4INFO_FILE),
+                 os.path.join(base_dir, BASE_BMV2_JSON_FILE))
+        return paths if all(os.path.exists(p) for p in paths) else None
+
+
+def _named_entities(p4info):
+    """
+    Returns {name: (kind, message)} for the P4Info entities with a preamble
+    (tables, actions, action profiles, counters, ...).
+    """
+    entities = {}
+    for field in p4info.DESCRIPTOR.fields:
+        if field.label != descriptor.FieldDescriptor.LABEL_REPEATED \
+                or field.message_type is None \
+                or "preamble" not in field.message_type.fields_by_name:
+            continue
+        for entity in getattr(p4info, field.name):
+            entities[entity.preamble.name] = (field.name, entity)
+    return entities
+
+
+def _strip_source_info(obj):
+    # Source locations change with unrelated edits of the P4 program.
+    if isinstance(obj, dict):
+        return {k: _strip_source_info(v) for k, v in obj.iteritems()
+                if k != "source_info"}
+    if isinstance(obj, list):
+        return [_strip_source_info(v) for v in obj]
+    return obj
+
+
+def _changed_actions(old_bmv2_json_path, new_bmv2_json_path):
+    """
+    Returns the names of the actions whose body changed in the BMv2 JSON, or
+    None if anything else than action bodies changed (parser, control flow,
+    ...).
+    """
+    with open(old_bmv2_json_path) as f:
+        old = _strip_source_info(json.load(f))
+    with open(new_bmv2_json_path) as f:
+        new = _strip_source_info(json.load(f))
+    old_actions = {a["name"]: a for a in old.pop("actions", [])}
+    new_actions = {a["name"]: a for a in new.pop("actions", [])}
+    if old != new:
+        return None
+    return set(name for name in set(old_actions) | set(new_actions)
+               if old_actions.get(name) != new_actions.get(name))
+
+
+def changed_names(old_p4info_path, old_bmv2_json_path, new_p4info_path,
+                  new_bmv2_json_path):
+    """
+    Returns the names (and aliases) of the P4Info entities that changed
+    between the two pipelines: entities added, removed or modified in the
+    P4Info, actions whose body changed in the BMv2 JSON, and the tables
+    referencing these actions or their direct resources. Returns None if the
+    change can't be narrowed down to named entities (e.g. a parser or
+    PacketIn/Out metadata change), in which case all tests are affected.
+    """
+    old = _named_entities(load_p4info(old_p4info_path).p4info)
+    new = _named_entities(load_p4info(new_p4info_path).p4info)
+    changed = set(name for name in set(old) | set(new)
+                  if old.get(name) != new.get(name))
+    if any((old.get(name) or new.get(name))[0] == "controller_packet_metadata"
+           for name in changed):
+        return None
+    actions = _changed_actions(old_bmv2_json_path, new_bmv2_json_path)
+    if actions is None:
+        return None
+    for name in actions:
+        if name not in new and name not in old:
+            # Compiler-generated action, not visible to tests.
+            return None
+        changed.add(name)
+
+    entities = dict(old)
+    entities.update(new)
+    ids = {entity.preamble.id: name
+           for name, (_, entity) in entities.iteritems()}
+    names = set(changed)
+    for name, (kind, entity) in entities.iteritems():
+        if kind == "tables" and any(ids.get(ref.id) in changed
+                                    for ref in entity.action_refs):
+            names.add(name)
+        elif kind in ("direct_counters", "direct_meters") \
+                and name in changed and entity.direct_table_id in ids:
+            names.add(ids[entity.direct_table_id])
+    for name in list(names):
+        if entities[name][1].preamble.alias:
+            names.add(entities[name][1].preamble.alias)
+    return names
+
+
+def _pattern(literal):
+    # "IngressPipeImpl.srv6_t_insert_%d" matches any srv6_t_insert action.
+    parts = re.split(r"%[-#0 +]*\d*(?:\.\d+)?[sdifrxX]|\{[^}]*\}", literal)
+    return re.compile("^%s$" % ".*".join(re.escape(p) for p in parts))
+
+
+def _strings(node):
+    return set(n.s for n in ast.walk(node) if isinstance(n, ast.Str))
+
+
+def _base_classes(node, classes):
+    # node and its base classes defined in the same module, given as
+    # {name: ast.ClassDef}.
+    found = []
+    pending = [node]
+    while pending:
+        cls = pending.pop()
+        if cls in found:
+            continue
+        found.append(cls)
+        pending.extend(classes[b.id] for b in cls.bases
+                       if isinstance(b, ast.Name) and b.id in classes)
+    return found
+
+
+def defines_run_test(node, classes):
+    """
+    Returns True if the class defines runTest, or inherits it from a base
+    class defined in the same module (classes, as {name: ast.ClassDef}).
+    """
+    return any(isinstance(n, ast.FunctionDef) and n.name == "runTest"
+               for cls in _base_classes(node, classes) for n in cls.body)
+
+
+def referenced_literals(ptfdir):
+    """
+    Returns {"module.Class": (groups, string literals)} for the test classes
+    in ptfdir. The literals of a class are the ones in its body, in the
+    bodies of its base classes defined in the same module, and outside of
+    classes in the module (constants and helper functions).
+    """
+    tests = {}
+    for filename in sorted(os.listdir(ptfdir)):
+        if not filename.endswith(".py"):
+            continue
+        module = filename[:-3]
+        with open(os.path.join(ptfdir, filename)) as f:
+            tree = ast.parse(f.read(), filename)
+        classes = dict((n.name, n) for n in tree.body
+                       if isinstance(n, ast.ClassDef))
+        module_strings = set()
+        for node in tree.body:
+            if not isinstance(node, ast.ClassDef):
+                module_strings |= _strings(node)
+        for name, node in classes.iteritems():
+            if not defines_run_test(node, classes):
+                continue
+            strings = set(module_strings)
+            for cls in _base_classes(node, classes):
+                strings |= _strings(cls)
+            groups = set()
+            for dec in node.decorator_list:
+                if isinstance(dec, ast.Call) \
+                        and getattr(dec.func, "id", None) == "group":
+                    groups |= _strings(dec)
+            tests["%s.%s" % (module, name)] = (groups, strings)
+    return tests
+
+
+def select_changed(ptfdir, tests, names):
+    """
+    Returns the tests, among the given ones, in the groups (as given by
+    @group, or the test itself if it has none) of the tests referencing any
+    of the given names. Literals with format specifiers ("..._%d") match the
+    names they can be formatted to.
+    """
+    literals = referenced_literals(ptfdir)
+    affected_groups = set()
+    for test, (groups, strings) in literals.iteritems():
+        patterns = [_pattern(s) for s in strings if "%" in s or "{" in s]
+        if any(s in names for s in strings) or any(
+                p.match(name) for p in patterns for name in names):
+            affected_groups |= groups or set([test])
+    return [test for test in tests
+            if test in affected_groups
+            or literals.get(test, (set(), None))[0] & affected_groups]
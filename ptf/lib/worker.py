@@ -0,0 +1,484 @@
+#!/usr/bin/env python2
+
+# Copyright 2019-present Open Networking Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Long-lived PTF worker, to iterate on tests without paying for the PTF
+# startup (imports, dataplane, P4Info parsing, pipeline push, gRPC session)
+# on each run:
+#     ./lib/worker.py serve --p4info /p4c-out/p4info.txt \
+#         --bmv2-json /p4c-out/bmv2.json --grpc-addr localhost:28000 \
+#         --cpu-port 255 --ptf-dir ./tests --port-map ./lib/port_map.json &
+#     ./lib/worker.py run bridging packetio.PacketOutTest
+# Test modules are reloaded and the pipeline config is pushed again if it
+# changed before each run. Changes to the modules in lib need a restart:
+#     ./lib/worker.py shutdown
+# runner.py --worker starts the worker if needed and runs the tests on it.
+#
+# Requests and replies are JSON lines on a Unix socket. The client side only
+# uses the standard library, the PTF and P4Runtime modules are imported by
+# the worker process.
+#
+import argparse
+import json
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+DEFAULT_SOCKET = "/tmp/ptf-worker.sock"
+
+# Max size of a request line.
+MAX_REQUEST_BYTES = 1024 * 1024
+
+# Seconds for a client to send its request.
+REQUEST_TIMEOUT = 5.0
+
+# PTF options without a value, the others can take the next argument.
+PTF_FLAGS = frozenset(["--failfast", "--relax", "--list", "--list-test-names",
+                       "--verbose", "-v", "--quiet", "-q",
+                       "--disable-ipv6", "--disable-vxlan", "--disable-erspan",
+                       "--disable-geneve", "--disable-mpls",
+                       "--disable-nvgre"])
+
+
+class WorkerError(Exception):
+    pass
+
+
+def _send_line(sock, msg):
+    sock.sendall(json.dumps(msg) + "\n")
+
+
+def _parse_line(line):
+    if not line.endswith("\n"):
+        raise WorkerError("Truncated message")
+    return json.loads(line)
+
+
+def _recv_line(sock_file, max_bytes=None):
+    line = sock_file.readline(max_bytes) if max_bytes else \
+        sock_file.readline()
+    return _parse_line(line)
+
+
+def request(socket_path, msg, timeout=None):
+    """
+    Sends a request to the worker listening on socket_path and returns the
+    reply. Raises socket.error if no worker is listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        _send_line(sock, msg)
+        reply = _recv_line(sock.makefile("r"))
+    finally:
+        sock.close()
+    if "error" in reply:
+        raise WorkerError(reply["error"])
+    return reply
+
+
+def is_running(socket_path):
+    try:
+        request(socket_path, {"op": "ping"}, timeout=1)
+        return True
+    except socket.timeout:
+        # Busy, but listening.
+        return True
+    except (socket.error, WorkerError):
+        return False
+
+
+def _accepts_connections(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(1)
+    try:
+        sock.connect(socket_path)
+        return True
+    except socket.timeout:
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+class TimedResult(unittest.TextTestResult):
+    """
+    TextTestResult also recording the duration of each test, as a list of
+    (test id, seconds).
+    """
+
+    def __init__(self, stream, descriptions, verbosity):
+        super(TimedResult, self).__init__(
+            unittest.runner._WritelnDecorator(stream), descriptions,
+            verbosity)
+        self.seconds = []
+        self._start = None
+
+    def startTest(self, test):
+        self._start = time.time()
+        super(TimedResult, self).startTest(test)
+
+    def stopTest(self, test):
+        super(TimedResult, self).stopTest(test)
+        self.seconds.append((test.id(), time.time() - self._start))
+
+
+class PtfWorker(object):
+    """
+    Runs PTF tests in-process on request, keeping the PTF dataplane, the
+    P4Runtime session (see session.get_session) and the parsed P4Info across
+    runs.
+    """
+
+    def __init__(self, p4info_path, bmv2_json_path, grpc_addr, device_id,
+                 cpu_port, ptfdir, port_map_path, perf_report=None):
+        self.p4info_path = os.path.abspath(p4info_path)
+        self.bmv2_json_path = os.path.abspath(bmv2_json_path)
+        self.grpc_addr = grpc_addr
+        self.device_id = device_id
+        self.cpu_port = cpu_port
+        self.ptfdir = os.path.abspath(ptfdir)
+        self.port_map_path = port_map_path
+        self.perf_report = perf_report
+        self._cookie = None
+        self._modules = {}
+        self.runs = 0
+
+    def start(self, ready_timeout):
+        """
+        Waits for the switch, pushes the pipeline config and starts the PTF
+        dataplane.
+        """
+        import ptf
+        import ptf.dataplane
+        import ptf.ptfutils
+        import ptf.testutils
+        from readiness import wait_until_ready
+        from runner import load_port_map, ptf_test_params
+
+        port_map = load_port_map(self.port_map_path)
+        wait_until_ready(self.grpc_addr, self.device_id, port_map.values(),
+                         timeout=ready_timeout)
+        if not self.sync_pipeline():
+            raise WorkerError("Cannot push pipeline config")
+
+        # Same defaults as the ptf command, with the interfaces of the port
+        # map on device 0.
+        ptf.config.update({
+            "platform": "eth",
+            "platform_args": None,
+            "interfaces": [(0, p4_port, iface_name)
+                           for p4_port, iface_name in port_map.items()],
+            "port_map": {(0, p4_port): iface_name
+                         for p4_port, iface_name in port_map.items()},
+            "device_sockets": [],
+            "test_dir": self.ptfdir,
+            "test_params": ptf_test_params(
+                self.p4info_path, self.grpc_addr, self.device_id,
+                self.cpu_port, self.perf_report),
+            "log_file": "ptf.log",
+            "log_dir": None,
+            "relax": False,
+            "failfast": False,
+            "default_timeout": 2.0,
+            "default_negative_timeout": 0.1,
+            "minsize": 0,
+            "qlen": 100,
+            "socket_recv_size": 4096,
+        })
+        ptf.ptfutils.default_timeout = ptf.config["default_timeout"]
+        ptf.ptfutils.default_negative_timeout = \
+            ptf.config["default_negative_timeout"]
+        ptf.testutils.MINSIZE = ptf.config["minsize"]
+        ptf.dataplane_instance = ptf.dataplane.DataPlane(ptf.config)
+        for (device, port), iface_name in ptf.config["port_map"].items():
+            ptf.dataplane_instance.port_add(iface_name, device, port)
+        if self.ptfdir not in sys.path:
+            sys.path.insert(0, self.ptfdir)
+
+    def stop(self):
+        import ptf
+        if ptf.dataplane_instance is not None:
+            ptf.dataplane_instance.kill()
+            ptf.dataplane_instance = None
+
+    def sync_pipeline(self):
+        """
+        Pushes the pipeline config if the P4Info or BMv2 JSON changed since
+        the last push.
+        """
+        from runner import pipeline_cookie, update_config
+        cookie = pipeline_cookie(self.p4info_path, self.bmv2_json_path)
+        if cookie == self._cookie:
+            return True
+        # update_config skips the push if the switch already runs the config.
+        # The session is shared with the tests, keep it open.
+        if not update_config(self.p4info_path, self.bmv2_json_path,
+                             self.grpc_addr, self.device_id, close=False):
+            return False
+        self._cookie = cookie
+        return True
+
+    def _load_tests(self, specs):
+        """
+        Returns a TestSuite with the tests matching specs, reloading their
+        modules to pick up changes since the previous run, and the PTF
+        options in specs (e.g. --test-params=...), as a list of (option,
+        value or None).
+        """
+        from runner import discover_tests, select_tests
+        tests, other = select_tests(discover_tests(self.ptfdir), specs)
+        options = []
+        unknown = []
+        for arg in other:
+            if arg.startswith("-"):
+                option, _, value = arg.partition("=")
+                options.append([option, value or None])
+            elif options and options[-1][1] is None \
+                    and options[-1][0] not in PTF_FLAGS:
+                # Value of the previous option, e.g. "--test-params x=1".
+                options[-1][1] = arg
+            else:
+                unknown.append(arg)
+        if unknown:
+            raise WorkerError("Unknown tests: %s" % " ".join(unknown))
+        loaded = {}
+        suite = unittest.TestSuite()
+        for test in tests:
+            module_name, class_name = test.split(".")
+            module = loaded.get(module_name)
+            if module is None:
+                module = self._modules.get(module_name)
+                module = __import__(module_name) if module is None \
+                    else reload(module)
+                loaded[module_name] = self._modules[module_name] = module
+            suite.addTest(getattr(module, class_name)())
+        return suite, [tuple(o) for o in options]
+
+    def run(self, specs):
+        """
+        Runs the tests matching specs (module, module.Class or group names,
+        all tests if empty). Returns the reply to the client.
+        """
+        start = time.time()
+        self.runs += 1
+        if not self.sync_pipeline():
+            raise WorkerError("Cannot push pipeline config")
+        import ptf
+        suite, options = self._load_tests(specs)
+
+        output = StringIO()
+        result = TimedResult(output, True, 2)
+        test_params = ptf.config["test_params"]
+        extra_params = []
+        ignored = []
+        for option, value in options:
+            if option == "--test-params" and value:
+                extra_params.append(value)
+            elif option == "--failfast":
+                result.failfast = True
+            else:
+                ignored.append(option)
+        if ignored:
+            output.write("Ignoring PTF options not supported by the "
+                         "worker: %s\n" % " ".join(ignored))
+        if extra_params:
+            ptf.config["test_params"] = ";".join([test_params] +
+                                                 extra_params)
+        try:
+            suite.run(result)
+        finally:
+            ptf.config["test_params"] = test_params
+        result.printErrors()
+        statuses = {}
+        for status, tests in (("fail", result.failures),
+                              ("error", result.errors),
+                              ("skip", result.skipped)):
+            for test, _ in tests:
+                statuses[test.id()] = status
+        return {
+            "success": result.wasSuccessful(),
+            "tests": [{"test": test_id,
+                       "status": statuses.get(test_id, "ok"),
+                       "seconds": seconds}
+                      for test_id, seconds in result.seconds],
+            "output": output.getvalue(),
+            "seconds": time.time() - start,
+        }
+
+    def handle(self, msg):
+        op = msg.get("op")
+        if op == "ping":
+            return {"runs": self.runs}
+        if op == "run":
+            return self.run(msg.get("tests", []))
+        if op == "shutdown":
+            return {}
+        raise WorkerError("Unknown op %r" % op)
+
+    def _accept(self, server, requests):
+        # Reads the requests on a separate thread, answering pings right away
+        # so that a worker busy running tests is still seen as running.
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.error:
+                # Server closed.
+                return
+            try:
+                conn.settimeout(REQUEST_TIMEOUT)
+                line = conn.makefile("r").readline(MAX_REQUEST_BYTES)
+                if not line:
+                    # Connection check, see _accepts_connections.
+                    conn.close()
+                    continue
+                msg = _parse_line(line)
+                conn.settimeout(None)
+                if msg.get("op") == "ping":
+                    _send_line(conn, self.handle(msg))
+                    conn.close()
+                else:
+                    requests.put((conn, msg))
+            except (socket.error, ValueError, WorkerError) as e:
+                print >> sys.stderr, "Bad request: %s" % e
+                conn.close()
+
+    def serve(self, socket_path):
+        """
+        Serves requests on socket_path until a shutdown request. Tests are
+        run one request at a time, on the calling thread.
+        """
+        if os.path.exists(socket_path):
+            # Never remove the socket of a live worker, even a busy one.
+            if _accepts_connections(socket_path):
+                raise WorkerError("A worker is already listening on %s"
+                                  % socket_path)
+            os.unlink(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(5)
+        requests = Queue.Queue()
+        accept_thread = threading.Thread(target=self._accept,
+                                         args=(server, requests))
+        accept_thread.daemon = True
+        accept_thread.start()
+        try:
+            while True:
+                conn, msg = requests.get()
+                try:
+                    try:
+                        reply = self.handle(msg)
+                    except Exception as e:
+                        reply = {"error": "%s: %s" % (type(e).__name__, e)}
+                    _send_line(conn, reply)
+                except socket.error as e:
+                    print >> sys.stderr, "Cannot reply: %s" % e
+                finally:
+                    conn.close()
+                if msg.get("op") == "shutdown":
+                    break
+        finally:
+            server.close()
+            os.unlink(socket_path)
+
+
+def run_tests(socket_path, specs):
+    """
+    Runs tests on the worker, printing their output. Returns the reply, with
+    "success" True if all tests passed.
+    """
+    start = time.time()
+    reply = request(socket_path, {"op": "run", "tests": list(specs)})
+    sys.stdout.write(reply["output"])
+    print "Ran %d tests in %.3f s (%.3f s with client)" % (
+        len(reply["tests"]), reply["seconds"], time.time() - start)
+    return reply
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Long-lived PTF worker and its client")
+    parser.add_argument('--socket',
+                        help='Unix socket of the worker',
+                        type=str, default=DEFAULT_SOCKET)
+    subparsers = parser.add_subparsers(dest='command')
+    serve = subparsers.add_parser('serve', help='Start the worker')
+    serve.add_argument('--p4info',
+                       help='Location of p4info proto in text format',
+                       type=str, required=True)
+    serve.add_argument('--bmv2-json',
+                       help='Location BMv2 JSON output from p4c',
+                       type=str, required=True)
+    serve.add_argument('--grpc-addr',
+                       help='Address to use to connect to P4 Runtime server',
+                       type=str, default='localhost:50051')
+    serve.add_argument('--device-id',
+                       help='Device id for device under test',
+                       type=int, default=1)
+    serve.add_argument('--cpu-port',
+                       help='CPU port ID of device under test',
+                       type=int, required=True)
+    serve.add_argument('--ptf-dir',
+                       help='Directory containing PTF tests',
+                       type=str, required=True)
+    serve.add_argument('--port-map',
+                       help='Path to JSON port mapping',
+                       type=str, required=True)
+    serve.add_argument('--ready-timeout',
+                       help='Seconds to wait for the switch to be ready',
+                       type=float, default=30.0)
+    serve.add_argument('--perf-report',
+                       help='Write a latency report of all runs to this '
+                            'file when the worker exits',
+                       type=str, required=False)
+    run = subparsers.add_parser('run', help='Run tests on the worker')
+    run.add_argument('tests', nargs='*',
+                     help='Modules, module.Class or groups to run '
+                          '(default: all)')
+    subparsers.add_parser('shutdown', help='Stop the worker')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'run':
+            reply = run_tests(args.socket, args.tests)
+            sys.exit(0 if reply["success"] else 1)
+        if args.command == 'shutdown':
+            request(args.socket, {"op": "shutdown"})
+            return
+    except (socket.error, WorkerError) as e:
+        print >> sys.stderr, "Worker request failed: %s" % e
+        sys.exit(2)
+
+    worker = PtfWorker(args.p4info, args.bmv2_json, args.grpc_addr,
+                       args.device_id, args.cpu_port, args.ptf_dir,
+                       args.port_map, args.perf_report)
+    worker.start(args.ready_timeout)
+    try:
+        worker.serve(args.socket)
+    finally:
+        worker.stop()
+
+
+if __name__ == '__main__':
+    main()
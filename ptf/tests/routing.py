@@ -131,6 +131,45 @@ class IPv6RoutingTest(P4RuntimeTest):
         testutils.verify_packet(self, exp_pkt, self.port2)
 
 
+@group("routing")
+class EcmpGroupIdReuseTest(P4RuntimeTest):
+    """Tests that the ids of a deleted ECMP group and of its members are
+    allocated again.
+    """
+
+    @autocleanup
+    def runTest(self):
+        act_prof_name = "IngressPipeImpl.ecmp_selector"
+        messages = self.helper.build_act_prof_group(
+            act_prof_name=act_prof_name,
+            group_id=None,
+            actions=[
+                ("IngressPipeImpl.set_next_hop", {"dmac": SWITCH2_MAC}),
+                ("IngressPipeImpl.set_next_hop", {"dmac": SWITCH3_MAC}),
+            ],
+            reuse=True
+        )
+        self.insert(messages)
+        group_id = messages[-1].group_id
+        member_ids = set(m.member_id for m in messages[:-1])
+
+        # Group first, then its members.
+        for entity in self.helper.member_pool.delete_group(act_prof_name,
+                                                           group_id):
+            req = self.get_new_write_request()
+            self.add_update(req, p4runtime_pb2.Update.DELETE, entity)
+            self.write_request(req, store=False)
+
+        new_group_id = self.helper.get_next_grp_id()
+        new_member_ids = set(self.helper.get_next_mbr_id()
+                             for _ in member_ids)
+        self.assertEqual(new_group_id, group_id)
+        self.assertEqual(new_member_ids, member_ids)
+        self.helper.grp_ids.release(new_group_id)
+        for member_id in new_member_ids:
+            self.helper.mbr_ids.release(member_id)
+
+
 @group("routing")
 class NdpReplyGenTest(P4RuntimeTest):
     """Tests automatic generation of NDP Neighbor Advertisement for IPV6